@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Raster I/O throughput benchmarks for weto.dask_raster.
+
+Generates synthetic rasters across tiling, compression and dtype, then times
+read_raster_band and write_raster (locked and parallel) across block_size
+values and worker counts. Each case runs in a fresh process, so peak RSS and
+the dataset pool start clean. Block I/O is recorded with weto.metrics and
+summarized by stage. Results are appended as JSON lines, one per case, to
+compare runs over time.
+
+    python benchmarks/raster_io.py --size 4096 --output raster_io.jsonl
+    python benchmarks/raster_io.py --tilings 256 --compressions lzw zstd \
+        --dtypes int16 --workers 1 4 16
+
+Created on Sat Oct 17 13:31:08 2026
+
+@author: twillia2
+"""
+
+import argparse
+import datetime as dt
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess as sp
+import tempfile
+import time
+
+import dask
+import numpy as np
+import rasterio
+
+from rasterio.transform import from_origin
+
+
+TILINGS = ("striped", "256", "512")
+COMPRESSIONS = ("none", "lzw", "deflate", "zstd")
+DTYPES = ("uint8", "int16", "float32")
+BLOCK_SIZES = (1, 4, 16)
+WORKERS = (1, 4)
+
+
+def make_raster(path, size, tiling, compression, dtype):
+    """Write a synthetic, moderately compressible square raster"""
+    profile = {"driver": "GTiff", "height": size, "width": size, "count": 1,
+               "dtype": dtype, "crs": "EPSG:5070",
+               "transform": from_origin(0, size * 63.6, 63.6, 63.6)}
+    if tiling != "striped":
+        profile.update(tiled=True, blockxsize=int(tiling),
+                       blockysize=int(tiling))
+    if compression != "none":
+        profile["compress"] = compression
+
+    # Patchy integer codes, like the code rasters, with some noise
+    rng = np.random.RandomState(42)
+    rows = min(size, 1024)
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, size, rows):
+            height = min(rows, size - row)
+            codes = rng.randint(0, 200, (height // 64 + 1, size // 64 + 1))
+            block = np.kron(codes, np.ones((64, 64)))[:height, :size]
+            block += rng.randint(0, 3, block.shape)
+            window = rasterio.windows.Window(0, row, size, height)
+            dst.write(block.astype(dtype), 1, window=window)
+
+    return profile
+
+
+def run_case(case):
+    """Time one read and write case, meant to run in a fresh process"""
+    from weto.dask_raster import pool_stats, read_raster_band, write_raster
+    from weto.metrics import METRICS, enable_metrics, stage
+
+    # Block latencies are recorded only when asked for
+    enable_metrics()
+
+    path = case["path"]
+    nbytes = case["size"] ** 2 * np.dtype(case["dtype"]).itemsize
+    result = dict(case)
+
+    with dask.config.set(scheduler="threads", num_workers=case["workers"]):
+        # Read
+        start = time.time()
+        array = read_raster_band(path, block_size=case["block_size"])
+        result["graph_seconds"] = time.time() - start
+        result["tasks"] = len(array.__dask_graph__())
+        result["chunks"] = [max(c) for c in array.chunks]
+        start = time.time()
+        with stage("read"):
+            array.max().compute()
+        seconds = time.time() - start
+        result["read_seconds"] = seconds
+        result["read_mbs"] = nbytes / 1e6 / seconds
+        result["pool"] = pool_stats()
+
+        # Write, locked and parallel
+        with rasterio.open(path) as src:
+            profile = src.profile
+        for mode in ("locked", "parallel"):
+            dst = os.path.join(case["tmpdir"], "write_{}.tif".format(mode))
+            start = time.time()
+            with stage("write_" + mode):
+                write_raster(dst, array, parallel=mode == "parallel",
+                             **profile)
+            seconds = time.time() - start
+            result["write_{}_seconds".format(mode)] = seconds
+            result["write_{}_mbs".format(mode)] = nbytes / 1e6 / seconds
+            os.remove(dst)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if platform.system() == "Darwin" else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    result["peak_rss_mb"] = rss / 1e6
+    result["io"] = METRICS.summary(nslowest=1)
+
+    return result
+
+
+def environment():
+    """Describe the software and hardware a run happened on"""
+    try:
+        commit = sp.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                 cwd=os.path.dirname(__file__),
+                                 stderr=sp.DEVNULL).decode().strip()
+    except (OSError, sp.CalledProcessError):
+        commit = None
+
+    return {"timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+            "commit": commit, "host": platform.node(),
+            "cpus": mp.cpu_count(), "python": platform.python_version(),
+            "dask": dask.__version__, "rasterio": rasterio.__version__,
+            "gdal": rasterio.__gdal_version__}
+
+
+def main(args):
+    """Generate rasters, run every case and append results"""
+    env = environment()
+    context = mp.get_context("spawn")
+    tmpdir = args.tmpdir or tempfile.mkdtemp(prefix="weto_bench_")
+    os.makedirs(tmpdir, exist_ok=True)
+
+    for tiling, compression, dtype in itertools.product(
+            args.tilings, args.compressions, args.dtypes):
+        name = "{}_{}_{}.tif".format(tiling, compression, dtype)
+        path = os.path.join(tmpdir, name)
+        try:
+            make_raster(path, args.size, tiling, compression, dtype)
+        except rasterio.errors.RasterioError as error:
+            print("Skipping {}: {}".format(name, error))
+            continue
+
+        for block_size, workers in itertools.product(args.block_sizes,
+                                                     args.workers):
+            case = {"path": path, "tmpdir": tmpdir, "size": args.size,
+                    "tiling": tiling, "compression": compression,
+                    "dtype": dtype, "block_size": block_size,
+                    "workers": workers}
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case,))
+            result.update(env)
+            with open(args.output, "a") as file:
+                file.write(json.dumps(result) + "\n")
+            print("{} block_size={} workers={}: read {:.1f} MB/s, write "
+                  "{:.1f}/{:.1f} MB/s (locked/parallel), {} tasks, {:.0f} MB "
+                  "peak".format(name, block_size, workers,
+                                result["read_mbs"],
+                                result["write_locked_mbs"],
+                                result["write_parallel_mbs"],
+                                result["tasks"], result["peak_rss_mb"]))
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=4096,
+                        help="raster width and height in pixels")
+    parser.add_argument("--tilings", nargs="+", default=TILINGS,
+                        choices=TILINGS)
+    parser.add_argument("--compressions", nargs="+", default=COMPRESSIONS,
+                        choices=COMPRESSIONS)
+    parser.add_argument("--dtypes", nargs="+", default=DTYPES,
+                        choices=DTYPES)
+    parser.add_argument("--block-sizes", nargs="+", type=int,
+                        default=BLOCK_SIZES)
+    parser.add_argument("--workers", nargs="+", type=int, default=WORKERS)
+    parser.add_argument("--output", default="raster_io.jsonl",
+                        help="JSON lines file to append results to")
+    parser.add_argument("--tmpdir", default=None,
+                        help="scratch directory for the synthetic rasters")
+    main(parser.parse_args())
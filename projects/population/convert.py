@@ -15,8 +15,8 @@ import subprocess as sp
 import rasterio
 import xarray as xr
 
-from dask.distributed import Client
 from gdalmethods import Data_Path, translate, warp, gdal_options
+from weto.cluster import cluster
 
 dpp = Data_Path("/scratch/twillia2/weto/populations/data")
 dpc = Data_Path("/projects/rev/data/conus/")
@@ -83,7 +83,7 @@ new = xr.open_rasterio(dst, chunks=chunks)[0]
 ona = original.attrs["nodatavals"][0]
 nna = new.attrs["nodatavals"][0]
 
-with Client():
+with cluster():
     
     odata = original.data
     ndata = new.data
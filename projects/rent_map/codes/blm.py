@@ -107,7 +107,8 @@ rasterize(src=shp_dst,
           dst=dp.join("rasters/albers/acre/blm_codes.tif"),
           attribute="code",
           template_path=template,
-          dtype=gdal.GDT_Float32,
+          dtype=gdal.GDT_UInt16,
+          navalue=0,
           overwrite=True)
 
 # Done.
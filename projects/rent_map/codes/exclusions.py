@@ -10,10 +10,13 @@ Created on Fri Feb 14 09:18:28 2020
 
 import dask.array as da
 import numpy as np
+import rasterio
 import xarray as xr
 
-from dask.distributed import Client
-from gdalmethods import Data_Path, to_raster, warp
+from gdalmethods import Data_Path, warp
+from weto.cluster import cluster
+from weto.codes import EXCLUSION_CODE, NO_CODE
+from weto.dask_raster import write_raster
 
 # Data Paths
 # dp = Data_Path("~/Box/WETO 1.2/data")
@@ -27,6 +30,9 @@ RAIL_PATH =  DP.join("rasters", "core_exclusions_raster", "conus_rail.tif")
 # Best chunk size?
 CHUNKS = {'band': 1, 'x': 5000, 'y': 5000}
 
+# Exclusions are 9999 codes, 0 elsewhere
+CODE_DTYPE = "uint16"
+
 
 def build_exclusions():
     """ Build exclusion file for the WETO rent map."""
@@ -61,20 +67,20 @@ def build_exclusions():
     excl = da.stack([excl, roads, rails], axis=0).max(axis=0)
 
     # And let's make exclusion values 9999 since 1 will be a code
-    excl[excl == 1] = 9999
-
-    # And cut out just CONUS for mapping
-    excl = excl * conus
-
-    # Compute
-    print("Combining exclusion layers...")
-    with Client():
-        excl = excl.compute()
-
-    # save to raster
-    print("Saving to 90 meter reV grid...")
-    to_raster(excl, DP.join("rasters", "rent_exclusions.tif"),
-              template=EXL_PATH, compress="deflate")
+    excl[excl == 1] = EXCLUSION_CODE
+
+    # And cut out just CONUS for mapping, as integer codes
+    excl = (excl * conus).astype(CODE_DTYPE)
+
+    # Compute and save to raster in one streaming pass, only warp needs it
+    print("Combining exclusion layers on the 90 meter reV grid...")
+    with rasterio.open(EXL_PATH) as template:
+        profile = template.profile
+    profile.update(dtype=CODE_DTYPE, nodata=NO_CODE, count=1,
+                   compress="deflate")
+    with cluster():
+        write_raster(DP.join("rasters", "rent_exclusions.tif"), excl,
+                     parallel=True, **profile)
 
     # warp to acre grid in north american albers equal area conic
     print("Warping to acre grid...")
@@ -52,5 +52,6 @@ if not os.path.exists(state_tif):
               dst=state_tif,
               attribute="code",
               template_path=template,
-              dtype=gdal.GDT_Float32,
+              dtype=gdal.GDT_UInt16,
+              navalue=0,
               overwrite=True)
@@ -44,5 +44,6 @@ rasterize(src=shp_path_albers,
           dst=dp.join("rasters/albers/acre/tribal_codes.tif"),
           attribute="code",
           template_path=template,
-          dtype=gdal.GDT_Float32,
+          dtype=gdal.GDT_UInt16,
+          navalue=0,
           overwrite=True)
@@ -9,44 +9,64 @@ Created on Mon Feb  3 16:02:50 2020
 
 import os
 
+import dask
 import dask.array as da
 import numpy as np
-import xarray as xr
+import rasterio
 
 from osgeo import gdal
 
-from dask.distributed import Client
 from gdalmethods import Data_Path, to_raster
-from tqdm import tqdm
+from rasterio.transform import Affine
+from weto.cluster import cluster
+from weto.codes import code_nodata, priority_composite, to_codes, valid_mask
+from weto.dask_raster import read_aligned, write_raster
+from weto.metrics import METRICS, collect_metrics, stage
+from weto.store import IntermediateStore
+from weto.tiles import write_tiles
 
 # Data Paths
 DP = Data_Path("/scratch/twillia2/weto/data")
 DPM = Data_Path(DP.join("rasters/albers/acre/masks"))
 
-# Set the chunk sizes
-CHUNKS = {'band': 1, 'x': 5000, 'y': 5000}
+# Interim arrays are handed between steps here, not through GeoTIFFs
+STORE = IntermediateStore(DPM.join("interim.zarr"))
+
+# Integer code mode, None keeps float32 codes with NaN outside CONUS
+CODE_DTYPE = "uint16"
+NODATA = np.nan if CODE_DTYPE is None else code_nodata(CODE_DTYPE)
+
+# Values that mean "no code here", including the integer nodata sentinel
+NAVALUES = (-9999., 0.) if CODE_DTYPE is None else (-9999., 0., NODATA)
 
 # Reference geometry
 REFERENCE = gdal.Open(DP.join("rasters/albers/acre/blm_codes.tif"))
 PROJ = REFERENCE.GetProjection()
 GEOM = REFERENCE.GetGeoTransform()
+TRANSFORM = Affine.from_gdal(*GEOM)
+PROFILE = {"driver": "GTiff", "height": REFERENCE.RasterYSize,
+           "width": REFERENCE.RasterXSize, "count": 1,
+           "dtype": CODE_DTYPE or "float32", "nodata": NODATA, "crs": PROJ,
+           "transform": TRANSFORM, "tiled": True, "blockxsize": 256,
+           "blockysize": 256, "compress": "lzw"}
+GRID = (TRANSFORM, (REFERENCE.RasterYSize, REFERENCE.RasterXSize))
+
+# Code layers, highest priority first
+PRIORITY = ["excl", "blm", "tribal", "state", "nlcd"]
 
 
-@da.as_gufunc(signature="(i)->(i)", output_dtypes=int, vectorize=True,
-              allow_rechunk=True)
-def gmask(array, navalues=(-9999., 0.0)):
-    """Create a mask of 1's and 0 out of an array using non values"""
-    # So multiple values can be masked out
-    if not isinstance(navalues, (list, tuple, np.ndarray)):
-        navalues = [navalues]
+def masked(array, mask=True):
+    """Zero the cells outside a mask or without a code, so the nodata
+    sentinel of integer codes never outranks a real code"""
+    return da.where(mask & valid_mask(array, NAVALUES), array,
+                    0).astype(array.dtype)
 
-    # Create mask
-    array = array.copy()
-    array[np.isin(array, navalues)] = np.nan
-    array = array * 0 + 1
-    array[np.isnan(array)] = 0
 
-    return array
+def as_codes(array):
+    """Cast a code array to CODE_DTYPE, if integer codes are on"""
+    if CODE_DTYPE is None:
+        return array
+    return to_codes(array, CODE_DTYPE, nodata=NODATA)
 
 
 # Make a conus mask with 1s for in and nans for out
@@ -54,11 +74,11 @@ def conus_mask():
     if not os.path.exists(DPM.join("conus.tif")):
         print("Creating CONUS mask...")
         template = DP.join("rasters/albers/acre/nlcd.tif")
-        conus = xr.open_rasterio(template, chunks=CHUNKS)[0].data
+        conus = read_aligned(template, GRID, chunks="auto")
         conus = conus.astype("float32")
         conus[conus == 0.] = np.nan
         conus = (conus * 0) + 1
-        with Client():
+        with cluster():
             conus = conus.compute()
         to_raster(conus, DPM.join("conus.tif"), PROJ, GEOM, dtype="float32")
 
@@ -85,103 +105,145 @@ def build_masks():
     state_path = paths["state_path"]
     excl_path = paths["excl_path"]
 
-    # Get each array, remove band dimension
-    nlcd = xr.open_rasterio(nlcd_path, chunks=CHUNKS)[0].data
-    blm = xr.open_rasterio(blm_path, chunks=CHUNKS)[0].data
-    tribes = xr.open_rasterio(tribal_path, chunks=CHUNKS)[0].data
-    state = xr.open_rasterio(state_path, chunks=CHUNKS)[0].data
-    excl = xr.open_rasterio(excl_path, chunks=CHUNKS)[0].data
-
-    # I need to fix this...nlcd's shape is off by one cell
-    if nlcd.shape != blm.shape:
-        # One too many on top
-        nlcd = nlcd[1:, :]
-
-        # Now we need two on bottom
-        x = da.from_array(np.zeros((1, nlcd.shape[1])))
-        nlcd = np.vstack((nlcd, x, x))
-
-        # and one extra on the side
-        y = da.from_array(np.zeros((nlcd.shape[0], 1)))
-        nlcd = np.hstack((nlcd, y))
-        with Client():
-            nlcd = nlcd.compute()
-        to_raster(nlcd, nlcd_path, PROJ, GEOM)
-
-    # Make a mask of each higher priority layer
-    emask = gmask(excl)
-    bmask = gmask(blm)
-    tmask = gmask(tribes)
-    smask = gmask(state)
-
-    # Make four composite masks, the max will bring 1s to the front
-    mask1 = da.stack([emask, bmask, tmask, smask], axis=0).max(axis=0)
-    mask2 = da.stack([emask, bmask, tmask], axis=0).max(axis=0)
-    mask3 = da.stack([emask, bmask], axis=0).max(axis=0)
-    mask4 = emask
-
-    # Now we actually want the inverse of these (1 -> 0 -> 0 ; 0 -> -1 -> 1)
-    mask1 = (mask1 - 1) * -1
-    mask2 = (mask2 - 1) * -1
-    mask3 = (mask3 - 1) * -1
-    mask4 = (mask4 - 1) * -1
-
-    # We'll need to setup interim files, I can't handle the memory useage
+    # Get each array on the reference grid in block-aligned chunks. nlcd's
+    # grid is off by a cell, so it is lazily shifted and padded onto it
+    nlcd = read_aligned(nlcd_path, GRID, chunks="auto")
+    blm = read_aligned(blm_path, GRID, chunks="auto")
+    tribes = read_aligned(tribal_path, GRID, chunks="auto")
+    state = read_aligned(state_path, GRID, chunks="auto")
+    excl = read_aligned(excl_path, GRID, chunks="auto")
+    nlcd, blm, tribes, state, excl = [as_codes(a) for a in
+                                      (nlcd, blm, tribes, state, excl)]
+
+    # Make a boolean mask of each higher priority layer
+    emask = valid_mask(excl, NAVALUES)
+    bmask = valid_mask(blm, NAVALUES)
+    tmask = valid_mask(tribes, NAVALUES)
+    smask = valid_mask(state, NAVALUES)
+
+    # Four composite masks, True where no higher priority layer has a value
+    mask4 = ~emask
+    mask3 = mask4 & ~bmask
+    mask2 = mask3 & ~tmask
+    mask1 = mask2 & ~smask
+
+    # Too much memory at once, so stage the masked layers in the store
     layers = {"nlcd": nlcd,
               "state": state,
               "tribes": tribes,
               "blm": blm}
-    masked_paths = {"nlcd": DPM.join("nlcd.tif"),
-                    "state": DPM.join("state.tif"),
-                    "tribes": DPM.join("tribes.tif"),
-                    "blm": DPM.join("blm.tif")}
     masks = {"nlcd": mask1,
              "state": mask2,
              "tribes": mask3,
              "blm": mask4}
 
-    # Loop through, the lowest priority layers are masked by the largest mask <---- This is obviously not the best way to do this
+    # Write every masked layer in one graph, so the shared masks and their
+    # inputs are read once per chunk rather than once per layer
     print("Masking individual layers...")
-    for key, layer in tqdm(layers.items(), position=0):
-        layer_path = masked_paths[key]
-        mask = masks[key]
-        mlayer = layer * mask
-        with Client():
-            masked_layer = mlayer.compute()
-        to_raster(masked_layer, layer_path, PROJ, GEOM)
-        del masked_layer
+    with cluster() as client:
+        writes = [STORE.write(key, masked(layer, masks[key]),
+                              transform=TRANSFORM, crs=PROJ, compute=False)
+                  for key, layer in layers.items()]
+        dask.compute(*writes)
+        collect_metrics(client)
 
-    return masked_paths
+    return list(layers.keys())
 
 
-def composite(masked_paths):
-    
-    # Too much at once, read the precomputd masked layers from file
+def composite(masked_names):
+
+    # Read the precomputed masked layers back from the store
     excl_path = DP.join("rasters/albers/acre/rent_exclusions.tif")
-    excl = xr.open_rasterio(excl_path, chunks=CHUNKS)[0].data
-    mblm = xr.open_rasterio(masked_paths["blm"], chunks=CHUNKS)[0].data
-    mtribes = xr.open_rasterio(masked_paths["tribes"], chunks=CHUNKS)[0].data
-    mstate = xr.open_rasterio(masked_paths["state"], chunks=CHUNKS)[0].data
-    mnlcd = xr.open_rasterio(masked_paths["nlcd"], chunks=CHUNKS)[0].data
-    mconus = xr.open_rasterio(DPM.join("conus.tif"), chunks=CHUNKS)[0].data
-
-    print("Merging layers ...")
-    with Client():
+    excl = masked(as_codes(read_aligned(excl_path, GRID, chunks="auto")))
+    mblm = STORE.read("blm")
+    mtribes = STORE.read("tribes")
+    mstate = STORE.read("state")
+    mnlcd = STORE.read("nlcd")
+    mconus = read_aligned(DPM.join("conus.tif"), GRID, chunks="auto")
+
+    # Stream the composite straight into the final GeoTIFF
+    save = DP.join("rasters/albers/acre/cost_codes.tif")
+    print("Merging layers into " + save + " ...")
+    with cluster() as client:
         layers = [excl, mblm, mtribes, mstate, mnlcd]
         composite_layer = da.stack(layers, axis=0).max(axis=0)
-        composite_layer = composite_layer * mconus
-        final = composite_layer.compute()
+        composite_layer = da.where(valid_mask(mconus), composite_layer,
+                                   NODATA)
+        write_raster(save, composite_layer.astype(PROFILE["dtype"]),
+                     parallel=True, **PROFILE)
+        collect_metrics(client)
+
+
+def code_layers(priority=PRIORITY, chunks="auto"):
+    """Read each code layer and the CONUS mask lazily on the reference grid
+    Returns:
+        tuple -- dict of code layers in priority order, and the mask
+    """
+    paths = code_paths()
+    layers = {}
+    for key in priority:
+        layers[key] = read_aligned(paths[key + "_path"], GRID, chunks=chunks)
+    conus = read_aligned(DPM.join("conus.tif"), GRID, chunks=chunks)
 
-    # Save to file
-    save = DP.join("rasters/albers/acre/cost_codes.tif")
-    print("Saving file to " + save + " ...")
-    to_raster(final, save, PROJ, GEOM)
+    return layers, conus
+
+
+def composite_array(priority=PRIORITY, source_band=False, chunks="auto"):
+    """The lazy priority composite of the code layers"""
+    layers, conus = code_layers(priority, chunks)
+    return priority_composite(layers, navalues=NAVALUES, mask=conus,
+                              nodata=NODATA,
+                              source_band=source_band,
+                              dtype=PROFILE["dtype"])
 
 
-def main():
-    conus_mask()
-    masked_paths = build_masks()
-    composite(masked_paths)
+def fused_composite(priority=PRIORITY, source_band=False):
+    """Build cost_codes.tif in one pass, each cell taking the first valid
+    code in priority order. Every input window is read once, there are no
+    interim layers, and with source_band a second band records which layer
+    (1-based, in priority order) won each cell."""
+
+    # Stream the composite straight into the final GeoTIFF
+    save = DP.join("rasters/albers/acre/cost_codes.tif")
+    print("Compositing " + ", ".join(priority) + " into " + save + " ...")
+    composite_layer = composite_array(priority, source_band)
+    profile = dict(PROFILE, count=2 if source_band else 1)
+    with cluster() as client:
+        write_raster(save, composite_layer, parallel=True, **profile)
+        collect_metrics(client)
+
+
+def update_composite(tiles, chunks, priority=PRIORITY):
+    """Recompute some tiles of cost_codes.tif and rewrite them in place
+    Arguments:
+        tiles {list(tuple)} -- (row, col) indices of tiles to rebuild
+        chunks {tuple(int)} -- (rows, cols) tile shape
+    """
+    save = DP.join("rasters/albers/acre/cost_codes.tif")
+    with rasterio.open(save) as src:
+        source_band = src.count == 2
+    composite_layer = composite_array(priority, source_band, chunks)
+    print("Rewriting {} tiles of {} ...".format(len(tiles), save))
+    with cluster() as client:
+        write_tiles(save, composite_layer, tiles)
+        collect_metrics(client)
+
+
+def main(fused=True, source_band=False):
+    with stage("conus_mask"):
+        conus_mask()
+    if fused:
+        with stage("composite"):
+            fused_composite(source_band=source_band)
+    else:
+        with stage("build_masks"):
+            masked_names = build_masks()
+        with stage("composite"):
+            composite(masked_names)
+
+    # Per-stage block I/O latency and throughput, with WETO_METRICS=1
+    if METRICS.enabled:
+        METRICS.to_csv(DP.join("tables", "cost_codes_io.csv"))
 
 
 if __name__ == "__main__":
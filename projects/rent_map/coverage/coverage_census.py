@@ -10,22 +10,25 @@ Created on Tue Mar 24 10:23:16 2020
 
 import os
 
-from tqdm import tqdm
-
 import dask.array as da
 import geopandas as gpd
 import pandas as pd
 import rasterio
-import xarray as xr
 
-from dask.distributed import Client
+from coverage_codes import SAMPLE_CHUNK_BYTES, parser, read_on_grid
 from gdalmethods import Data_Path, rasterize
+from weto.cluster import cluster
+from weto.codes import EXCLUSION_CODE, NO_CODE, clear_nodata
+from weto.stats import ratio_estimate, sample_blocks, zonal_crosstab
 
 
 DP = Data_Path("/scratch/twillia2/weto/data")
 TEMPLATE = DP.join("rasters", "albers", "acre", "rent_map.tif")
 DIVISIONS_PATH = DP.join("rasters", "albers", "acre", "census_divisions.tif")
 
+# Kinds of code cell, in code layer order: no code, a cost code or excluded
+CODE_KINDS = ["none", "code", "excluded"]
+
 
 # Get a shapefile of the census blocks
 def make_divisions():
@@ -63,95 +66,122 @@ def make_divisions():
     return division_dict
 
 
-def coverage_total(division_dict, cost_coverage=False):
+def division_counts(division_dict, fraction=None, seed=None):
+    """Count cells by census division, code kind, CONUS and cost in one
+    pass over the rasters.
+
+    With a fraction, only a stratified random sample of blocks is counted,
+    block by block, and the sample design is returned for the coverage
+    functions to estimate confidence intervals with. Otherwise the design
+    is None.
+    """
 
     conus_path = DP.join("rasters", "albers", "acre", "masks", "conus.tif")
     code_path = DP.join("rasters", "albers", "acre", "cost_codes.tif")
     cost_path = DP.join("rasters/albers/acre/rent_map.tif")
-    chunks = {"band": 1, "x": 5000, "y": 5000}
-
-    # Read in the tifs
-    codes = xr.open_rasterio(code_path, chunks=chunks)[0].data
-    conus = xr.open_rasterio(conus_path, chunks=chunks)[0].data
-    costs = xr.open_rasterio(cost_path, chunks=chunks)[0].data
-    divisions = xr.open_rasterio(DIVISIONS_PATH, chunks=chunks)[0].data
-
-    # Set nans to zero (count_nonzero counts nans)
-    codes[da.isnan(codes)] = 0
-
-    coverages = {}
-    with Client():
-        for key, item in tqdm(division_dict.items(), position=0):
-            
-            div = conus[divisions == key]
-            total = da.count_nonzero(div)
-
-            # If calculating costs
-            if cost_coverage:
-                coverage = codes[((costs > 0) | (codes == 9999)) &
-                                 (divisions == key)]
-                coded = da.count_nonzero(coverage)
-            else:
-                coverage = codes[divisions == key]
-                coded = da.count_nonzero(coverage)
-            ratio = coded / total
-            coverages[item] = ratio.compute()
-
-    df = pd.DataFrame(coverages, index=[0]).T
-    df.columns = ["total_coverage"]
+    with rasterio.open(code_path) as src:
+        code_nodata = src.nodata
+    with rasterio.open(DIVISIONS_PATH) as src:
+        division_nodata = src.nodata
 
-    return df
+    # Read in the tifs in block-aligned chunks on the code grid, smaller
+    # ones when sampling
+    chunk_bytes = SAMPLE_CHUNK_BYTES if fraction else None
+    codes, conus, costs, divisions = read_on_grid(
+        [code_path, conus_path, cost_path, DIVISIONS_PATH], chunk_bytes)
 
+    # Nodata codes count as no code, NaN as outside CONUS or any division.
+    # The zones lead the crosstab, so they carry the code chunks
+    codes = clear_nodata(codes, code_nodata)
+    zones = clear_nodata(divisions, division_nodata, fill=0).astype("uint8")
+    zones = zones.rechunk(codes.chunks)
+    layers = {"code": ((codes != NO_CODE).astype("uint8") +
+                       (codes == EXCLUSION_CODE)),
+              "conus": (conus != 0) & ~da.isnan(conus),
+              "cost": costs > 0}
 
-def coverage_developable(division_dict, cost_coverage=False):
+    design = blocks = None
+    if fraction:
+        blocks, strata, totals = sample_blocks(zones.numblocks, fraction,
+                                               seed=seed)
+        design = (strata, totals)
 
-    conus_path = DP.join("rasters", "albers", "acre", "masks", "conus.tif")
-    code_path = DP.join("rasters", "albers", "acre", "cost_codes.tif")
-    cost_path = DP.join("rasters/albers/acre/rent_map.tif")
-    chunks = {"band": 1, "x": 5000, "y": 5000}
-
-    # Read in the tifs
-    codes = xr.open_rasterio(code_path, chunks=chunks)[0].data
-    conus = xr.open_rasterio(conus_path, chunks=chunks)[0].data
-    costs = xr.open_rasterio(cost_path, chunks=chunks)[0].data
-    divisions = xr.open_rasterio(DIVISIONS_PATH, chunks=chunks)[0].data
-
-    # Set nans to zero (count_nonzero counts nans)
-    codes[da.isnan(codes)] = 0
-
-    coverages = {}
-    with Client():
-        for key, item in tqdm(division_dict.items(), position=0):
-            # break
-            developable = da.count_nonzero(
-                conus[(divisions == key) &
-                      (codes != 9999)]
-                )
-
-            # If calculating costs
-            if cost_coverage:
-                coverage = codes[(costs > 0) &
-                                 (codes != 9999) &
-                                 (divisions == key)]
-                coded = da.count_nonzero(coverage)
-            else:
-                coverage = codes[(divisions == key) &
-                                 (codes != 9999)]
-                coded = da.count_nonzero(coverage)
-            ratio = coded / developable
-            coverages[item] = ratio.compute()
-
-    df = pd.DataFrame(coverages, index=[0]).T
-    df.columns = ["developable_coverage"]
+    with cluster():
+        table = zonal_crosstab(zones, layers, sizes=[len(CODE_KINDS), 2, 2],
+                               zone_size=max(division_dict) + 1,
+                               blocks=blocks)
+    table["code"] = table["code"].map(dict(enumerate(CODE_KINDS)))
+    table = table[table["zone"].isin(list(division_dict))]
+
+    return table, design
+
+
+def _ratios(counts, covered, area, division_dict, column, design=None):
+    """Covered over area cells by division, as a named data frame.
+
+    With a sample design, each ratio is estimated from the counts of the
+    sampled blocks, with the half width of its 95% confidence interval in
+    a second "_margin" column.
+    """
+
+    if design is None:
+        def total(rows):
+            return counts[rows].groupby("zone")["count"].sum()
+
+        ratios = total(covered) / total(area)
+        ratios = ratios.reindex(list(division_dict))
+        ratios.index = [division_dict[key] for key in ratios.index]
+
+        return ratios.to_frame(column)
+
+    # Covered and area cells of every division in every sampled block
+    blocks = pd.MultiIndex.from_product(
+        [list(division_dict), range(len(design[0]))],
+        names=["zone", "block"])
+
+    def total(rows):
+        totals = counts[rows].groupby(["zone", "block"])["count"].sum()
+        return totals.reindex(blocks, fill_value=0)
+
+    y, x = total(covered), total(area)
+    estimates = {name: ratio_estimate(y[key].values, x[key].values, *design)
+                 for key, name in division_dict.items()}
+
+    return pd.DataFrame(estimates, index=[column, column + "_margin"]).T
+
+
+def coverage_total(counts, division_dict, cost_coverage=False,
+                   design=None):
+    """Share of each division's CONUS cells that have a code."""
+
+    coded = counts["code"] != "none"
+    if cost_coverage:
+        coded &= counts["cost"] | (counts["code"] == "excluded")
+
+    return _ratios(counts, coded, counts["conus"], division_dict,
+                   "total_coverage", design)
+
+
+def coverage_developable(counts, division_dict, cost_coverage=False,
+                         design=None):
+    """Share of each division's developable CONUS cells that have a
+    code."""
+
+    developable = counts["code"] != "excluded"
+    coded = counts["code"] == "code"
+    if cost_coverage:
+        coded &= counts["cost"]
+
+    return _ratios(counts, coded, developable & counts["conus"],
+                   division_dict, "developable_coverage", design)
 
-    return df
 
 def merge_dfs(df1, df2):
 
     df = df1.join(df2)
     df["census_division"] = df.index
-    cols = df.columns
-    new_cols = [cols[i] for i in (2, 0, 1)]
+    cols = list(df.columns)
+    new_cols = cols[-1:] + cols[:-1]
     df = df[new_cols]
     
     return df
@@ -159,18 +189,29 @@ def merge_dfs(df1, df2):
 
 if __name__ == "__main__":
 
+    args = parser(__doc__).parse_args()
+    suffix = "_approx" if args.sample else ""
     division_dict = make_divisions()
 
+    # One pass over the rasters for all four tables
+    counts, design = division_counts(division_dict, args.sample, args.seed)
+
     # Codes
-    tcode_df = coverage_total(division_dict, cost_coverage=False)
-    dcode_df = coverage_developable(division_dict, cost_coverage=False)
+    tcode_df = coverage_total(counts, division_dict, cost_coverage=False,
+                              design=design)
+    dcode_df = coverage_developable(counts, division_dict,
+                                    cost_coverage=False, design=design)
     codedf = merge_dfs(tcode_df, dcode_df)
-    save_path = DP.join("tables", "census_code_coverage.csv")
+    save_path = DP.join("tables", "census_code_coverage{}.csv".format(
+        suffix))
     codedf.to_csv(save_path, index=False)
 
     # Costs
-    tcost_df = coverage_total(division_dict, cost_coverage=True)
-    dcost_df = coverage_developable(division_dict, cost_coverage=True)
+    tcost_df = coverage_total(counts, division_dict, cost_coverage=True,
+                              design=design)
+    dcost_df = coverage_developable(counts, division_dict,
+                                    cost_coverage=True, design=design)
     costdf = merge_dfs(tcost_df, dcost_df)
-    save_path = DP.join("tables", "census_cost_coverage.csv")
+    save_path = DP.join("tables", "census_cost_coverage{}.csv".format(
+        suffix))
     costdf.to_csv(save_path, index=False)
@@ -7,19 +7,28 @@ Created on Thu Feb 20 22:26:30 2020
 @author: twillia2
 """
 
+import argparse
+
 import dask.array as da
 import numpy as np
 import pandas as pd
-import xarray as xr
+import rasterio
 
-from dask.distributed import Client
 from gdalmethods import Data_Path
-from tqdm import tqdm
+from weto.cluster import cluster
+from weto.codes import EXCLUSION_CODE, NO_CODE, clear_nodata, to_codes
+from weto.dask_raster import aligned_window, read_aligned
+from weto.dask_raster import read_amplification, read_raster_band
+from weto.stats import block_histograms, joint_histogram, ratio_estimate
+from weto.stats import sample_blocks
 
 
 # DP = Data_Path("~/data/weto/rent_map")
 DP = Data_Path("/scratch/twillia2/weto/data")
 
+# Chunk size target when sampling, so there are many blocks to draw from
+SAMPLE_CHUNK_BYTES = "8MiB"
+
 
 def fixit(x):
     x = x.replace("*", "").replace("\n", "").replace("$", "").replace(",", "")
@@ -58,119 +67,216 @@ def get_codes(cost_coverage=False):
     return code_dict
 
 
-def get_counts(cost_coverage=False):
-    """Get cell counts for each category."""
+def read_on_grid(paths, chunk_bytes=None):
+    """Read rasters on the grid of the first in block-aligned chunks.
 
-    code_dict = get_codes(cost_coverage)
+    The others share the first one's chunks wherever those also fall on
+    their own blocks, so a sampled block reads whole tiles of every input.
+    Any other raster gets auto chunks of its own blocks.
+    """
+
+    first = read_raster_band(paths[0], chunks="auto",
+                             chunk_bytes=chunk_bytes)
+    arrays = [first]
+    for path in paths[1:]:
+        with rasterio.open(path) as src:
+            window = aligned_window(src, first.transform, first.shape)
+            factor = read_amplification(src.block_shapes[0], src.shape,
+                                        first.chunks, offset=(
+                                            window.row_off, window.col_off))
+        chunks = first.chunks if factor <= 1.0 else "auto"
+        arrays.append(read_aligned(path, paths[0], chunks=chunks,
+                                   chunk_bytes=chunk_bytes))
+
+    return arrays
+
+
+def read_inputs(chunk_bytes=None):
+    """Read the code, CONUS and cost rasters as (code, in CONUS, has a
+    cost) histogram inputs, in chunks of about chunk_bytes."""
 
-    # Read in code and conus rasters
-    chunks = {"band": 1, "x": 5000, "y": 5000}
     code_path = DP.join("rasters/albers/acre/cost_codes.tif")
     cost_path = DP.join("rasters/albers/acre/rent_map.tif")
     conus_path = DP.join("rasters/albers/acre/masks/conus.tif")
-    codes = xr.open_rasterio(code_path, chunks=chunks)[0].data
-    costs = xr.open_rasterio(cost_path, chunks=chunks)[0].data
-    conus = xr.open_rasterio(conus_path, chunks=chunks)[0].data
+    with rasterio.open(code_path) as src:
+        code_nodata = src.nodata
+    codes, costs, conus = read_on_grid([code_path, cost_path, conus_path],
+                                       chunk_bytes)
+
+    # Nodata codes count as no code, NaN as outside CONUS. Float code
+    # rasters are cast to integer codes to be histogram bins
+    codes = clear_nodata(codes, code_nodata)
+    codes = to_codes(codes, navalues=())
+    in_conus = (conus != 0) & ~da.isnan(conus)
+    has_cost = costs > 0
+
+    return [codes, in_conus, has_cost]
+
 
-    # Dask array's `count_nonzero` counts na values
-    codes[da.isnan(codes)] = 0
-    conus[da.isnan(conus)] = 0
+def count_categories(hist, code_dict, cost_coverage=False):
+    """Cell counts for each category from a (code, in CONUS, has a cost)
+    histogram."""
 
-    # If calculating costs
+    # Cells covered by each code, with a cost or excluded for cost coverage
     if cost_coverage:
-        coverage = codes[(costs > 0) | (codes == 9999)]  # No exclusion in cost
+        covered = hist[:, :, 1].sum(axis=1)
+        covered[EXCLUSION_CODE] += hist[EXCLUSION_CODE, :, 0].sum()
     else:
-        coverage = codes.copy()
-
-    # Extract code from dictionary
-    blm_codes = code_dict["blm"]
-    tribal_codes = code_dict["tribal"]
-    state_codes = code_dict["state"]
-    private_codes = code_dict["private"]
-
-    # Arrays
-    developable = conus[codes != 9999]
-    dev_covered = coverage[coverage != 9999]
-    excl = coverage[coverage == 9999]
-    blm = coverage[da.isin(coverage, blm_codes)]
-    tribal = coverage[da.isin(coverage, tribal_codes)]
-    state = coverage[da.isin(coverage, state_codes)]
-    private = coverage[da.isin(coverage, private_codes)]
-    arrays = {"excl": excl, "blm": blm, "tribal": tribal, "state": state,
-              "private": private, "covered": coverage, "total": conus, 
-              "developable": developable, "dev_covered": dev_covered}
-
-    # Collect counts
-    counts = {}
-    with Client():
-        for key, item in tqdm(arrays.items(), position=0):
-            counts["n" + key] = da.count_nonzero(item).compute()
+        covered = hist.sum(axis=(1, 2))
+    covered[NO_CODE] = 0
+
+    # Covered cells in each category
+    def category(key):
+        return int(covered[np.unique(code_dict[key]).astype(int)].sum())
+
+    conus_codes = hist[:, 1, :].sum(axis=1)
+    counts = {"nexcl": int(covered[EXCLUSION_CODE]),
+              "nblm": category("blm"),
+              "ntribal": category("tribal"),
+              "nstate": category("state"),
+              "nprivate": category("private"),
+              "ncovered": int(covered.sum()),
+              "ntotal": int(conus_codes.sum()),
+              "ndevelopable": int(conus_codes.sum() -
+                                  conus_codes[EXCLUSION_CODE]),
+              "ndev_covered": int(covered.sum() - covered[EXCLUSION_CODE])}
 
     return counts
 
 
-def overall_coverage(counts):
-    """Calculate percent coverage of each category overall."""
+def get_counts(cost_coverage=False):
+    """Get cell counts for each category.
+
+    Every count comes from one joint histogram of (code, in CONUS, has a
+    cost) built in a single pass over the three rasters.
+    """
 
-    # Overall percentages
-    total_coverage = counts["ncovered"] / counts["ntotal"]
-    blm_coverage = counts["nblm"] /counts["ntotal"]
-    tribal_coverage = counts["ntribal"] / counts["ntotal"]
-    private_coverage = counts["nprivate"] / counts["ntotal"]
-    state_coverage = counts["nstate"] / counts["ntotal"]
-    excl_coverage = counts["nexcl"] / counts["ntotal"]
+    code_dict = get_codes(cost_coverage)
+    arrays = read_inputs()
+    with cluster():
+        hist = joint_histogram(arrays).compute()
 
-    # Overall Data Frame
-    overall = {"total": total_coverage,
-                "blm": blm_coverage,
-                "tribal": tribal_coverage,
-                "state": state_coverage,
-                "private": private_coverage,
-                "excluded": excl_coverage}
-    odf = pd.DataFrame(overall, index=[0]).T
-    odf.columns = ["overall_percentage"]
+    return count_categories(hist, code_dict, cost_coverage)
 
-    return odf
 
+def sample_counts(cost_coverage=False, fraction=0.05, seed=None):
+    """Get cell counts for each category in a stratified random sample of
+    blocks, for quick approximate coverage.
 
-def developable_coverage(counts):
-    """Calculate percent coverage, but only within developable land."""
+    Returns the counts of each sampled block, as arrays, and the sample
+    design to pass on to get_coverage.
+    """
+
+    code_dict = get_codes(cost_coverage)
+    arrays = read_inputs(SAMPLE_CHUNK_BYTES)
+    blocks, strata, totals = sample_blocks(arrays[0].numblocks, fraction,
+                                           seed=seed)
+    with cluster():
+        hists = block_histograms(arrays, blocks)
+
+    block_counts = [count_categories(hist, code_dict, cost_coverage)
+                    for hist in hists]
+    counts = {key: np.array([c[key] for c in block_counts])
+              for key in block_counts[0]}
+
+    return counts, (strata, totals)
+
+
+def coverage_frame(counts, numerators, denominator, column, design=None):
+    """Share of the denominator count in each numerator count.
 
-    # Developable Percentages
-    total_coverage = counts["ndev_covered"] / counts["ndevelopable"]
-    blm_coverage = counts["nblm"] / counts["ndevelopable"]
-    tribal_coverage = counts["ntribal"] / counts["ndevelopable"]
-    private_coverage = counts["nprivate"] / counts["ndevelopable"]
-    state_coverage = counts["nstate"] / counts["ndevelopable"]
+    With a sample design the counts are per sampled block, and the half
+    width of each share's 95% confidence interval goes in a second
+    "_margin" column.
+    """
 
-    # Developable Data Frame
-    developable = {"total": total_coverage,
-                    "blm": blm_coverage,
-                    "tribal": tribal_coverage,
-                    "state": state_coverage,
-                    "private": private_coverage}
-    ddf = pd.DataFrame(developable, index=[0]).T
-    ddf.columns = ["developable_percentage"]
+    shares = {}
+    for area, numerator in numerators.items():
+        if design is None:
+            shares[area] = (counts[numerator] / counts[denominator], None)
+        else:
+            shares[area] = ratio_estimate(counts[numerator],
+                                          counts[denominator], *design)
 
-    return ddf
+    df = pd.DataFrame({column: [s[0] for s in shares.values()]},
+                      index=list(shares))
+    if design is not None:
+        df[column + "_margin"] = [s[1] for s in shares.values()]
 
+    return df
+
+
+def overall_coverage(counts, design=None):
+    """Calculate percent coverage of each category overall."""
+
+    numerators = {"total": "ncovered",
+                  "blm": "nblm",
+                  "tribal": "ntribal",
+                  "state": "nstate",
+                  "private": "nprivate",
+                  "excluded": "nexcl"}
+
+    return coverage_frame(counts, numerators, "ntotal",
+                          "overall_percentage", design)
+
+
+def developable_coverage(counts, design=None):
+    """Calculate percent coverage, but only within developable land."""
+
+    numerators = {"total": "ndev_covered",
+                  "blm": "nblm",
+                  "tribal": "ntribal",
+                  "state": "nstate",
+                  "private": "nprivate"}
+
+    return coverage_frame(counts, numerators, "ndevelopable",
+                          "developable_percentage", design)
 
-def get_coverage(counts, file_path="coverage.csv"):
+
+def get_coverage(counts, file_path="coverage.csv", design=None):
     """Combine overall and developable coverage statistics."""
 
     # Get both data frames
-    odf = overall_coverage(counts)
-    ddf = developable_coverage(counts)
+    odf = overall_coverage(counts, design)
+    ddf = developable_coverage(counts, design)
 
     # Composite Data Frame
     df = odf.join(ddf)
     df["area"] = df.index
-    df = df[["area", "overall_percentage", "developable_percentage"]]
+    df = df[["area"] + [c for c in df.columns if c != "area"]]
     df.to_csv(DP.join("tables", file_path), index=False)
 
     return df
 
 
+def parser(description):
+    """Command line options shared by the coverage scripts."""
+
+    options = argparse.ArgumentParser(
+        description=description.split("\n\n")[0])
+    options.add_argument("--sample", type=float, metavar="FRACTION",
+                         help="estimate from this share of blocks, with "
+                              "95%% confidence intervals, instead of "
+                              "counting every cell")
+    options.add_argument("--seed", type=int,
+                         help="random seed of the block sample")
+
+    return options
+
+
+def main(args, cost_coverage=False, file_path="coverage_codes.csv"):
+    """Write exact coverage, or an approximate table next to it."""
+
+    if args.sample:
+        counts, design = sample_counts(cost_coverage, args.sample, args.seed)
+        file_path = file_path.replace(".csv", "_approx.csv")
+    else:
+        counts, design = get_counts(cost_coverage), None
+    df = get_coverage(counts, file_path=file_path, design=design)
+    print(df.to_string(index=False))
+
+    return df
+
+
 if __name__ == "__main__":
-    counts = get_counts(cost_coverage=False)
-    covdf = get_coverage(counts, file_path="coverage_codes.csv")
+    main(parser(__doc__).parse_args())
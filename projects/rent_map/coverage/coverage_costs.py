@@ -7,9 +7,9 @@ Created on Tue Mar 24 10:19:58 2020
 @author: twillia2
 """
 
-from coverage_codes import get_counts, get_coverage
+from coverage_codes import main, parser
 
 
 if __name__ == "__main__":
-    counts = get_counts(cost_coverage=True)
-    covdf = get_coverage(counts, file_path="coverage_cost.csv")
+    main(parser(__doc__).parse_args(), cost_coverage=True,
+         file_path="coverage_cost.csv")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Patch cost_codes.tif and rent_map.tif after a small input correction.
+
+Every code layer and the CONUS mask is hashed tile by tile on the cost code
+grid and compared with the hashes from the last run. Only the tiles that
+changed are recomputed and rewritten in place in cost_codes.tif and
+rent_map.tif, their tile statistics indexes are refreshed for the same
+tiles, then the coverage statistics that read them are rerun. With no
+saved hashes, or when the grid changed, it falls back to a full build.
+A changed lookup table still remaps all of rent_map.tif.
+
+    python incremental.py
+
+Created on Sat Oct 17 21:40:18 2026
+
+@author: twillia2
+"""
+
+import os
+
+import numpy as np
+
+from cost_codes import PRIORITY, code_layers, conus_mask, update_composite
+from cost_codes import main as build_codes
+from pipeline import DP, LOOKUP, stages
+from rent_map import table, update_costs
+from rent_map import main as build_costs
+from weto.cluster import cluster
+from weto.pipeline import HashCache, Pipeline
+from weto.tiles import TileIndex, TileState, tile_hashes
+
+
+# Tile shape, a multiple of the 256 cell output blocks
+TILE = (2048, 2048)
+
+# Tile hashes from the last run
+STATE = TileState(DP.join("tables/rent_map_tiles.npz"))
+
+# Stages that read cost_codes.tif and rent_map.tif
+COVERAGE = ["coverage_codes", "coverage_costs", "coverage_census",
+            "map_categories"]
+
+
+def input_hashes():
+    """Hash every code layer and the CONUS mask tile by tile, plus the
+    lookup table as a whole"""
+    # The mask is made by the first full build, so a fresh tree needs it
+    # before anything can be hashed
+    conus_mask()
+    layers, conus = code_layers(PRIORITY, chunks=TILE)
+    layers["conus"] = conus
+    with cluster():
+        hashes = {name: tile_hashes(layer) for name, layer in layers.items()}
+    digest = HashCache()(LOOKUP)
+    hashes["lookup"] = np.frombuffer(bytes.fromhex(digest[:16]),
+                                     dtype=np.uint64).reshape((1, 1))
+
+    return hashes
+
+
+def main():
+    hashes = input_hashes()
+    lookup_hash = hashes.pop("lookup")
+    saved = STATE.load()
+    tiles = STATE.changed(hashes)
+    outputs = [DP.join("rasters/albers/acre/cost_codes.tif"),
+               DP.join("rasters/albers/acre/rent_map.tif")]
+
+    indexes = [TileIndex(path, tile=TILE) for path in outputs]
+    if tiles is None or not all(os.path.exists(p) for p in outputs):
+        print("No comparable tile state, rebuilding everything...")
+        build_codes()
+        build_costs()
+        rebuilt = indexes
+    else:
+        print("{} of {} tiles changed".format(
+            len(tiles), next(iter(hashes.values())).size))
+        update_composite(tiles, TILE)
+        rebuilt = [i for i in indexes if not os.path.exists(i.index_path)]
+        if not np.array_equal(saved.get("lookup"), lookup_hash):
+            print("The lookup table changed, remapping all costs...")
+            build_costs()
+            rebuilt.append(indexes[1])
+        else:
+            update_costs(table(), tiles, TILE)
+
+    # Refresh the tile statistics of what was rewritten
+    with cluster():
+        for index in indexes:
+            if index in rebuilt:
+                index.build()
+            else:
+                index.update(tiles)
+
+    hashes["lookup"] = lookup_hash
+    STATE.save(hashes)
+
+    # Record the patched rasters as current and refresh what reads them
+    pipeline = Pipeline(stages(), DP.join("tables/rent_map_pipeline.json"),
+                        log_dir=DP.join("logs/rent_map"))
+    pipeline.mark_current(["cost_codes", "rent_map"])
+    results = pipeline.run(targets=COVERAGE)
+    for name, result in results.items():
+        print("{:<16} {}".format(name, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,15 @@ Created on Thu Mar 26 12:40:25 2020
 @author: twillia2
 """
 
+import dask.array as da
 import numpy as np
 import pandas as pd
 import rasterio
-import xarray as xr
 
-from dask.distributed import Client
-from gdalmethods import Data_Path, to_raster
+from gdalmethods import Data_Path
+from weto.cluster import cluster
+from weto.codes import EXCLUSION_CODE, NO_CODE, code_lut, map_codes
+from weto.dask_raster import read_raster_band, write_raster
 
 DP = Data_Path("/scratch/twillia2/weto/data")
 
@@ -23,62 +25,80 @@ CATEGORIES = {1: "BLM",
               3: "State", 
               4: "Private"}
 
-CHUNKS = {'band': 1, 'x': 5000, 'y': 5000}
+# Category for cells outside CONUS, 0 is no category
+NODATA = -1
 
+# Category for codes in neither the lookup table nor the fixed codes below
+UNMAPPED = -2
+
+
+def categorize(lookup):
+    """Category number of each row of the lookup table"""
+    types = lookup["type"]
+    conditions = [types.str.contains("BLM"),
+                  types.str.contains("Tribal"),
+                  types.str.contains("State Land")]
+    return np.select(conditions, [1, 2, 3], default=4)
+
+
+def classify(codes, costs, lookup, code_nodata=None, cost_nodata=None):
+    """Classify codes and costs into categories in one blockwise pass
+    Each code is looked up in a code-indexed category array, so categories
+    can have any codes, interleaved or not.
+    Arguments:
+        codes {dask.array.Array} -- cost codes
+        costs {dask.array.Array} -- dollars per acre on the same grid
+        lookup {pandas.DataFrame} -- lookup table with code and type
+    Keyword Arguments:
+        code_nodata {int, float} -- nodata value of codes (default: {None})
+        cost_nodata {int, float} -- nodata value of costs (default: {None})
+    Returns:
+        tuple(dask.array.Array) -- int16 code categories, EXCLUSION_CODE
+            for exclusions and UNMAPPED for codes not in the table, and
+            the same categories only where there is a cost
+    """
+    # No code stays 0 and exclusions keep their code, as in the original
+    # category rasters
+    codes_in = np.concatenate([lookup["code"], [NO_CODE, EXCLUSION_CODE]])
+    cats = np.concatenate([categorize(lookup), [0, EXCLUSION_CODE]])
+    lut = code_lut(codes_in, cats, dtype="int16", unmapped=UNMAPPED)
+    code_cats = map_codes(codes, lut, navalues=[code_nodata], nodata=NODATA)
+    costed = costs > 0
+    if cost_nodata is not None:
+        costed &= costs != cost_nodata
+    cost_cats = da.where(costed | (code_cats == NODATA), code_cats,
+                         np.int16(0))
+
+    return code_cats, cost_cats
 
-def categorize(row):
-    if "BLM" in row["type"]:
-        return 1
-    if "Tribal" in row["type"]:
-        return 2
-    if "State Land" in row["type"]:
-        return 3
-    else:
-        return 4
 
-    
 def main():
-    
+
     # Get lookup table with all of the codes
     lookup = pd.read_csv(DP.join("tables", "conus_cbe_lookup.csv"))
-    lookup["category"] = lookup.apply(categorize, axis=1)    
-
-    # Get all codes for each category
-    cat_codes = {}
-    for cat in CATEGORIES.keys():
-        code_vals = lookup["code"][lookup["category"] == cat].values
-        cat_codes[cat] = code_vals
+    lookup.columns = ["code", "type", "dollar_ac"]
 
-    # Open the rasters
+    # Read the rasters once, both outputs come from the same chunks
     code_path = DP.join("rasters", "albers", "acre", "cost_codes.tif")
     cost_path = DP.join("rasters", "albers", "acre", "rent_map.tif")
-    template = rasterio.open(code_path)
-    codes = xr.open_rasterio(code_path, chunks=CHUNKS)[0].data
-    costs = xr.open_rasterio(cost_path, chunks=CHUNKS)[0].data 
-    new_costs = costs.copy()
-    new_codes = codes.copy()
-
-    # Okay, change all of the values
-    for cat, code_vals in cat_codes.items():
-        minc = np.nanmin(code_vals)
-        maxc = np.nanmax(code_vals)
-#        new_costs[(codes >= minc) & (codes <= maxc) & (costs > 0)] = cat
-        new_codes[(codes >= minc) & (codes <= maxc)] = cat
-        
-    # Now compute the results
-    with Client():
-#        new_costs = new_costs.compute()
-        new_codes = new_codes.compute()
-
-    # Save
-    proj = template.crs.to_wkt()
-    geom = template.transform.to_gdal()
+    with rasterio.open(code_path) as src:
+        profile = src.profile
+        code_nodata = src.nodata
+    with rasterio.open(cost_path) as src:
+        cost_nodata = src.nodata
+    codes = read_raster_band(code_path, chunks="auto")
+    costs = read_raster_band(cost_path, chunks="auto")
+    code_cats, cost_cats = classify(codes, costs, lookup, code_nodata,
+                                    cost_nodata)
+
+    # Compute and save both in one graph, each chunk read once for both
+    profile.update(dtype="int16", count=1, nodata=NODATA, compress="LZW")
     new_cost_path = DP.join("rasters", "albers", "acre", "cost_cats.tif")
     new_code_path = DP.join("rasters", "albers", "acre", "code_cats.tif")
-    to_raster(new_costs, new_cost_path, proj, geom, dtype="int16",
-              compress="LZW")
-    to_raster(new_codes, new_code_path, proj, geom, dtype="int16",
-              compress="LZW")
+    with cluster():
+        write_raster([new_code_path, new_cost_path], [code_cats, cost_cats],
+                     parallel=True, **profile)
+
 
 if __name__ == "__main__":
     main()
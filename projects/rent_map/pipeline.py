@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run the rent map workflow, redoing only what changed.
+
+Replaces the hand-run sequence in order.txt. Each script is a stage with
+declared inputs and outputs. A stage is skipped when its inputs and code
+hash the same as its last successful run, and stages that don't depend on
+each other, like the exclusion, BLM, tribal and state code rasters, run at
+the same time. Editing dollar values in the lookup table reruns rent_map.py
+and what reads rent_map.tif, but not the code rasters, which only depend
+on the lookup table's code and type columns.
+
+    python pipeline.py                     # bring everything up to date
+    python pipeline.py --dry-run           # show what would run
+    python pipeline.py rent_map            # just rent_map and its inputs
+    python pipeline.py --force state       # rerun state and downstream
+
+Created on Sat Oct 17 20:14:37 2026
+
+@author: twillia2
+"""
+
+import argparse
+import os
+
+from gdalmethods import Data_Path
+from weto.pipeline import Pipeline, Stage, raster_grid, table_columns
+
+
+DP = Data_Path("/scratch/twillia2/weto/data")
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The lookup table's code and type columns, without dollar values
+LOOKUP = DP.join("tables/conus_cbe_lookup.csv")
+LOOKUP_CODES = (LOOKUP, table_columns(0, 1))
+
+# Rasters
+ACRE = Data_Path(DP.join("rasters/albers/acre"))
+EXCLUSIONS = ACRE.join("rent_exclusions.tif")
+NLCD = ACRE.join("nlcd.tif")
+NLCD_AG = ACRE.join("nlcd_ag.tif")
+NLCD_CODES = ACRE.join("nlcd_codes.tif")
+BLM_CODES = ACRE.join("blm_codes.tif")
+TRIBAL_CODES = ACRE.join("tribal_codes.tif")
+STATE_CODES = ACRE.join("state_codes.tif")
+CONUS = ACRE.join("masks/conus.tif")
+COST_CODES = ACRE.join("cost_codes.tif")
+RENT_MAP = ACRE.join("rent_map.tif")
+DIVISIONS = ACRE.join("census_divisions.tif")
+
+
+def stages():
+    """The rent map stages, in no particular order"""
+    return [
+        Stage("exclusions", ["python", "codes/exclusions.py"], cwd=HERE,
+              inputs=[DP.join("rasters/core_exclusions_raster/"
+                              "alopez_core_exclusions.tif"),
+                      DP.join("rasters/core_exclusions_raster/"
+                              "conus_roads.tif"),
+                      DP.join("rasters/core_exclusions_raster/"
+                              "conus_rail.tif"),
+                      DP.join("rasters/albers/90m/conus.tif")],
+              outputs=[EXCLUSIONS]),
+        Stage("nlcd", ["python", "codes/nlcd.py"], cwd=HERE,
+              inputs=[DP.join("rasters/NLCD/"
+                              "NLCD_2016_Land_Cover_L48_20190424.img"),
+                      (EXCLUSIONS, raster_grid), LOOKUP_CODES],
+              outputs=[NLCD, NLCD_AG, NLCD_CODES,
+                       DP.join("tables/nlcd_rast_lookup.csv")]),
+        Stage("blm", ["python", "codes/blm.py"], cwd=HERE,
+              inputs=[LOOKUP_CODES, (NLCD_AG, raster_grid),
+                      DP.join("shapefiles/BLM/"
+                              "conus_fedland_blm_county.shp")],
+              outputs=[BLM_CODES]),
+        Stage("tribal", ["python", "codes/tribal.py"], cwd=HERE,
+              inputs=[LOOKUP_CODES, (NLCD_AG, raster_grid),
+                      DP.join("shapefiles/tribal/tl_2016_us_aiannh.shp")],
+              outputs=[TRIBAL_CODES]),
+        Stage("state", ["python", "codes/state.py"], cwd=HERE,
+              inputs=[LOOKUP_CODES, (NLCD_AG, raster_grid),
+                      DP.join("shapefiles/USA/conus_padus_state.shp")],
+              outputs=[STATE_CODES]),
+        Stage("cost_codes", ["python", "cost_codes.py"], cwd=HERE,
+              inputs=[EXCLUSIONS, NLCD_CODES, BLM_CODES, TRIBAL_CODES,
+                      STATE_CODES, (NLCD, raster_grid)],
+              outputs=[COST_CODES, CONUS]),
+        Stage("rent_map", ["python", "rent_map.py"], cwd=HERE,
+              inputs=[LOOKUP, COST_CODES],
+              outputs=[RENT_MAP]),
+        Stage("map_categories", ["python", "map_categories.py"], cwd=HERE,
+              inputs=[LOOKUP_CODES, COST_CODES, RENT_MAP],
+              outputs=[ACRE.join("code_cats.tif"),
+                       ACRE.join("cost_cats.tif")]),
+        Stage("coverage_codes", ["python", "coverage/coverage_codes.py"],
+              cwd=HERE, inputs=[LOOKUP_CODES, COST_CODES, RENT_MAP, CONUS],
+              outputs=[DP.join("tables/coverage_codes.csv")]),
+        Stage("coverage_costs", ["python", "coverage/coverage_costs.py"],
+              cwd=os.path.join(HERE, "coverage"),
+              code=["coverage_costs.py", "coverage_codes.py"],
+              inputs=[LOOKUP, COST_CODES, RENT_MAP, CONUS],
+              outputs=[DP.join("tables/coverage_cost.csv")]),
+        Stage("coverage_census", ["python", "coverage/coverage_census.py"],
+              cwd=HERE, code=["coverage/coverage_census.py",
+                              "coverage/coverage_codes.py"],
+              inputs=[COST_CODES, RENT_MAP, CONUS],
+              outputs=[DIVISIONS,
+                       DP.join("tables/census_code_coverage.csv"),
+                       DP.join("tables/census_cost_coverage.csv")])
+    ]
+
+
+def main(args):
+    pipeline = Pipeline(stages(), DP.join("tables/rent_map_pipeline.json"),
+                        log_dir=DP.join("logs/rent_map"))
+    results = pipeline.run(targets=args.targets or None, force=args.force,
+                           max_workers=args.workers, dry_run=args.dry_run)
+    for name, result in results.items():
+        print("{:<16} {}".format(name, result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("targets", nargs="*",
+                        help="stages to bring up to date, default all")
+    parser.add_argument("--force", nargs="+", default=[],
+                        help="stages to rerun along with their dependents")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="most stages to run at once")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="report what would run without running it")
+    main(parser.parse_args())
@@ -8,17 +8,26 @@ Created on Fri Feb 21 10:02:49 2020
 @author: twillia2
 """
 
-import os
 import pandas as pd
-import subprocess as sp
+import rasterio
 
-from gdalmethods import Data_Path, Map_Values
-from glob import glob
+from gdalmethods import Data_Path
+from weto.cluster import cluster
+from weto.codes import code_lut, map_codes
+from weto.dask_raster import read_raster_band, write_raster
+from weto.metrics import collect_metrics
+from weto.tiles import write_tiles
 
 
 # Set Data Path
 # DP = Data_Path("~/data/weto/rent_map")
 DP = Data_Path("/scratch/twillia2/weto/data")
+CODE_PATH = DP.join("rasters/albers/acre/cost_codes.tif")
+COST_PATH = DP.join("rasters/albers/acre/rent_map.tif")
+
+# Dollar values for codes missing from the table and for cells outside CONUS
+UNMAPPED = 0.
+NODATA = -9999.
 
 
 def fixit(x):
@@ -28,51 +37,73 @@ def fixit(x):
     return x
 
 
-def table():
-    lookup = pd.read_csv(DP.join("tables/conus_cbe_lookup.csv"))
+def table(path=None):
+    """Read a code to dollar lookup table, conus_cbe_lookup.csv by default,
+    or another table in its format"""
+    lookup = pd.read_csv(path or DP.join("tables/conus_cbe_lookup.csv"))
     lookup.columns = ['code', 'type', 'dollar_ac']
     lookup["dollar_ac"] = lookup["dollar_ac"].apply(fixit)
     lookup["dollar_ac"] = lookup["dollar_ac"].astype(float)
 
-    return lookup
-
-
-def tile():
-    code_path = DP.join("rasters/albers/acre/cost_codes.tif")
-    print("Tiling " + code_path + "...")
-    code_tile_folder = DP.join("rasters/albers/acre/code_tiles")
-    os.makedirs(code_tile_folder, exist_ok=True)
-    sp.call(["gdal_retile.py",
-             "-ps", "5000", "5000",
-             "-targetDir", code_tile_folder,
-             code_path])
-    code_tiles = glob(os.path.join(code_tile_folder, "*tif"))
+    # Codes are integers, so keys match uint16 code rasters exactly
+    lookup["code"] = lookup["code"].astype(int)
 
-    return code_tiles
-
-
-def map_costs(lookup, code_tiles):
-    cost_tile_folder = DP.join("rasters/albers/acre/cost_tiles")
-    print("Mapping costs to code tiles...")
-    val_dict = dict(zip(lookup["code"], lookup["dollar_ac"]))
-    mv = Map_Values(val_dict)
-    cost_tiles = mv.map_files(code_tiles, cost_tile_folder, ncpu=4)
-
-    return cost_tiles
+    return lookup
 
 
-def merge_costs(cost_tiles):
-    cost_file = DP.join("rasters/albers/acre/rent_map.tif")
-    print("Merging cost tiles into " + cost_file + "...")
-    call =  ["gdal_merge.py", "-o", cost_file] + cost_tiles
-    sp.call(call)
+def costs(lookup, chunks="auto", strict=False):
+    """Lazily map cost_codes.tif to dollars per acre
+    The dense lookup array is built once and each chunk is mapped with one
+    np.take. Codes missing from the table get UNMAPPED, or raise a KeyError
+    when strict, and cells with the code raster's nodata value get NODATA.
+    Arguments:
+        lookup {pandas.DataFrame} -- code to dollar table
+    Keyword Arguments:
+        chunks {string, tuple(int)} -- read chunks (default: {"auto"})
+        strict {bool} -- fail on codes missing from the table
+            (default: {False})
+    Returns:
+        dask.array.Array -- float32 dollars per acre
+    """
+    lut = code_lut(lookup["code"], lookup["dollar_ac"], unmapped=UNMAPPED)
+    with rasterio.open(CODE_PATH) as src:
+        code_nodata = src.nodata
+    codes = read_raster_band(CODE_PATH, chunks=chunks)
+
+    return map_codes(codes, lut, navalues=[code_nodata], nodata=NODATA,
+                     known=lookup["code"], strict=strict)
+
+
+def map_costs(lookup, strict=False):
+    """Stream rent_map.tif straight from cost_codes.tif in one pass"""
+    print("Mapping " + CODE_PATH + " to costs in " + COST_PATH + "...")
+    with rasterio.open(CODE_PATH) as src:
+        profile = src.profile
+    profile.update(driver="GTiff", count=1, dtype="float32", nodata=NODATA,
+                   tiled=True, blockxsize=256, blockysize=256,
+                   compress="lzw")
+    with cluster() as client:
+        write_raster(COST_PATH, costs(lookup, strict=strict), parallel=True,
+                     **profile)
+        collect_metrics(client)
+
+
+def update_costs(lookup, tiles, chunks):
+    """Recompute some tiles of rent_map.tif from cost_codes.tif and rewrite
+    them in place
+    Arguments:
+        lookup {pandas.DataFrame} -- code to dollar table
+        tiles {list(tuple)} -- (row, col) indices of tiles to rebuild
+        chunks {tuple(int)} -- (rows, cols) tile shape
+    """
+    print("Rewriting {} tiles of {} ...".format(len(tiles), COST_PATH))
+    with cluster():
+        write_tiles(COST_PATH, costs(lookup, chunks), tiles)
 
 
 def main():
     lookup = table()
-    code_tiles = tile()
-    cost_tiles = map_costs(lookup, code_tiles)
-    merge_costs(cost_tiles)
+    map_costs(lookup)
 
 
 if __name__ == "__main__":
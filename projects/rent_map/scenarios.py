@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare alternative dollar per acre lookup tables without remapping.
+
+Codes in cost_codes.tif are counted once by state, county and census
+division, in one pass, and the counts are kept in a table. A scenario's
+dollar total and mean for CONUS or any zone is then a sum over those
+counts, so any number of lookup tables, in the format of
+conus_cbe_lookup.csv, are compared in seconds. The current lookup table is
+always included as "baseline". With --write, the scenarios are also mapped
+to one band each of a cost raster in a single pass over the codes.
+
+    python scenarios.py low.csv high.csv
+    python scenarios.py low.csv high.csv --zones conus state
+    python scenarios.py low.csv high.csv --write scenario_costs.tif
+
+Created on Sun Oct 18 11:05:27 2026
+
+@author: twillia2
+"""
+
+import argparse
+import os
+
+import dask.array as da
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+
+from gdalmethods import Data_Path, rasterize
+from rent_map import CODE_PATH, NODATA, UNMAPPED, table
+from weto.cluster import cluster
+from weto.codes import CODE_NODATA, clear_nodata, code_lut, map_codes
+from weto.codes import to_codes
+from weto.dask_raster import read_raster_band, write_raster
+from weto.metrics import collect_metrics
+from weto.stats import value_counts
+
+
+DP = Data_Path("/scratch/twillia2/weto/data")
+TEMPLATE = DP.join("rasters", "albers", "acre", "rent_map.tif")
+COUNTS_PATH = DP.join("tables", "code_counts.csv")
+
+# Census zones: boundary file, id field, name field and one more than the
+# largest id. Divisions share their files with coverage_census.py
+CENSUS = "https://www2.census.gov/geo/tiger/GENZ2018/shp/"
+ZONES = {
+    "state": {"file": "cb_2018_us_state_5m", "field": "STATEFP",
+              "label": "NAME", "size": 100,
+              "raster": DP.join("rasters", "albers", "acre",
+                                "census_states.tif")},
+    "county": {"file": "cb_2018_us_county_5m", "field": "GEOID",
+               "label": "NAME", "size": 2 ** 16,
+               "raster": DP.join("rasters", "albers", "acre",
+                                 "census_counties.tif")},
+    "division": {"file": "cb_2018_us_division_5m", "field": "DIVISIONCE",
+                 "label": "NAME", "size": 10,
+                 "raster": DP.join("rasters", "albers", "acre",
+                                   "census_divisions.tif")}
+}
+
+
+def make_zones(name):
+    """Download, reproject and rasterize a census zone layer, then return
+    its zone ids and names."""
+
+    zone = ZONES[name]
+    shp_path = DP.join("shapefiles", "USA", zone["file"] + ".shp")
+
+    if not os.path.exists(shp_path):
+        print("Retrieving Census {}s...".format(name))
+        zones = gpd.read_file(CENSUS + zone["file"] + ".zip")
+        zones = zones.to_crs(rasterio.open(TEMPLATE).crs.to_proj4())
+        zones.to_file(shp_path)
+
+    if not os.path.exists(zone["raster"]):
+        print("Rasterizing Census {}s...".format(name))
+        rasterize(shp_path, zone["raster"], attribute=zone["field"],
+                  template_path=TEMPLATE)
+
+    zones = gpd.read_file(shp_path)
+    return dict(zip(zones[zone["field"]].astype(int), zones[zone["label"]]))
+
+
+def read_zones(name):
+    """Read a zone raster as uint16 ids, 0 outside every zone"""
+    zones = read_raster_band(ZONES[name]["raster"], chunks="auto")
+    with rasterio.open(ZONES[name]["raster"]) as src:
+        nodata = src.nodata
+    outside = da.isnan(zones) if zones.dtype.kind == "f" else False
+    if nodata is not None:
+        outside = outside | (zones == nodata)
+    return da.where(outside, 0, zones).astype("uint16")
+
+
+def code_counts(refresh=False):
+    """Count cells of each code by state, county and division
+    The counts are computed in one pass over cost_codes.tif and the zone
+    rasters, then kept in COUNTS_PATH until one of them changes.
+    Keyword Arguments:
+        refresh {bool} -- recount even if the kept counts are current
+            (default: {False})
+    Returns:
+        pandas.DataFrame -- code, state, county, division and count
+            columns, without cells outside CONUS
+    """
+    rasters = [CODE_PATH] + [zone["raster"] for zone in ZONES.values()]
+    if not refresh and os.path.exists(COUNTS_PATH):
+        kept = os.path.getmtime(COUNTS_PATH)
+        if all(os.path.getmtime(p) < kept for p in rasters):
+            return pd.read_csv(COUNTS_PATH)
+
+    print("Counting codes by zone...")
+    with rasterio.open(CODE_PATH) as src:
+        code_nodata = src.nodata
+
+    # Integer codes, with nodata and NaN on the uint16 sentinel
+    nodata = CODE_NODATA["uint16"]
+    codes = read_raster_band(CODE_PATH, chunks="auto")
+    codes = to_codes(clear_nodata(codes, code_nodata, fill=nodata),
+                     navalues=())
+
+    arrays = [codes] + [read_zones(name) for name in ZONES]
+    sizes = [2 ** 16] + [zone["size"] for zone in ZONES.values()]
+    with cluster() as client:
+        counts = value_counts(arrays, ["code"] + list(ZONES), sizes)
+        collect_metrics(client)
+    counts = counts[counts["code"] != nodata]
+    counts.to_csv(COUNTS_PATH, index=False)
+
+    return counts
+
+
+def scenario_luts(scenarios, size):
+    """Stack the dollar lookup array of each scenario
+    Arguments:
+        scenarios {dict} -- scenario name: code to dollar table
+        size {int} -- length of each lookup array, see code_lut
+    Returns:
+        numpy.ndarray -- (scenarios, size) dollars per acre by code
+    """
+    return np.stack([code_lut(lookup["code"], lookup["dollar_ac"],
+                              dtype="float64", unmapped=UNMAPPED, size=size)
+                     for lookup in scenarios.values()])
+
+
+def evaluate(counts, scenarios, zone=None, names=None):
+    """Dollar totals and means of each scenario, from code counts alone
+    Arguments:
+        counts {pandas.DataFrame} -- code counts from code_counts
+        scenarios {dict} -- scenario name: code to dollar table
+    Keyword Arguments:
+        zone {string} -- zone column to break totals down by, or None for
+            CONUS as a whole (default: {None})
+        names {dict} -- zone id: zone name (default: {None})
+    Returns:
+        pandas.DataFrame -- scenario, zone, name, cells, costed cells,
+            total dollars, mean dollars per acre and mean dollars per
+            costed acre
+    """
+    keys = ["code"] if zone is None else [zone, "code"]
+    counts = counts.groupby(keys, as_index=False)["count"].sum()
+    codes = counts["code"].values.astype(np.intp)
+    cells = counts["count"].values
+
+    # Cover every counted code, those missing from a table get UNMAPPED
+    size = max([int(codes.max()) + 2 if codes.size else 1] +
+               [int(lookup["code"].max()) + 2
+                for lookup in scenarios.values()])
+    dollars = scenario_luts(scenarios, size)[:, codes]
+
+    frames = []
+    for name, values in zip(scenarios, dollars):
+        frame = pd.DataFrame({"zone": "conus" if zone is None else
+                              counts[zone].values,
+                              "cells": cells,
+                              "costed_cells": np.where(values > 0, cells, 0),
+                              "total": values * cells})
+        frame = frame.groupby("zone", as_index=False).sum()
+        frame["mean"] = frame["total"] / frame["cells"]
+        frame["costed_mean"] = frame["total"] / frame["costed_cells"]
+        frame.insert(0, "scenario", name)
+        frames.append(frame)
+
+    results = pd.concat(frames, ignore_index=True)
+    results.insert(2, "name", results["zone"].map(names or {}))
+    if zone is not None:
+        results = results[results["zone"] != 0]
+
+    return results
+
+
+def write_scenarios(scenarios, path):
+    """Map every scenario to its own band of one cost raster in a single
+    pass over the codes"""
+    print("Mapping " + CODE_PATH + " to {} scenario bands in {}...".format(
+        len(scenarios), path))
+    with rasterio.open(CODE_PATH) as src:
+        profile = src.profile
+        code_nodata = src.nodata
+    size = max(int(lookup["code"].max()) + 2
+               for lookup in scenarios.values())
+    luts = scenario_luts(scenarios, size).astype("float32")
+    codes = read_raster_band(CODE_PATH, chunks="auto")
+    bands = map_codes(codes, luts, navalues=[code_nodata], nodata=NODATA)
+
+    profile.update(driver="GTiff", count=len(scenarios), dtype="float32",
+                   nodata=NODATA, tiled=True, blockxsize=256,
+                   blockysize=256, compress="lzw", interleave="band")
+    with cluster() as client:
+        write_raster(path, bands, parallel=True, **profile)
+        collect_metrics(client)
+    with rasterio.open(path, "r+") as dst:
+        for band, name in enumerate(scenarios, start=1):
+            dst.set_band_description(band, name)
+
+
+def main(args):
+    scenarios = {"baseline": table()}
+    for path in args.tables:
+        scenarios[os.path.splitext(os.path.basename(path))[0]] = table(path)
+
+    # Every zone raster is counted at once, so make any that are missing
+    zones = args.zones or ["conus"] + list(ZONES)
+    names = {zone: make_zones(zone) for zone in ZONES}
+    counts = code_counts(refresh=args.refresh)
+
+    results = []
+    for zone in zones:
+        result = evaluate(counts, scenarios, None if zone == "conus" else
+                          zone, names.get(zone))
+        result.insert(1, "zone_type", zone)
+        results.append(result)
+    results = pd.concat(results, ignore_index=True)
+    results.to_csv(DP.join("tables", "scenario_costs.csv"), index=False)
+
+    conus = results[results["zone_type"] == "conus"]
+    print(conus[["scenario", "cells", "costed_cells", "total", "mean",
+                 "costed_mean"]].to_string(index=False))
+
+    if args.write:
+        write_scenarios(scenarios, args.write)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("tables", nargs="*",
+                        help="lookup tables to compare with the baseline")
+    parser.add_argument("--zones", nargs="+",
+                        choices=["conus"] + list(ZONES),
+                        help="zones to break totals down by, default all")
+    parser.add_argument("--write", metavar="PATH",
+                        help="also write a cost raster with a band per "
+                             "scenario")
+    parser.add_argument("--refresh", action="store_true",
+                        help="recount codes by zone even if current")
+    main(parser.parse_args())
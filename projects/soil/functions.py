@@ -31,10 +31,10 @@ import pandas as pd
 import rasterio 
 import xarray as xr
 
-from dask.distributed import Client
 from gdalmethods import Map_Values
 from pyproj import Proj, transform
 from urllib.request import urlretrieve
+from weto.cluster import cluster
 
 
 GSSURGO_URLS = {
@@ -67,7 +67,7 @@ def fix_mukey(mukey_tif):
     # Change everything under 0 to the nan value
     array = mukey.data
     array[array < 0] = profile["nodata"]
-    with Client():
+    with cluster():
         array = array.compute()
 
     # save
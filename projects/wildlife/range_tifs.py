@@ -10,8 +10,9 @@ import rasterio
 import xarray as xr
 
 from numpy.random import randint
-from dask.distributed import Client
 from gdalmethods import Data_Path, to_raster
+from weto.cluster import get_client
+from weto.dask_raster import read_raster_band
 
 
 DP = Data_Path("/projects/rev/data/conus/wildlife")
@@ -43,6 +44,9 @@ RANGE_CATEGORIES = {
 
 CHUNKS = {"band": 1, "x": 5000, "y": 5000}
 
+# Test region, ((row_start, row_stop), (col_start, col_stop))
+WINDOW = ((4000, 10000), (4000, 10000))
+
 
 def seq_int(seq):
     """Concatenate a list of integers.
@@ -82,7 +86,9 @@ def code_range(path_dict):
     for key, path in path_dict.items():
         value = key_dict[key]
         full_path = DP.join(path)
-        array = xr.open_rasterio(full_path, chunks=CHUNKS)[0].data
+        array = read_raster_band(full_path, chunks=(CHUNKS["y"], CHUNKS["x"]),
+                                 window=WINDOW)
+        transform = array.transform
         array[da.isnan(array)] = 0
         array[array > 0] = value
         arrays.append(array)
@@ -90,15 +96,12 @@ def code_range(path_dict):
     # Stack everything together - we might have to save this a temporary file
     stack = da.stack(arrays, axis=0)
     stack = stack.rechunk((stack.shape[0], 5000, 5000))
-    stack = stack[:, 4000: 10000, 4000: 10000]
 
     # Try to map the function to each point
-    client = Client()
+    client = get_client()
     codes = da.apply_along_axis(seq_int, 0, stack, dtype="uint8")
     future = client.compute(codes)
     result = future.result()
-    client.shutdown()
-    client.close()
 
     # Save to temp and delete
     template = rasterio.open(full_path)
@@ -108,9 +111,12 @@ def code_range(path_dict):
         profile.update(
             dtype=rasterio.uint8,
             count=1,
+            height=result.shape[0],
+            width=result.shape[1],
+            transform=transform,
             compress='lzw')
         with rasterio.open(temp_path, 'w', **profile) as dst:
-            dst.write(result)
+            dst.write(result, 1)
 
 
 if __name__ == "__main__":
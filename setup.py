@@ -20,5 +20,5 @@ setup(
     author_email="travis.williams@nrel.gov",
     install_requires=["dask", "dask-jobqueue", "descartes", "distributed",
                       "geopandas", "h5py", "rasterio", "scipy", "tqdm",
-		      "xarray"]
+		      "xarray", "zarr"]
     )
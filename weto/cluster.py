@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One shared, configurable dask cluster for the project scripts.
+
+Scripts open `with cluster() as client:` wherever they used to open
+`with Client():`. The first call starts a local or SLURM cluster and every
+later call, in any stage or module, reuses the same warm workers. The
+cluster is shut down when the process exits, or with `shutdown()`.
+
+Settings come from DEFAULTS, updated by a YAML or JSON file (the `path`
+argument, or the WETO_CLUSTER_CONFIG environment variable), then by
+WETO_CLUSTER_<KEY> environment variables:
+
+    # ~/weto_cluster.yaml
+    backend: slurm
+    minimum: 2
+    maximum: 40
+    slurm:
+        account: weto
+        queue: standard
+        walltime: "04:00:00"
+
+    WETO_CLUSTER_CONFIG=~/weto_cluster.yaml python cost_codes.py
+    WETO_CLUSTER_BACKEND=local WETO_CLUSTER_MAXIMUM=8 python cost_codes.py
+
+Created on Sat Oct 17 18:20:44 2026
+
+@author: twillia2
+"""
+
+import atexit
+import copy
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+
+import yaml
+
+
+BACKENDS = ("local", "slurm")
+
+DEFAULTS = {
+    # "local" or "slurm"
+    "backend": "local",
+
+    # Adaptive scaling bounds, in workers. Without adapt, scale to maximum
+    "adapt": True,
+    "minimum": 1,
+    "maximum": os.cpu_count() or 1,
+
+    # Per worker
+    "threads": 1,
+    "memory": None,
+
+    # Extra keyword arguments for distributed.LocalCluster
+    "local": {"processes": True, "dashboard_address": ":8787"},
+
+    # Record per-block I/O in every worker, see weto.metrics
+    "metrics": False,
+
+    # Extra keyword arguments for dask_jobqueue.SLURMCluster
+    "slurm": {"cores": 36, "processes": 36, "memory": "90GB",
+              "walltime": "01:00:00", "queue": None, "account": None,
+              "local_directory": "/tmp/scratch"}
+}
+
+ENV_PREFIX = "WETO_CLUSTER_"
+
+_LOCK = threading.RLock()
+_CLIENT = None
+
+
+def _update(base, new):
+    """Recursively update a nested dict"""
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _update(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def cluster_config(path=None, **kwargs):
+    """Resolve cluster settings from defaults, a file and the environment
+    Keyword Arguments:
+        path {string} -- YAML or JSON settings file, defaults to the
+            WETO_CLUSTER_CONFIG environment variable (default: {None})
+        **kwargs -- settings that override everything else
+    Returns:
+        dict -- cluster settings
+    """
+    config = copy.deepcopy(DEFAULTS)
+
+    path = path or os.environ.get(ENV_PREFIX + "CONFIG")
+    if path:
+        with open(os.path.expanduser(path)) as file:
+            if path.endswith(".json"):
+                _update(config, json.load(file))
+            else:
+                _update(config, yaml.safe_load(file) or {})
+
+    # WETO_CLUSTER_MAXIMUM=8, WETO_CLUSTER_SLURM__ACCOUNT=weto
+    for key, value in os.environ.items():
+        if not key.startswith(ENV_PREFIX) or key == ENV_PREFIX + "CONFIG":
+            continue
+        keys = key[len(ENV_PREFIX):].lower().split("__")
+        entry = config
+        for k in keys[:-1]:
+            entry = entry.setdefault(k, {})
+        entry[keys[-1]] = yaml.safe_load(value)
+
+    _update(config, kwargs)
+    if config["backend"] not in BACKENDS:
+        raise ValueError("backend must be one of {}, not {}".format(
+            BACKENDS, config["backend"]))
+
+    return config
+
+
+def make_cluster(config):
+    """Start a cluster from resolved settings
+    Arguments:
+        config {dict} -- settings from cluster_config
+    Returns:
+        distributed.deploy.Cluster -- a LocalCluster or SLURMCluster
+    """
+    if config["backend"] == "slurm":
+        from dask_jobqueue import SLURMCluster
+        kwargs = {k: v for k, v in config["slurm"].items() if v is not None}
+        if config["memory"] is not None:
+            kwargs["memory"] = config["memory"]
+        cluster = SLURMCluster(**kwargs)
+    else:
+        from dask.distributed import LocalCluster
+        kwargs = dict(config["local"], threads_per_worker=config["threads"],
+                      n_workers=config["minimum"])
+        if config["memory"] is not None:
+            kwargs["memory_limit"] = config["memory"]
+        cluster = LocalCluster(**kwargs)
+
+    if config["adapt"]:
+        cluster.adapt(minimum=config["minimum"], maximum=config["maximum"])
+    else:
+        cluster.scale(config["maximum"])
+
+    return cluster
+
+
+def get_client(path=None, **kwargs):
+    """Return the shared client, starting its cluster on first use
+    Settings only apply when the cluster is started, later calls return
+    the running client as is.
+    Keyword Arguments:
+        path {string} -- settings file, see cluster_config (default: {None})
+        **kwargs -- settings overrides, see cluster_config
+    Returns:
+        distributed.Client -- client connected to the shared cluster
+    """
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None or _CLIENT.status not in ("running", "connecting"):
+            from dask.distributed import Client
+            config = cluster_config(path, **kwargs)
+            if config["metrics"]:
+                # Before the workers start, so they inherit the switch
+                from weto.metrics import enable_metrics
+                enable_metrics()
+            cluster = make_cluster(config)
+            _CLIENT = Client(cluster, set_as_default=True)
+        return _CLIENT
+
+
+@contextmanager
+def cluster(path=None, **kwargs):
+    """Use the shared cluster in a with block
+    Unlike `with Client():`, leaving the block keeps the workers and their
+    memory for the next stage.
+    Example:
+        >> with cluster() as client:
+        ..    array.compute()
+    Keyword Arguments:
+        path {string} -- settings file, see cluster_config (default: {None})
+        **kwargs -- settings overrides, see cluster_config
+    """
+    client = get_client(path, **kwargs)
+    with client.as_current():
+        yield client
+
+
+def shutdown():
+    """Close the shared client and its cluster"""
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is not None:
+            cluster = _CLIENT.cluster
+            _CLIENT.close()
+            if cluster is not None:
+                cluster.close()
+            _CLIENT = None
+
+
+atexit.register(shutdown)
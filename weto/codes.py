@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Blockwise kernels for code rasters.
+
+Created on Sat Oct 17 16:02:35 2026
+
+@author: twillia2
+"""
+
+import dask.array as da
+import numpy as np
+
+
+# Integer code mode: 0 is "no code here", 9999 marks full exclusions and
+# cells outside the study area hold a nodata sentinel instead of NaN
+NO_CODE = 0
+EXCLUSION_CODE = 9999
+CODE_NODATA = {"uint16": 65535, "int16": -32768}
+
+
+def code_nodata(dtype):
+    """Return the nodata sentinel of an integer code dtype"""
+    dtype = np.dtype(dtype).name
+    if dtype not in CODE_NODATA:
+        raise ValueError("code dtype must be one of {}, not {}".format(
+            sorted(CODE_NODATA), dtype))
+    return CODE_NODATA[dtype]
+
+
+def _valid(block, navalues):
+    """Boolean array of cells holding a value other than NaN or navalues"""
+    valid = ~np.isin(block, navalues)
+    if block.dtype.kind == "f":
+        valid &= ~np.isnan(block)
+    return valid
+
+
+def _mask_kernel(block, navalues, out_dtype, packed):
+    """Valid cell mask of one block, optionally packed 8 cells to a byte"""
+    valid = _valid(block, navalues)
+    if packed:
+        return np.packbits(valid, axis=-1)
+    return valid.astype(out_dtype, copy=False)
+
+
+def _unpack_kernel(block, block_info=None):
+    """Unpack one block of a packed mask to its unpacked width"""
+    width = block_info[None]["chunk-shape"][-1]
+    return np.unpackbits(block, axis=-1, count=width).astype(bool)
+
+
+def valid_mask(array, navalues=(-9999., 0.), dtype=bool, packed=False):
+    """Mask cells holding a value other than NaN or one of the navalues
+    All sentinels are checked in one vectorized comparison per block and
+    the mask comes out in a compact type, one byte per cell or one bit per
+    cell when packed.
+    Arguments:
+        array {dask.array.Array} -- array to mask
+    Keyword Arguments:
+        navalues {int, float, iterable} -- value or values that mean "no
+            value here" (default: {(-9999., 0.)})
+        dtype {string} -- bool or uint8 output, ignored when packed
+            (default: {bool})
+        packed {bool} -- pack 8 cells of each row into a uint8 along the
+            last axis, use unpack_mask to expand it again (default: {False})
+    Returns:
+        dask.array.Array -- 1/True where the cell is valid, 0/False elsewhere
+    """
+    if not isinstance(navalues, (list, tuple, np.ndarray)):
+        navalues = [navalues]
+    array = da.asarray(array)
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype(bool), np.dtype("uint8")):
+        raise ValueError("mask dtype must be bool or uint8, not "
+                         "{}".format(dtype))
+    kwargs = dict(navalues=list(navalues), out_dtype=dtype, packed=packed)
+    if not packed:
+        return da.map_blocks(_mask_kernel, array, dtype=dtype,
+                             token="valid-mask", **kwargs)
+
+    # Every chunk but the last must pack into whole bytes
+    xchunks = array.chunks[-1]
+    if any(c % 8 for c in xchunks[:-1]):
+        size = max(8, max(xchunks) // 8 * 8)
+        array = array.rechunk(array.chunks[:-1] + (size,))
+    chunks = array.chunks[:-1] + (tuple(-(-c // 8) for c in
+                                        array.chunks[-1]),)
+    return da.map_blocks(_mask_kernel, array, chunks=chunks, dtype="uint8",
+                         token="valid-mask", **kwargs)
+
+
+def unpack_mask(packed, width):
+    """Expand a mask from valid_mask(..., packed=True) back to bools
+    Arguments:
+        packed {dask.array.Array} -- packed mask
+        width {int} -- width of the array the mask was made from
+    Returns:
+        dask.array.Array -- bool mask, one cell per original cell
+    """
+    xchunks = [c * 8 for c in packed.chunks[-1]]
+    xchunks[-1] -= sum(xchunks) - width
+    return da.map_blocks(_unpack_kernel, packed,
+                         chunks=packed.chunks[:-1] + (tuple(xchunks),),
+                         dtype=bool, token="unpack-mask")
+
+
+def _priority_kernel(*blocks, navalues, fill, nodata, masked, source_band,
+                     out_dtype):
+    """Take the first valid value of each cell across blocks in priority
+    order, optionally recording which block it came from"""
+    if masked:
+        mask, blocks = blocks[-1], blocks[:-1]
+    out = np.full(blocks[0].shape, fill, dtype=out_dtype)
+    source = np.zeros(blocks[0].shape, dtype=out_dtype)
+    empty = np.ones(blocks[0].shape, dtype=bool)
+
+    for i, block in enumerate(blocks):
+        take = empty & _valid(block, navalues)
+        out[take] = block[take]
+        source[take] = i + 1
+        empty &= ~take
+        if not empty.any():
+            break
+
+    if masked:
+        outside = ~_valid(mask, [0])
+        out[outside] = nodata
+        source[outside] = 0
+
+    if source_band:
+        return np.stack([out, source])
+    return out
+
+
+def priority_composite(layers, navalues=(-9999., 0.), fill=0, mask=None,
+                       nodata=None, source_band=False, dtype=None):
+    """Composite layers by priority in a single blockwise pass
+    Each cell gets the value of the first layer, in priority order, that
+    isn't NaN or one of the navalues. Every input window is read once and
+    no interim masks or layers are built.
+    Arguments:
+        layers {list(dask.array.Array), dict} -- 2d arrays in priority
+            order, highest first. A dict keeps its insertion order
+    Keyword Arguments:
+        navalues {iterable} -- values that mean "no value here"
+            (default: {(-9999., 0.)})
+        fill {int, float} -- value for cells no layer covers (default: {0})
+        mask {dask.array.Array} -- optional area mask, cells where it is 0 or
+            NaN are set to nodata (default: {None})
+        nodata {int, float} -- value for cells outside the mask, defaults
+            to NaN for float output and to the dtype's sentinel in
+            CODE_NODATA for integer codes (default: {None})
+        source_band {bool} -- add a second band holding the 1-based index
+            of the layer that won each cell, 0 where none did
+            (default: {False})
+        dtype {string} -- output data type, defaults to the common type of
+            the layers (default: {None})
+    Returns:
+        dask.array.Array -- (y, x) composite, or (2, y, x) composite and
+            source bands
+    """
+    if isinstance(layers, dict):
+        layers = list(layers.values())
+    layers = [da.asarray(layer) for layer in layers]
+    if dtype is None:
+        dtype = np.result_type(*layers)
+    dtype = np.dtype(dtype)
+
+    # Integer output can't hold NaN, so it needs an integer sentinel
+    if mask is not None and dtype.kind != "f":
+        if nodata is None and dtype.name not in CODE_NODATA:
+            raise ValueError("pass a nodata value for a masked {} "
+                             "composite".format(dtype))
+        if nodata is None:
+            nodata = code_nodata(dtype)
+        elif np.isnan(nodata) or not np.can_cast(np.min_scalar_type(nodata),
+                                                 dtype):
+            raise ValueError("nodata {} doesn't fit the {} composite".format(
+                nodata, dtype))
+    elif nodata is None:
+        nodata = np.nan
+
+    # Every layer and the mask share the first layer's chunks
+    chunks = layers[0].chunks
+    arrays = [layer.rechunk(chunks) for layer in layers]
+    if mask is not None:
+        arrays.append(da.asarray(mask).rechunk(chunks))
+
+    kwargs = dict(navalues=list(navalues), fill=fill, nodata=nodata,
+                  masked=mask is not None, source_band=source_band,
+                  out_dtype=dtype)
+    if source_band:
+        return da.map_blocks(_priority_kernel, *arrays, new_axis=0,
+                             chunks=((2,),) + chunks, dtype=dtype,
+                             token="priority-composite", **kwargs)
+    return da.map_blocks(_priority_kernel, *arrays, dtype=dtype,
+                         token="priority-composite", **kwargs)
+
+
+def _codes_kernel(block, navalues, nodata, out_dtype):
+    """Cast one block of float codes to integers"""
+    nocode = np.isin(block, navalues)
+    missing = np.isnan(block) if block.dtype.kind == "f" else nocode & False
+    out = np.where(nocode | missing, NO_CODE, block).astype(out_dtype)
+    out[missing] = nodata
+    return out
+
+
+def to_codes(array, dtype="uint16", navalues=(-9999., 0.), nodata=None):
+    """Convert a float code array to integer codes
+    Arguments:
+        array {dask.array.Array} -- code array, usually float32
+    Keyword Arguments:
+        dtype {string} -- "uint16" or "int16" (default: {"uint16"})
+        navalues {iterable} -- values that mean "no code here", these become
+            NO_CODE (default: {(-9999., 0.)})
+        nodata {int} -- value for NaN cells, defaults to the dtype's
+            sentinel in CODE_NODATA (default: {None})
+    Returns:
+        dask.array.Array -- integer codes
+    """
+    array = da.asarray(array)
+    dtype = np.dtype(dtype)
+    if nodata is None:
+        nodata = code_nodata(dtype)
+    if array.dtype == dtype:
+        return array
+    return da.map_blocks(_codes_kernel, array, navalues=list(navalues),
+                         nodata=nodata, out_dtype=dtype, dtype=dtype,
+                         token="to-codes")
+
+
+def _clear_kernel(block, nodata, fill):
+    """Set the nodata (and NaN) cells of one block to a fill value"""
+    invalid = ~_valid(block, [] if nodata is None else [nodata])
+    if invalid.any():
+        block = block.copy()
+        block[invalid] = fill
+    return block
+
+
+def clear_nodata(array, nodata=None, fill=NO_CODE):
+    """Replace nodata cells, NaN in float arrays, with a fill value
+    Counting with `da.count_nonzero` then works the same on float and
+    integer code rasters.
+    Arguments:
+        array {dask.array.Array} -- code array
+    Keyword Arguments:
+        nodata {int, float} -- nodata sentinel, NaN is always cleared in
+            float arrays (default: {None})
+        fill {int, float} -- replacement value (default: {NO_CODE})
+    Returns:
+        dask.array.Array -- array without nodata cells
+    """
+    array = da.asarray(array)
+    if nodata is not None and np.isnan(nodata):
+        nodata = None
+    return da.map_blocks(_clear_kernel, array, nodata=nodata, fill=fill,
+                         dtype=array.dtype, token="clear-nodata")
+
+
+def code_lut(codes, values, dtype="float32", unmapped=0, size=None):
+    """Build a dense lookup array indexed by code
+    The last slot holds the unmapped value, so codes outside the table's
+    range can be pointed at it.
+    Arguments:
+        codes {iterable(int)} -- non-negative integer codes
+        values {iterable} -- value of each code
+    Keyword Arguments:
+        dtype {string} -- lookup value type (default: {"float32"})
+        unmapped {int, float} -- value for codes not in the table
+            (default: {0})
+        size {int} -- length of the array, so lookups of different tables
+            can be stacked, at least max(codes) + 2 (default: {None})
+    Returns:
+        numpy.ndarray -- array of max(codes) + 2, or size, values
+    """
+    codes = np.asarray(codes).astype(np.int64)
+    if codes.size and codes.min() < 0:
+        raise ValueError("codes must be non-negative")
+    needed = int(codes.max()) + 2 if codes.size else 1
+    if size is not None and size < needed:
+        raise ValueError("size must be at least {}".format(needed))
+    size = size or needed
+    lut = np.full(size, unmapped, dtype=dtype)
+    lut[codes] = np.asarray(values, dtype=dtype)
+    lut[-1] = unmapped
+
+    return lut
+
+
+def _lut_kernel(block, lut, known, navalues, nodata, strict):
+    """Map one block of codes through a dense lookup array, or a stack of
+    them to one band each"""
+    missing = np.isin(block, navalues)
+    if block.dtype.kind == "f":
+        missing |= np.isnan(block)
+    size = lut.shape[-1]
+    outside = (block < 0) | (block >= size - 1)
+    index = np.where(missing | outside, size - 1, block)
+    index = index.astype(np.intp, copy=False)
+    if strict:
+        unknown = ~missing & (outside | ~known[index])
+        if unknown.any():
+            raise KeyError("codes missing from the lookup table: {}".format(
+                np.unique(block[unknown])[:20].tolist()))
+    out = np.take(lut, index, axis=-1)
+    out[..., missing] = nodata
+
+    return out
+
+
+def map_codes(codes, lut, navalues=(), nodata=np.nan, known=None,
+              strict=False):
+    """Map a code array through a dense lookup array, one np.take per block
+    Arguments:
+        codes {dask.array.Array} -- integer (or integral float) codes
+        lut {numpy.ndarray} -- lookup array from code_lut, or a (bands,
+            codes) stack of them to map every block to several bands at
+            once
+    Keyword Arguments:
+        navalues {iterable} -- code nodata values, mapped to nodata along
+            with NaN (default: {()})
+        nodata {int, float} -- output value for nodata codes
+            (default: {numpy.nan})
+        known {iterable} -- codes in the table, only needed when strict
+            (default: {None})
+        strict {bool} -- raise a KeyError for codes that aren't known
+            instead of giving them the lut's unmapped value
+            (default: {False})
+    Returns:
+        dask.array.Array -- mapped values, of the lut's type, with a leading
+            band axis for a stack of lookups
+    """
+    codes = da.asarray(codes)
+    lut = np.asarray(lut)
+    mask = np.zeros(lut.shape[-1], dtype=bool)
+    if known is not None:
+        mask[np.asarray(known).astype(np.intp)] = True
+    elif strict:
+        raise ValueError("strict mapping needs the known codes")
+    navalues = [v for v in navalues if v is not None and not np.isnan(v)]
+
+    kwargs = dict(lut=lut, known=mask, navalues=navalues, nodata=nodata,
+                  strict=strict)
+    if lut.ndim == 2:
+        return da.map_blocks(_lut_kernel, codes, new_axis=0,
+                             chunks=((lut.shape[0],),) + codes.chunks,
+                             dtype=lut.dtype, token="map-codes", **kwargs)
+    return da.map_blocks(_lut_kernel, codes, dtype=lut.dtype,
+                         token="map-codes", **kwargs)
@@ -6,15 +6,379 @@ Created on Wed Feb 12 14:37:42 2020
 @author: travis
 """
 
+import functools
+import os
+import shutil
+import struct
+import sys
+import threading
+import warnings
+import xml.etree.ElementTree as ET
+
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from itertools import product
+
+import dask
 import dask.array as da
+import numpy as np
 import rasterio
+import rasterio.shutil
 from dask import is_dask_collection
 from dask.base import tokenize
+from rasterio.crs import CRS
 from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
+from rasterio.windows import transform as window_transform
+
+from weto.metrics import METRICS
+from weto.tiff import read_tiff_layout
+
+
+# POOL
+class DatasetPool:
+    """Process-local, thread-safe pool of open rasterio dataset handles.
+
+    Handles are keyed by (path, mtime), so a file rewritten on disk is
+    reopened instead of served from a stale handle. A rasterio dataset can't
+    be read from two threads at once, so each handle is checked out to one
+    caller at a time and returned to the idle list afterwards. Idle handles
+    are closed least recently used first once more than `max_open` files are
+    open.
+
+    Example:
+        >> pool = DatasetPool(max_open=64)
+        >> with pool.dataset("test.tif") as src:
+        ..    array = src.read(1, window=Window(0, 0, 256, 256))
+        >> pool.stats()
+        {'hits': 0, 'misses': 1, 'evictions': 0, 'open': 1, 'idle': 1}
+    """
+
+    def __init__(self, max_open=128):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Forget every handle, used at init and after a fork"""
+        self._pid = os.getpid()
+        self._idle = OrderedDict()
+        self._nopen = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(path):
+        """Pool key for a path, mtime is None for non-local paths"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError):
+            mtime = None
+        return (str(path), mtime)
+
+    def _check_pid(self):
+        """Drop inherited handles in a forked child"""
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _evict(self):
+        """Close idle handles, oldest first, until under max_open"""
+        while self._nopen > self.max_open and self._idle:
+            key, handles = next(iter(self._idle.items()))
+            handles.pop().close()
+            if not handles:
+                del self._idle[key]
+            self._nopen -= 1
+            self.evictions += 1
+
+    def _discard_stale(self, key):
+        """Close idle handles for this path opened at another mtime"""
+        stale = [k for k in self._idle if k[0] == key[0] and k != key]
+        for k in stale:
+            for handle in self._idle.pop(k):
+                handle.close()
+                self._nopen -= 1
+
+    def acquire(self, path):
+        """Check out an open dataset for path, opening one if none is idle"""
+        key = self._key(path)
+        with self._lock:
+            self._check_pid()
+            handles = self._idle.get(key)
+            if handles:
+                handle = handles.pop()
+                if not handles:
+                    del self._idle[key]
+                self.hits += 1
+                return key, handle
+            self._discard_stale(key)
+            self.misses += 1
+            self._nopen += 1
+
+        try:
+            handle = rasterio.open(path)
+        except Exception:
+            with self._lock:
+                self._nopen -= 1
+            raise
+
+        return key, handle
+
+    def release(self, key, handle):
+        """Return a checked out dataset to the idle list"""
+        with self._lock:
+            if self._pid != os.getpid() or handle.closed:
+                return
+            self._idle.setdefault(key, []).append(handle)
+            self._idle.move_to_end(key)
+            self._evict()
+
+    @contextmanager
+    def dataset(self, path):
+        """Context manager yielding a pooled dataset for path"""
+        key, handle = self.acquire(path)
+        try:
+            yield handle
+        finally:
+            self.release(key, handle)
+
+    def discard(self, path):
+        """Close the idle handles of a path, whatever its mtime"""
+        with self._lock:
+            self._check_pid()
+            for key in [k for k in self._idle if k[0] == str(path)]:
+                for handle in self._idle.pop(key):
+                    handle.close()
+                    self._nopen -= 1
+
+    def clear(self):
+        """Close every idle handle and reset the counters"""
+        with self._lock:
+            if self._pid == os.getpid():
+                for handles in self._idle.values():
+                    for handle in handles:
+                        handle.close()
+            self._reset()
+
+    def stats(self):
+        """Return hit, miss and eviction counts and open handle counts"""
+        with self._lock:
+            self._check_pid()
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "open": self._nopen,
+                    "idle": sum(len(h) for h in self._idle.values())}
+
+
+POOL = DatasetPool()
+
+
+def pool_stats():
+    """Return the dataset pool counters for this process.
+    On a distributed cluster, run it on every worker to confirm reuse:
+        >> client.run(pool_stats)
+    Returns:
+        dict -- hits, misses, evictions, open and idle handle counts
+    """
+    return POOL.stats()
+
+
+def clear_pool():
+    """Close all pooled dataset handles in this process"""
+    POOL.clear()
+
+
+def release_file(path):
+    """Forget this process's pooled handles and memory maps of a file
+    Writers call it once a file is written or rewritten in place, so no
+    later read is served stale pages from, or faults on, an old mapping.
+    Arguments:
+        path {string} -- path of the written raster
+    """
+    POOL.discard(path)
+    _file_map.cache_clear()
+
+
+# MEMMAP
+BACKENDS = ("auto", "memmap", "rasterio")
+
+
+@functools.lru_cache(maxsize=64)
+def _tiff_layout(path, mtime):
+    """Parse and cache a TIFF's block layout, once per file version"""
+    return read_tiff_layout(path)
+
+
+@functools.lru_cache(maxsize=64)
+def _file_map(path, mtime):
+    """Map a whole file read-only, once per file version. Views of it are
+    read-only too, so no kernel can change what later reads see"""
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+def memmap_layout(src, indexes):
+    """Return a raster's TiffLayout when its bands can be memory mapped
+    That means a local, uncompressed, native byte order GeoTIFF whose every
+    block is allocated at its full size. Anything else has to be decoded by
+    GDAL.
+    Arguments:
+        src {rasterio.io.DatasetReader} -- open raster dataset
+        indexes {int, list(int)} -- band number(s) to be read
+    Returns:
+        weto.tiff.TiffLayout -- block layout, or None when the raster can't
+            be mapped
+    """
+    if src.driver != "GTiff" or not os.path.isfile(src.name):
+        return None
+    try:
+        layout = _tiff_layout(src.name, os.stat(src.name).st_mtime_ns)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+    if isinstance(indexes, int):
+        indexes = [indexes]
+    dtypes = {np.dtype(src.dtypes[b - 1]) for b in indexes}
+    native = "<" if sys.byteorder == "little" else ">"
+    if (not layout.uncompressed or layout.byteorder != native or
+            len(dtypes) != 1 or dtypes.pop().itemsize * 8 != layout.bits or
+            (layout.height, layout.width) != src.shape or
+            layout.samples != src.count):
+        return None
+
+    # Sparse or short blocks are filled in by GDAL, leave them to it
+    rows = np.arange(len(layout.offsets)) // layout.blocks_across
+    rows = rows % layout.blocks_down
+    expected = np.array([layout.block_nbytes(r) for r in
+                         range(layout.blocks_down)])[rows]
+    if (layout.offsets <= 0).any() or (layout.bytecounts < expected).any():
+        return None
+
+    return layout
+
+
+def _mmap_block(raw, layout, dtype, row, col, band=1):
+    """View one block as a (rows, cols, samples) array, without copying"""
+    index = layout.block_index(band, row, col)
+    offset = int(layout.offsets[index])
+    samples = layout.samples if layout.planar == 1 else 1
+    shape = (layout.block_rows(row), layout.block_width, samples)
+    return np.ndarray(shape, dtype=dtype, buffer=raw, offset=offset)
+
+
+def _mmap_band(raw, layout, dtype, band=1):
+    """View a whole band of contiguous blocks as a (rows, cols, samples)
+    array, without copying"""
+    index = layout.block_index(band, 0, 0)
+    offset = int(layout.offsets[index])
+    samples = layout.samples if layout.planar == 1 else 1
+    shape = (layout.height, layout.width, samples)
+    return np.ndarray(shape, dtype=dtype, buffer=raw, offset=offset)
+
+
+def _mmap_region(raw, layout, dtype, rows, cols, band, samples):
+    """Return a (rows, cols, samples) array for a window of a band's blocks
+    Views the file directly unless the window spans several tiles."""
+    bh, bw = layout.block_height, layout.block_width
+    first_row, last_row = rows.start // bh, (rows.stop - 1) // bh
+    first_col, last_col = cols.start // bw, (cols.stop - 1) // bw
+
+    if not layout.tiled and layout.contiguous:
+        view = _mmap_band(raw, layout, dtype, band)
+        return view[rows, cols, samples]
+
+    if first_row == last_row and first_col == last_col:
+        view = _mmap_block(raw, layout, dtype, first_row, first_col, band)
+        return view[rows.start - first_row * bh:rows.stop - first_row * bh,
+                    cols.start - first_col * bw:cols.stop - first_col * bw,
+                    samples]
+
+    if isinstance(samples, slice):
+        nsamples = len(range(layout.samples)[samples])
+    else:
+        nsamples = len(samples)
+    array = np.empty((rows.stop - rows.start, cols.stop - cols.start,
+                      nsamples), dtype=dtype)
+    for row in range(first_row, last_row + 1):
+        for col in range(first_col, last_col + 1):
+            block = _mmap_block(raw, layout, dtype, row, col, band)
+            y0 = max(rows.start, row * bh)
+            y1 = min(rows.stop, row * bh + block.shape[0])
+            x0 = max(cols.start, col * bw)
+            x1 = min(cols.stop, (col + 1) * bw)
+            array[y0 - rows.start:y1 - rows.start,
+                  x0 - cols.start:x1 - cols.start] = block[
+                      y0 - row * bh:y1 - row * bh,
+                      x0 - col * bw:x1 - col * bw, samples]
+
+    return array
+
+
+def read_mmap_window(path, window, indexes, dtype):
+    """Read a window of an uncompressed GeoTIFF through memmap views
+    A window inside a single block, or any window of a striped file whose
+    strips are contiguous, comes back as a view of the file with no copy.
+    Windows spanning several tiles are gathered into a new array, still
+    without GDAL.
+    Arguments:
+        path {string} -- path to the raster file
+        window {rasterio.windows.Window} -- integer pixel window
+        indexes {int, list(int)} -- band number, or list of band numbers
+            for a (band, y, x) result
+        dtype {string} -- numpy data type of the bands
+    Returns:
+        numpy.ndarray -- 2d or 3d window array
+    """
+    mtime = os.stat(path).st_mtime_ns
+    layout = _tiff_layout(path, mtime)
+    raw = _file_map(path, mtime)
+    dtype = np.dtype(dtype)
+    bands = [indexes] if isinstance(indexes, int) else list(indexes)
+    rows = slice(window.row_off, window.row_off + window.height)
+    cols = slice(window.col_off, window.col_off + window.width)
+
+    if layout.planar == 1:
+        # Pixel-interleaved, a run of bands is still a view
+        samples = [b - 1 for b in bands]
+        if samples == list(range(samples[0], samples[-1] + 1)):
+            samples = slice(samples[0], samples[-1] + 1)
+        region = _mmap_region(raw, layout, dtype, rows, cols, 1, samples)
+        array = np.moveaxis(region, -1, 0)
+    else:
+        regions = [_mmap_region(raw, layout, dtype, rows, cols, b,
+                                slice(0, 1))[..., 0] for b in bands]
+        if len(regions) == 1:
+            array = regions[0][None]
+        else:
+            array = np.stack(regions)
+
+    if isinstance(indexes, int):
+        return array[0]
+    return array
+
+
+def _use_memmap(src, indexes, backend):
+    """Decide whether a read can go through the memmap backend"""
+    if backend not in BACKENDS:
+        raise ValueError('backend must be one of {}'.format(BACKENDS))
+    if backend == "rasterio":
+        return False
+    mappable = memmap_layout(src, indexes) is not None
+    if backend == "memmap" and not mappable:
+        raise ValueError('{} is compressed or otherwise not a plain '
+                         'GeoTIFF, it can\'t be memory mapped'.format(
+                             src.name))
+    return mappable
 
 
 # READ
-def read_raster(path, band=None, block_size=1):
+class ReadAmplificationWarning(UserWarning):
+    """Chunks cut through compressed blocks, so some are decoded twice"""
+
+
+def read_raster(path, band=None, block_size=1, multiband=False, chunks=None,
+                chunk_bytes=None, window=None, bounds=None, backend="auto"):
     """Read all or some bands from raster
     Arguments:
         path {string} -- path to raster file
@@ -22,59 +386,568 @@ def read_raster(path, band=None, block_size=1):
         band {int, iterable(int)} -- band number or iterable of bands.
             When passing None, it reads all bands (default: {None})
         block_size {int} -- block size multiplier (default: {1})
+        multiband {bool} -- read every requested band of a window in one
+            call instead of stacking one graph per band. Pixel-interleaved
+            tiles are then decoded once, not once per band
+            (default: {False})
+        chunks {string, tuple(int)} -- "auto" or a (rows, cols) chunk
+            shape. Overrides block_size, see `read_raster_band`
+            (default: {None})
+        chunk_bytes {int} -- target chunk size in bytes for "auto" chunks
+            (default: {None})
+        window {rasterio.windows.Window, tuple} -- pixel window to read,
+            as a Window or ((row_start, row_stop), (col_start, col_stop))
+            (default: {None})
+        bounds {tuple(float)} -- (left, bottom, right, top) projected
+            bounds to read, in place of a window (default: {None})
+        backend {string} -- "auto", "memmap" or "rasterio", see
+            `read_raster_band` (default: {"auto"})
     Returns:
-        dask.array.Array -- a Dask array
+        dask.array.Array -- a Dask array, carrying the affine transform of
+            its upper left pixel as `array.transform`
     """
+    options = dict(block_size=block_size, chunks=chunks,
+                   chunk_bytes=chunk_bytes, window=window, bounds=bounds,
+                   backend=backend)
 
     if isinstance(band, int):
-        return read_raster_band(path, band=band, block_size=block_size)
+        return read_raster_band(path, band=band, **options)
     else:
         if band is None:
             bands = range(1, get_band_count(path) + 1)
         else:
             bands = list(band)
-        return da.stack([
-            read_raster_band(path, band=band, block_size=block_size)
-            for band in bands
-        ])
+        if multiband:
+            return read_raster_bands(path, bands=bands, **options)
+        arrays = [read_raster_band(path, band=band, **options)
+                  for band in bands]
+        array = da.stack(arrays)
+        array.transform = arrays[0].transform
+        return array
+
+
+def auto_chunks(block_shape, shape, itemsize, chunk_bytes=None, nbands=1):
+    """Pick a chunk shape of whole blocks close to a target size in bytes
+    Striped files (one block spans the full width) get full-width chunks of
+    as many strips as fit, tiled files get square-ish runs of tiles. Either
+    way every chunk edge falls on a block edge, so no compressed block is
+    decoded by more than one task.
+    Arguments:
+        block_shape {tuple(int)} -- (rows, cols) of the native blocks
+        shape {tuple(int)} -- (rows, cols) of the raster
+        itemsize {int} -- bytes per pixel
+    Keyword Arguments:
+        chunk_bytes {int} -- target chunk size in bytes. Defaults to dask's
+            "array.chunk-size" setting (default: {None})
+        nbands {int} -- number of bands held in each chunk (default: {1})
+    Returns:
+        tuple(int) -- (rows, cols) chunk shape
+    """
+    if chunk_bytes is None:
+        chunk_bytes = dask.utils.parse_bytes(
+            dask.config.get("array.chunk-size"))
+    elif isinstance(chunk_bytes, str):
+        chunk_bytes = dask.utils.parse_bytes(chunk_bytes)
+
+    bh, bw = block_shape
+    rows, cols = shape
+    ny = -(-rows // bh)
+    nx = -(-cols // bw)
+    nblocks = max(1, chunk_bytes // (bh * bw * itemsize * nbands))
+
+    if bw >= cols:
+        my, mx = nblocks, 1
+    else:
+        side = int(nblocks ** 0.5) or 1
+        mx = min(side, nx)
+        my = max(1, nblocks // mx)
+
+    return (min(my, ny) * bh, min(mx, nx) * bw)
+
+
+def read_amplification(block_shape, shape, chunks, offset=(0, 0)):
+    """Estimate how many times each pixel's block is decoded
+    Arguments:
+        block_shape {tuple(int)} -- (rows, cols) of the native blocks
+        shape {tuple(int)} -- (rows, cols) of the raster
+        chunks {tuple} -- (rows, cols) chunk shape or normalized dask chunks
+    Keyword Arguments:
+        offset {tuple(int)} -- (row, col) of the raster at which the chunks
+            start, for chunks laid out on another grid. They must then be
+            normalized dask chunks (default: {(0, 0)})
+    Returns:
+        float -- pixels decoded / pixels in the raster, 1.0 when every chunk
+            edge falls on a block edge
+    """
+    if tuple(offset) == (0, 0):
+        chunks = da.core.normalize_chunks(chunks, shape)
+    factor = 1.0
+    for block, length, sizes, start in zip(block_shape, shape, chunks,
+                                           offset):
+        decoded = 0
+        inside = 0
+        for size in sizes:
+            low, high = max(start, 0), min(start + size, length)
+            if high > low:
+                first = low // block
+                last = -(-high // block)
+                decoded += min(last * block, length) - first * block
+                inside += high - low
+            start += size
+        factor *= decoded / float(inside) if inside else 1.0
+
+    return factor
+
+
+def _shifted_chunks(size, offset, length, extent):
+    """Chunk sizes along one axis of a grid starting `offset` cells into a
+    raster `extent` cells long, with edges on multiples of size in the
+    raster. Cells before the raster join the first chunk."""
+    if size >= extent:
+        return (length,)
+    first = (max(offset, 0) // size + 1) * size - offset
+    sizes = [min(first, length)]
+    while sum(sizes) < length:
+        sizes.append(min(size, length - sum(sizes)))
+    return tuple(sizes)
+
+
+def _raster_chunks(src, band, block_size, chunks, chunk_bytes, nbands=1,
+                   shape=None, offset=(0, 0)):
+    """Resolve the (rows, cols) chunk shape for reading a band, explicit
+    chunks on a grid of `shape` starting at `offset` in the raster are
+    checked for alignment there"""
+    block_shape = src.block_shapes[band - 1]
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize
+
+    if chunks is None and chunk_bytes is None:
+        h, w = block_shape
+        return (h * block_size, w * block_size)
+
+    if chunks is None or chunks == "auto":
+        return auto_chunks(block_shape, src.shape, itemsize,
+                           chunk_bytes=chunk_bytes, nbands=nbands)
+
+    if tuple(offset) == (0, 0):
+        factor = read_amplification(block_shape, src.shape, chunks)
+    else:
+        grid = da.core.normalize_chunks(chunks, tuple(shape))
+        factor = read_amplification(block_shape, src.shape, grid, offset)
+    if factor > 1.0:
+        msg = ("chunks {} are not aligned with the {} blocks of {}, each "
+               "block is decoded {:.2f} times on average. Use chunks='auto' "
+               "or whole multiples of the block shape.")
+        warnings.warn(msg.format(tuple(chunks), tuple(block_shape),
+                                 src.name, factor),
+                      ReadAmplificationWarning, stacklevel=3)
+
+    return tuple(chunks)
+
+
+def resolve_window(src, window=None, bounds=None):
+    """Resolve a pixel window or projected bounds to a window in the raster
+    Fractional windows are rounded outward to whole pixels and the result
+    is trimmed to the raster's extent.
+    Arguments:
+        src {rasterio.io.DatasetReader} -- open raster dataset
+    Keyword Arguments:
+        window {rasterio.windows.Window, tuple} -- pixel window, as a Window
+            or ((row_start, row_stop), (col_start, col_stop))
+            (default: {None})
+        bounds {tuple(float)} -- (left, bottom, right, top) projected bounds
+            (default: {None})
+    Returns:
+        rasterio.windows.Window -- integer window, the full raster when
+            neither window nor bounds are given
+    """
+    if window is not None and bounds is not None:
+        raise ValueError('pass either a window or bounds, not both')
+    if bounds is not None:
+        window = window_from_bounds(*bounds, transform=src.transform)
+    if window is None:
+        return Window(0, 0, src.width, src.height)
+    if not isinstance(window, Window):
+        window = Window.from_slices(*window)
+
+    # Round outward, ignoring float noise from the bounds conversion
+    col_start = max(int(np.floor(round(window.col_off, 6))), 0)
+    row_start = max(int(np.floor(round(window.row_off, 6))), 0)
+    col_stop = min(int(np.ceil(round(window.col_off + window.width, 6))),
+                   src.width)
+    row_stop = min(int(np.ceil(round(window.row_off + window.height, 6))),
+                   src.height)
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError('window {} does not intersect {}'.format(
+            window, src.name))
+
+    return Window(col_start, row_start, col_stop - col_start,
+                  row_stop - row_start)
+
 
+def _window_chunks(chunks, window):
+    """Clip normalized full-raster chunks to a window
+    Chunk edges stay on the full raster's chunk grid, so only the chunks at
+    the window's edges are trimmed.
+    """
+    clipped = []
+    spans = ((window.row_off, window.height), (window.col_off, window.width))
+    for sizes, (start, length) in zip(chunks, spans):
+        stop = start + length
+        edges = np.cumsum((0,) + tuple(sizes))
+        inner = edges[(edges > start) & (edges < stop)]
+        bounds = np.concatenate(([start], inner, [stop]))
+        clipped.append(tuple(int(n) for n in np.diff(bounds)))
+
+    return tuple(clipped)
+
+
+class RasterArray:
+    """Lazy, array-like view of one or more bands of a raster.
+
+    Indexing it reads just the requested window, through the dataset pool
+    or as memmap views. Given the (rows, cols) extent of the file, the
+    window may reach past its edges, and cells out there are filled with
+    fill_value instead of read. `da.from_array` wraps it in a single Blockwise layer
+    whose tasks are computed from chunk indices when the graph is
+    materialized rather than enumerated up front, so the graph stays small,
+    can be culled, and slices taken downstream are fused into the reads.
+    Example:
+        >> window = Window(0, 0, 4096, 4096)
+        >> raster = RasterArray("test.tif", 1, window, "uint16")
+        >> raster[:256, :256].shape
+        (256, 256)
+    """
+
+    def __init__(self, path, indexes, window, dtype, memmap=False,
+                 extent=None, fill_value=0):
+        self.path = path
+        self.indexes = indexes
+        self.window = window
+        self.dtype = np.dtype(dtype)
+        self.memmap = memmap
+        self.extent = extent
+        self.fill_value = fill_value
+        shape = (window.height, window.width)
+        if not isinstance(indexes, int):
+            shape = (len(indexes),) + shape
+        self.shape = shape
+        self.ndim = len(shape)
+
+    def __repr__(self):
+        return "RasterArray<{}, indexes={}, window={}>".format(
+            self.path, self.indexes, self.window)
+
+    def __getitem__(self, key):
+        """Read the bounding window of a key and index into it locally"""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            n = key.index(Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:n] + fill + key[n + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError('too many indices for {}'.format(self))
+
+        spans = []
+        local = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 0:
+                    spans.append((0, n))
+                    local.append(k)
+                else:
+                    stop = max(start, stop)
+                    spans.append((start, stop))
+                    local.append(slice(0, stop - start, step))
+            elif isinstance(k, (int, np.integer)):
+                i = int(k) + n if k < 0 else int(k)
+                if not 0 <= i < n:
+                    raise IndexError('index {} is out of bounds'.format(k))
+                spans.append((i, i + 1))
+                local.append(0)
+            else:
+                spans.append((0, n))
+                local.append(k)
+
+        if any(start == stop for start, stop in spans):
+            shape = tuple(stop - start for start, stop in spans)
+            return np.empty(shape, dtype=self.dtype)[tuple(local)]
+
+        return self._read(spans)[tuple(local)]
 
-def read_raster_band(path, band=1, block_size=1):
+    def _read(self, spans):
+        """Read the block of the raster covered by per-axis (start, stop)"""
+        (row_start, row_stop), (col_start, col_stop) = spans[-2:]
+        window = Window(self.window.col_off + col_start,
+                        self.window.row_off + row_start,
+                        col_stop - col_start, row_stop - row_start)
+        indexes = self.indexes
+        if not isinstance(indexes, int):
+            indexes = list(indexes[spans[0][0]:spans[0][1]])
+
+        if self.extent is not None:
+            return self._read_boundless(window, indexes)
+
+        return self._read_window(window, indexes)
+
+    def _read_boundless(self, window, indexes):
+        """Read the part of a window inside the file, fill the rest"""
+        height, width = self.extent
+        row_start = min(max(window.row_off, 0), height)
+        row_stop = max(min(window.row_off + window.height, height), row_start)
+        col_start = min(max(window.col_off, 0), width)
+        col_stop = max(min(window.col_off + window.width, width), col_start)
+        inner = Window(col_start, row_start, col_stop - col_start,
+                       row_stop - row_start)
+        if inner.width == window.width and inner.height == window.height:
+            return self._read_window(window, indexes)
+
+        shape = (window.height, window.width)
+        if not isinstance(indexes, int):
+            shape = (len(indexes),) + shape
+        array = np.full(shape, self.fill_value, dtype=self.dtype)
+        if inner.width and inner.height:
+            rows = slice(row_start - window.row_off,
+                         row_stop - window.row_off)
+            cols = slice(col_start - window.col_off,
+                         col_stop - window.col_off)
+            array[..., rows, cols] = self._read_window(inner, indexes)
+
+        return array
+
+    def _read_window(self, window, indexes):
+        """Read a window that lies inside the file"""
+        op = "read_mmap" if self.memmap else "read"
+        with METRICS.timed(op, self.path, window) as info:
+            if self.memmap:
+                array = read_mmap_window(self.path, window, indexes,
+                                         self.dtype)
+            else:
+                with POOL.dataset(self.path) as src:
+                    array = src.read(indexes, window=window)
+            info["nbytes"] = array.nbytes
+
+        return array
+
+
+def _from_raster(raster, chunks, name, transform):
+    """Wrap a RasterArray in a dask array carrying its transform"""
+    array = da.from_array(raster, chunks=chunks, name=name, lock=False,
+                          asarray=False, fancy=False,
+                          meta=np.empty((0,) * raster.ndim, raster.dtype))
+    array.transform = transform
+    return array
+
+
+def read_raster_band(path, band=1, block_size=1, chunks=None,
+                     chunk_bytes=None, window=None, bounds=None,
+                     backend="auto"):
     """Read a raster band and return a Dask array
+    Chunks default to the native block shape times `block_size`. Pass
+    chunks="auto" (or just a chunk_bytes target) to size chunks by bytes in
+    whole multiples of the file's tiles or strips, which keeps striped
+    rasters from turning into one task per row. Explicit chunks that cut
+    through blocks raise a ReadAmplificationWarning.
+
+    The graph is one compact Blockwise layer over a RasterArray: tasks are
+    derived from chunk indices on demand, culled when only some chunks are
+    needed, and downstream slices are fused into the window reads.
+
+    A window or bounds restricts the graph to the chunks that intersect it,
+    trimming the edge chunks, so graph size scales with the region read and
+    not the file. The returned array carries the region's affine transform
+    as `array.transform` (an attribute, so dask operations drop it).
+
+    Uncompressed GeoTIFFs, like scratch intermediates, are served as
+    numpy.memmap views of the file's blocks with the "auto" or "memmap"
+    backend, skipping GDAL decoding and copies. Compressed files always go
+    through rasterio.
     Arguments:
         path {string} -- path to the raster file
     Keyword Arguments:
         band {int} -- number of band to read (default: {1})
         block_size {int} -- block size multiplier (default: {1})
+        chunks {string, tuple(int)} -- "auto" or a (rows, cols) chunk
+            shape, overrides block_size (default: {None})
+        chunk_bytes {int, string} -- target chunk size for "auto" chunks,
+            e.g. 2**27 or "128MiB" (default: {None})
+        window {rasterio.windows.Window, tuple} -- pixel window to read
+            (default: {None})
+        bounds {tuple(float)} -- (left, bottom, right, top) projected
+            bounds to read (default: {None})
+        backend {string} -- "auto" memory maps the file when it can and
+            falls back to rasterio, "memmap" insists on it and "rasterio"
+            never uses it (default: {"auto"})
+    Returns:
+        dask.array.Array -- a Dask array
     """
 
-    def read_window(raster_path, window, band):
-        with rasterio.open(raster_path) as src:
-            return src.read(band, window=window)
+    with rasterio.open(path) as src:
+        window = resolve_window(src, window, bounds)
+        chunks = _raster_chunks(src, band, block_size, chunks, chunk_bytes)
+        chunks = da.core.normalize_chunks(chunks, src.shape)
+        chunks = _window_chunks(chunks, window)
+        name = 'raster-{}'.format(tokenize(path, band, chunks, window))
+        dtype = src.dtypes[band - 1]
+        transform = window_transform(window, src.transform)
+        memmap = _use_memmap(src, band, backend)
+
+    raster = RasterArray(path, band, window, dtype, memmap=memmap)
+
+    return _from_raster(raster, chunks, name, transform)
+
+
+def read_raster_bands(path, bands=None, block_size=1, chunks=None,
+                      chunk_bytes=None, window=None, bounds=None,
+                      backend="auto"):
+    """Read several raster bands at once and return a 3d Dask array
+    Each task reads all requested bands of its window with a single
+    `src.read(indexes, window=window)` call and returns a (band, y, x) chunk.
+    Arguments:
+        path {string} -- path to the raster file
+    Keyword Arguments:
+        bands {iterable(int)} -- band numbers to read. When passing None, it
+            reads all bands (default: {None})
+        block_size {int} -- block size multiplier (default: {1})
+        chunks {string, tuple(int)} -- "auto" or a (rows, cols) chunk
+            shape, overrides block_size (default: {None})
+        chunk_bytes {int, string} -- target chunk size for "auto" chunks
+            (default: {None})
+        window {rasterio.windows.Window, tuple} -- pixel window to read
+            (default: {None})
+        bounds {tuple(float)} -- (left, bottom, right, top) projected
+            bounds to read (default: {None})
+        backend {string} -- "auto", "memmap" or "rasterio", see
+            `read_raster_band` (default: {"auto"})
+    Returns:
+        dask.array.Array -- a Dask array of shape (band, y, x), carrying
+            its affine transform as `array.transform`
+    """
+
+    with rasterio.open(path) as src:
+        if bands is None:
+            bands = range(1, src.count + 1)
+        indexes = list(bands)
+        dtypes = {src.dtypes[b - 1] for b in indexes}
+        if len(dtypes) != 1:
+            raise TypeError('bands must share a dtype to be read together, '
+                            'got {}'.format(sorted(dtypes)))
+        window = resolve_window(src, window, bounds)
+        chunks = _raster_chunks(src, indexes[0], block_size, chunks,
+                                chunk_bytes, nbands=len(indexes))
+        chunks = da.core.normalize_chunks(chunks, src.shape)
+        chunks = _window_chunks(chunks, window)
+        name = 'raster-{}'.format(tokenize(path, indexes, chunks, window))
+        dtype = dtypes.pop()
+        transform = window_transform(window, src.transform)
+        memmap = _use_memmap(src, indexes, backend)
+
+    raster = RasterArray(path, indexes, window, dtype, memmap=memmap)
+
+    return _from_raster(raster, ((len(indexes),),) + chunks, name, transform)
+
+
+def aligned_window(src, transform, shape, tolerance=1e-6):
+    """Find the window of a raster that covers a reference grid
+    The raster must share the grid's cell size and orientation and be
+    offset from it by whole cells. The window may reach past the raster's
+    edges, as when a grid is off by a row or column.
+    Arguments:
+        src {rasterio.io.DatasetReader} -- open raster dataset
+        transform {affine.Affine} -- geotransform of the reference grid
+        shape {tuple(int)} -- (rows, cols) of the reference grid
+    Keyword Arguments:
+        tolerance {float} -- allowed difference in cells (default: {1e-6})
+    Returns:
+        rasterio.windows.Window -- integer window of the raster, in its own
+            pixel coordinates, matching the reference grid
+    """
+    source = src.transform
+    for a, b in zip(source[:6:3] + source[1:6:3], transform[:6:3] +
+                    transform[1:6:3]):
+        if abs(a - b) > tolerance * max(abs(source.a), abs(source.e)):
+            raise ValueError('{} does not share the cell size and '
+                             'orientation of the reference grid, it needs '
+                             'to be warped'.format(src.name))
+
+    col_off, row_off = ~source * (transform.c, transform.f)
+    offsets = (round(col_off), round(row_off))
+    if abs(col_off - offsets[0]) > tolerance or \
+            abs(row_off - offsets[1]) > tolerance:
+        raise ValueError('{} is offset from the reference grid by a '
+                         'fraction of a cell, it needs to be '
+                         'warped'.format(src.name))
+
+    return Window(int(offsets[0]), int(offsets[1]), shape[1], shape[0])
 
-    def resize_window(window, block_size):
-        return Window(
-            col_off=window.col_off * block_size,
-            row_off=window.row_off * block_size,
-            width=window.width * block_size,
-            height=window.height * block_size)
 
-    def block_windows(dataset, band, block_size):
-        return [(pos, resize_window(win, block_size))
-                for pos, win in dataset.block_windows(band)]
+def read_aligned(path, reference, band=1, block_size=1, chunks=None,
+                 chunk_bytes=None, fill_value=None, backend="auto"):
+    """Read a raster band onto a reference grid without resampling
+    The band's geotransform is compared against the reference's, and when
+    they differ by whole cells the band is presented as a lazily offset,
+    cropped and padded view: each chunk reads only the part of its window
+    inside the file and fills the rest. Off-by-one grids cost no extra pass
+    and nothing is written back.
+    Arguments:
+        path {string} -- path to the raster file
+        reference {string, tuple} -- path to a raster on the reference grid,
+            or its (transform, (rows, cols))
+    Keyword Arguments:
+        band {int} -- number of band to read (default: {1})
+        block_size {int} -- block size multiplier (default: {1})
+        chunks {string, tuple(int)} -- "auto" or a (rows, cols) chunk
+            shape, laid out on the reference grid. "auto" and default chunks
+            are shifted so their edges fall on the raster's block edges,
+            explicit chunks that cut through blocks raise a
+            ReadAmplificationWarning (default: {None})
+        chunk_bytes {int, string} -- target chunk size for "auto" chunks
+            (default: {None})
+        fill_value {int, float} -- value for cells outside the raster,
+            defaults to its nodata value or 0 (default: {None})
+        backend {string} -- "auto", "memmap" or "rasterio", see
+            `read_raster_band` (default: {"auto"})
+    Returns:
+        dask.array.Array -- a Dask array with the reference grid's shape,
+            carrying its affine transform as `array.transform`
+    """
+    if isinstance(reference, str):
+        with rasterio.open(reference) as ref:
+            transform, shape = ref.transform, ref.shape
+    else:
+        transform, shape = reference
 
     with rasterio.open(path) as src:
-        h, w = src.block_shapes[band - 1]
-        chunks = (h * block_size, w * block_size)
-        name = 'raster-{}'.format(tokenize(path, band, chunks))
+        window = aligned_window(src, transform, shape)
+        if window == Window(0, 0, src.width, src.height):
+            extent = None
+        else:
+            extent = src.shape
+        if fill_value is None:
+            fill_value = src.nodata if src.nodata is not None else 0
+        offset = (window.row_off, window.col_off)
+        explicit = chunks is not None and chunks != "auto"
+        chunks = _raster_chunks(src, band, block_size, chunks, chunk_bytes,
+                                shape=shape, offset=offset)
+        if explicit:
+            chunks = da.core.normalize_chunks(chunks, tuple(shape))
+        else:
+            # Chunks of whole source blocks, with their edges shifted onto
+            # the source's block grid so no block is split between chunks
+            chunks = tuple(_shifted_chunks(size, start, length, extent)
+                           for size, start, length, extent in
+                           zip(chunks, offset, shape, src.shape))
+        name = 'raster-{}'.format(tokenize(path, band, chunks, window,
+                                           fill_value))
         dtype = src.dtypes[band - 1]
-        shape = src.shape
-        blocks = block_windows(src, band, block_size)
+        memmap = _use_memmap(src, band, backend)
 
-    dsk = {(name, i, j): (read_window, path, window, band)
-           for (i, j), window in blocks}
+    raster = RasterArray(path, band, window, dtype, memmap=memmap,
+                         extent=extent, fill_value=fill_value)
 
-    return da.Array(dsk, name, chunks, dtype, shape)
+    return _from_raster(raster, chunks, name, transform)
 
 
 def get_band_count(raster_path):
@@ -84,13 +957,17 @@ def get_band_count(raster_path):
 
 
 # WRITE
-def write_raster(path, array, **kwargs):
+def write_raster(path, array, parallel=False, **kwargs):
     """Write a dask array to a raster file
     If array is 2d, write array on band 1.
     If array is 3d, write data on each band
     Arguments:
         path {string} -- path of raster to write
         array {dask.array.Array} -- band array
+        parallel {bool} -- write each chunk to its own part file without a
+            lock, then assemble the parts into the final raster with
+            multithreaded compression. See `write_raster_parallel`
+            (default: {False})
         kwargs {dict} -- keyword arguments to delegate to rasterio.open
     Examples:
         # Write a single band raster
@@ -100,11 +977,19 @@ def write_raster(path, array, **kwargs):
         >> img = read_raster("test.tif")
         >> new_img = process(img)
         >> write_raster("new.tif", new_img)
+        # Write several rasters in one graph, see `write_rasters`
+        >> write_raster(["a.tif", "b.tif"], [a, b], parallel=True, **profile)
     """
+    if isinstance(path, (list, tuple)):
+        return write_rasters(list(zip(path, array)), parallel=parallel,
+                             **kwargs)
+
     if len(array.shape) != 2 and len(array.shape) != 3:
         raise TypeError('invalid shape (must be either 2d or 3d)')
 
-    if is_dask_collection(array):
+    if is_dask_collection(array) and parallel:
+        write_raster_parallel(path, array, **kwargs)
+    elif is_dask_collection(array):
         with RasterioDataset(path, 'w', **kwargs) as dst:
             da.store(array, dst, lock=True)
     else:
@@ -113,6 +998,222 @@ def write_raster(path, array, **kwargs):
                 dst.write(array, 1)
             else:
                 dst.write(array)
+        release_file(path)
+
+
+def write_rasters(targets, parallel=False, **kwargs):
+    """Write several dask arrays to their own rasters in one graph
+    The arrays are optimized and computed together, so inputs and
+    intermediates they share are read and computed once per block and
+    each result is written to its own file.
+    Arguments:
+        targets {list(tuple)} -- (path, array) pairs, or (path, array,
+            profile) triples whose profile dict updates kwargs for that
+            file
+    Keyword Arguments:
+        parallel {bool} -- write parts without a lock and assemble them,
+            as in `write_raster_parallel` (default: {False})
+        kwargs {dict} -- keyword arguments to delegate to rasterio.open
+    Returns:
+        list(string) -- paths of the written rasters
+    Example:
+        >> codes = read_raster_band("cost_codes.tif")
+        >> write_rasters([("code_cats.tif", classify(codes)),
+        ..                ("cost_cats.tif", classify(codes) * costed)],
+        ..               parallel=True, **profile)
+    """
+    items = []
+    for target in targets:
+        path, array = target[:2]
+        profile = dict(kwargs)
+        if len(target) > 2:
+            profile.update(target[2])
+        if len(array.shape) != 2 and len(array.shape) != 3:
+            raise TypeError('invalid shape (must be either 2d or 3d)')
+        items.append((path, array, profile))
+
+    # Nothing to share between in-memory arrays
+    if not all(is_dask_collection(array) for _, array, _ in items):
+        for path, array, profile in items:
+            write_raster(path, array, parallel=parallel, **profile)
+        return [path for path, _, _ in items]
+
+    if parallel:
+        jobs = [_part_writes(path, array, **profile)
+                for path, array, profile in items]
+        dask.compute(*[writes for writes, _ in jobs])
+        return [assemble() for _, assemble in jobs]
+
+    with ExitStack() as stack:
+        targets = [stack.enter_context(RasterioDataset(path, 'w', **profile))
+                   for path, _, profile in items]
+        da.store([array for _, array, _ in items], targets, lock=True)
+
+    return [path for path, _, _ in items]
+
+
+# Profile keys that describe the dataset rather than how it's stored
+DATASET_KEYS = ("driver", "width", "height", "count", "dtype", "crs",
+                "transform", "nodata")
+
+# Creation options that only set up compression, left off chunk parts
+CODEC_KEYS = ("compress", "predictor", "zlevel", "zstd_level",
+              "jpeg_quality", "webp_level", "webp_lossless", "max_z_error",
+              "lerc_error")
+
+
+def write_raster_parallel(path, array, part_dir=None, keep_parts=False,
+                          **kwargs):
+    """Write a dask array to a raster with lock-free, concurrent chunk writes
+    Every chunk is written uncompressed to its own GeoTIFF part by
+    whichever worker computed it, so nothing is serialized behind a lock and
+    the parts may be written from separate processes. A VRT mosaics the
+    parts, and a final copy assembles them into a single tiled raster,
+    compressing each block once with GDAL's multithreaded compression
+    (NUM_THREADS=ALL_CPUS).
+    Arguments:
+        path {string} -- path of raster to write
+        array {dask.array.Array} -- 2d or 3d band array
+    Keyword Arguments:
+        part_dir {string} -- scratch directory for the chunk parts. Must be
+            visible to every worker (default: {path + ".parts"})
+        keep_parts {bool} -- keep the parts and their VRT after assembling
+            the final raster (default: {False})
+        kwargs {dict} -- keyword arguments to delegate to rasterio.open
+    Returns:
+        string -- path of the written raster
+    """
+    if not is_dask_collection(array):
+        array = da.from_array(np.asarray(array))
+    writes, assemble = _part_writes(path, array, part_dir, keep_parts,
+                                    **kwargs)
+    writes.compute()
+
+    return assemble()
+
+
+def _part_writes(path, array, part_dir=None, keep_parts=False, **kwargs):
+    """Plan the part writes of `write_raster_parallel`
+    Returns:
+        tuple -- a lazy array with one tiny chunk per written part, and a
+            function that assembles the parts into the final raster
+    """
+    if array.ndim == 2:
+        array = array[None, :, :]
+    if array.ndim != 3:
+        raise TypeError('invalid shape (must be either 2d or 3d)')
+
+    profile = dict(driver="GTiff", count=array.shape[0],
+                   height=array.shape[1], width=array.shape[2],
+                   dtype=array.dtype.name)
+    profile.update(kwargs)
+    options = {k: v for k, v in profile.items() if k not in DATASET_KEYS}
+    # Parts are read back once by the final copy, so compressing them would
+    # only spend the codec twice
+    part_profile = {k: v for k, v in options.items()
+                    if k.lower() not in CODEC_KEYS}
+    part_profile.update(driver="GTiff", dtype=profile["dtype"],
+                        compress="NONE")
+    for key in ("crs", "nodata"):
+        if profile.get(key) is not None:
+            part_profile[key] = profile[key]
+
+    if part_dir is None:
+        part_dir = str(path) + ".parts"
+    os.makedirs(part_dir, exist_ok=True)
+
+    # Each chunk writes its own part, in parallel. As a blockwise array
+    # the writes optimize and compute together with other arrays sharing
+    # the same inputs
+    writes = da.map_blocks(_write_block, array, part_dir=part_dir,
+                           profile=part_profile,
+                           transform=profile.get("transform"),
+                           chunks=tuple((1,) * n for n in array.numblocks),
+                           dtype=np.uint8, token="write-parts")
+    offsets = [np.cumsum((0,) + c[:-1]) for c in array.chunks]
+    parts = []
+    for k, i, j in product(*(range(n) for n in array.numblocks)):
+        window = Window(int(offsets[2][j]), int(offsets[1][i]),
+                        array.chunks[2][j], array.chunks[1][i])
+        bands = (int(offsets[0][k]), array.chunks[0][k])
+        parts.append((_part_path(part_dir, (k, i, j)), bands, window))
+
+    def assemble():
+        """Mosaic the parts and assemble the final raster"""
+        vrt = os.path.join(part_dir, "parts.vrt")
+        _write_vrt(vrt, parts, profile)
+        options.setdefault("num_threads", "ALL_CPUS")
+        rasterio.shutil.copy(vrt, path, driver=profile["driver"], **options)
+        release_file(path)
+        if not keep_parts:
+            shutil.rmtree(part_dir)
+        return path
+
+    return writes, assemble
+
+
+def _part_path(part_dir, location):
+    """Path of the part holding the chunk at a (band, y, x) location"""
+    return os.path.join(part_dir, "part_{}_{}_{}.tif".format(*location))
+
+
+def _write_block(block, part_dir, profile, transform, block_info=None):
+    """Write one chunk of a blockwise write to its part"""
+    info = block_info[0]
+    (_, _), (row, _), (col, _) = info["array-location"]
+    profile = dict(profile)
+    if transform is not None:
+        window = Window(col, row, block.shape[2], block.shape[1])
+        profile["transform"] = window_transform(window, transform)
+    _write_part(block, _part_path(part_dir, info["chunk-location"]),
+                profile)
+    return np.zeros((1, 1, 1), dtype=np.uint8)
+
+
+def _write_part(block, part_path, profile):
+    """Write one (band, y, x) chunk to its own raster"""
+    count, height, width = block.shape
+    window = Window(0, 0, width, height)
+    with METRICS.timed("write_part", part_path, window) as info:
+        with rasterio.open(part_path, "w", count=count, height=height,
+                           width=width, **profile) as dst:
+            dst.write(block)
+        info["nbytes"] = block.nbytes
+    return part_path
+
+
+def _write_vrt(vrt_path, parts, profile):
+    """Write a VRT that mosaics chunk parts into the full raster"""
+    dtype = rasterio.dtypes.typename_fwd[
+        rasterio.dtypes.dtype_rev[np.dtype(profile["dtype"]).name]]
+    root = ET.Element("VRTDataset", rasterXSize=str(profile["width"]),
+                      rasterYSize=str(profile["height"]))
+    if profile.get("crs") is not None:
+        crs = CRS.from_user_input(profile["crs"])
+        ET.SubElement(root, "SRS").text = crs.to_wkt()
+    if profile.get("transform") is not None:
+        ET.SubElement(root, "GeoTransform").text = ", ".join(
+            repr(float(v)) for v in profile["transform"].to_gdal())
+
+    for band in range(1, profile["count"] + 1):
+        vband = ET.SubElement(root, "VRTRasterBand", dataType=dtype,
+                              band=str(band))
+        if profile.get("nodata") is not None:
+            ET.SubElement(vband, "NoDataValue").text = repr(
+                float(profile["nodata"]))
+        for part, (band_off, nbands), window in parts:
+            if not band_off < band <= band_off + nbands:
+                continue
+            source = ET.SubElement(vband, "SimpleSource")
+            ET.SubElement(source, "SourceFilename",
+                          relativeToVRT="1").text = os.path.basename(part)
+            ET.SubElement(source, "SourceBand").text = str(band - band_off)
+            size = dict(xSize=str(window.width), ySize=str(window.height))
+            ET.SubElement(source, "SrcRect", xOff="0", yOff="0", **size)
+            ET.SubElement(source, "DstRect", xOff=str(window.col_off),
+                          yOff=str(window.row_off), **size)
+
+    ET.ElementTree(root).write(vrt_path)
 
 
 class RasterioDataset:
@@ -147,8 +1248,10 @@ class RasterioDataset:
         chx_off = x.start
         chx = x.stop - x.start
 
-        self.dataset.write(
-            item, window=Window(chx_off, chy_off, chx, chy), indexes=indexes)
+        window = Window(chx_off, chy_off, chx, chy)
+        with METRICS.timed("write", self.dataset.name, window) as info:
+            self.dataset.write(item, window=window, indexes=indexes)
+            info["nbytes"] = item.nbytes
 
     def __enter__(self):
         """Enter method"""
@@ -157,4 +1260,6 @@ class RasterioDataset:
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit method"""
-        self.dataset.close()
\ No newline at end of file
+        self.dataset.close()
+        if self.dataset.mode != "r":
+            release_file(self.dataset.name)
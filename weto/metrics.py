@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-block I/O instrumentation for weto.dask_raster.
+
+When enabled, every block read (rasterio or memmap) and every block written
+(locked store or parallel part) is timed and recorded with its path, window
+and byte count in a process-local METRICS object. Pipeline stages are
+marked with `stage`, and records are assigned to stages by time, so blocks
+read on distributed workers are attributed correctly once collected.
+
+Recording is off by default. Turn it on with the WETO_METRICS environment
+variable, with `enable_metrics()`, or with the "metrics" setting of
+weto.cluster (WETO_CLUSTER_METRICS=1):
+
+    WETO_METRICS=1 python cost_codes.py
+
+    >> from weto.metrics import METRICS, collect_metrics, enable_metrics
+    >> from weto.metrics import stage
+    >> enable_metrics()
+    >> with stage("composite"):
+    ..    write_raster("cost_codes.tif", composite, parallel=True, **profile)
+    >> collect_metrics(client)
+    >> METRICS.to_csv("io_summary.csv")
+
+Created on Sat Oct 17 14:48:22 2026
+
+@author: twillia2
+"""
+
+import csv
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# Fields of one block record
+FIELDS = ("op", "path", "col_off", "row_off", "width", "height", "nbytes",
+          "start", "seconds")
+
+# Columns of the per-stage summary
+SUMMARY_FIELDS = ("stage", "op", "blocks", "mb", "io_seconds", "p50_ms",
+                  "p99_ms", "max_ms", "block_mb_per_s", "wall_seconds",
+                  "wall_mb_per_s", "slowest")
+
+# Environment variable that turns recording on in every process
+ENV_VAR = "WETO_METRICS"
+
+
+def _env_enabled():
+    """Whether the environment asks for recording"""
+    value = os.environ.get(ENV_VAR, "")
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class IOMetrics:
+    """Thread-safe, process-local record of block I/O timings.
+
+    Records are kept in a bounded deque, so a long-lived worker never holds
+    more than `maxlen` of them. Nothing is timed or kept unless `enabled`.
+    """
+
+    def __init__(self, maxlen=1000000, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=maxlen)
+        self._stages = []
+
+    def record(self, op, path, window, nbytes, start, seconds):
+        """Record one block
+        Arguments:
+            op {string} -- "read", "read_mmap", "write" or "write_part"
+            path {string} -- raster the block belongs to
+            window {rasterio.windows.Window} -- block window
+            nbytes {int} -- bytes read or written
+            start {float} -- wall clock start, from time.time()
+            seconds {float} -- duration
+        """
+        if not self.enabled:
+            return
+        rec = (op, str(path), int(window.col_off), int(window.row_off),
+               int(window.width), int(window.height), int(nbytes), start,
+               seconds)
+        with self._lock:
+            self._records.append(rec)
+
+    @contextmanager
+    def timed(self, op, path, window):
+        """Time the enclosed block I/O. Yields a dict whose "nbytes" entry
+        the caller fills in."""
+        info = {"nbytes": 0}
+        if not self.enabled:
+            yield info
+            return
+        start = time.time()
+        tick = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(op, path, window, info["nbytes"], start,
+                        time.perf_counter() - tick)
+
+    @contextmanager
+    def stage(self, name):
+        """Mark the enclosed code as a named pipeline stage"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stages.append((name, start, time.time()))
+
+    def records(self):
+        """Return the records as a list of dicts"""
+        with self._lock:
+            return [dict(zip(FIELDS, r)) for r in self._records]
+
+    def drain(self):
+        """Return the raw records and forget them"""
+        with self._lock:
+            records = list(self._records)
+            self._records.clear()
+        return records
+
+    def extend(self, records):
+        """Add raw records gathered from another process"""
+        with self._lock:
+            self._records.extend(records)
+
+    def clear(self):
+        """Forget all records and stages"""
+        with self._lock:
+            self._records.clear()
+            self._stages = []
+
+    def _stage_of(self, start):
+        """Name of the latest stage running at a start time"""
+        for name, begin, end in reversed(self._stages):
+            if begin <= start <= end:
+                return name
+        return None
+
+    def summary(self, nslowest=5):
+        """Summarize block latency and throughput by stage and operation
+        Keyword Arguments:
+            nslowest {int} -- number of slowest windows to list per row
+                (default: {5})
+        Returns:
+            list(dict) -- one row per (stage, op) with block counts, MB,
+                p50/p99/max block latency, per-block and wall clock
+                throughput, and the slowest windows
+        """
+        with self._lock:
+            records = list(self._records)
+            stages = {name: end - begin for name, begin, end in self._stages}
+
+        groups = {}
+        for rec in records:
+            key = (self._stage_of(rec[7]), rec[0])
+            groups.setdefault(key, []).append(rec)
+
+        rows = []
+        for (name, op), recs in sorted(groups.items(),
+                                       key=lambda i: (str(i[0][0]), i[0][1])):
+            seconds = np.array([r[8] for r in recs])
+            mb = sum(r[6] for r in recs) / 1e6
+            if name is None:
+                wall = max(r[7] + r[8] for r in recs) - min(r[7] for r in recs)
+            else:
+                wall = stages[name]
+            slowest = sorted(recs, key=lambda r: r[8], reverse=True)
+            slowest = "; ".join(
+                "{}[{},{},{},{}] {:.0f}ms".format(r[1], r[2], r[3], r[4], r[5],
+                                                 r[8] * 1000)
+                for r in slowest[:nslowest])
+            rows.append({
+                "stage": name, "op": op, "blocks": len(recs), "mb": mb,
+                "io_seconds": seconds.sum(),
+                "p50_ms": np.percentile(seconds, 50) * 1000,
+                "p99_ms": np.percentile(seconds, 99) * 1000,
+                "max_ms": seconds.max() * 1000,
+                "block_mb_per_s": mb / max(seconds.sum(), 1e-9),
+                "wall_seconds": wall,
+                "wall_mb_per_s": mb / max(wall, 1e-9),
+                "slowest": slowest})
+
+        return rows
+
+    def to_csv(self, path, nslowest=5):
+        """Write the per-stage summary to a CSV file
+        Arguments:
+            path {string} -- CSV file to write
+        Keyword Arguments:
+            nslowest {int} -- number of slowest windows to list per row
+                (default: {5})
+        """
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.summary(nslowest))
+
+    def records_to_csv(self, path):
+        """Write every raw block record to a CSV file"""
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records())
+
+
+METRICS = IOMetrics(enabled=_env_enabled())
+
+
+def stage(name):
+    """Mark a pipeline stage on the process-wide METRICS"""
+    return METRICS.stage(name)
+
+
+def _drain():
+    return METRICS.drain()
+
+
+def _set_enabled(enabled):
+    METRICS.enabled = enabled
+
+
+def enable_metrics(enabled=True, client=None):
+    """Turn block recording on or off
+    The switch is also set in the environment, so worker processes started
+    afterwards inherit it, and on the running workers of a client.
+    Keyword Arguments:
+        enabled {bool} -- record block I/O (default: {True})
+        client {dask.distributed.Client} -- client whose running workers
+            to switch as well (default: {None})
+    Returns:
+        IOMetrics -- the process-wide METRICS
+    """
+    os.environ[ENV_VAR] = "1" if enabled else "0"
+    _set_enabled(enabled)
+    if client is not None:
+        client.run(_set_enabled, enabled)
+
+    return METRICS
+
+
+def collect_metrics(client=None):
+    """Pull block records from every distributed worker into METRICS
+    Keyword Arguments:
+        client {dask.distributed.Client} -- client of the cluster, or None
+            for the current default client. Does nothing without one
+            (default: {None})
+    Returns:
+        IOMetrics -- the process-wide METRICS
+    """
+    if not METRICS.enabled:
+        return METRICS
+    if client is None:
+        try:
+            from dask.distributed import default_client
+            client = default_client()
+        except (ImportError, ValueError):
+            return METRICS
+
+    for records in client.run(_drain).values():
+        METRICS.extend(records)
+
+    return METRICS
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A small declarative pipeline runner with content-hash based skipping.
+
+Each Stage declares the files it reads, the files it writes and the code
+that defines it. Stages are ordered by matching one stage's outputs to
+another's inputs, independent stages run concurrently, and a stage is
+skipped when the content hashes of its inputs and code match the last
+successful run and its outputs still exist. A stage's code includes the
+modules its scripts import from their own directories and every module of
+the weto package, so a library change reruns the stages it could affect.
+
+    >> stages = [Stage("blm", ["python", "codes/blm.py"],
+    ..                 inputs=["tables/lookup.csv"],
+    ..                 outputs=["rasters/blm_codes.tif"]),
+    ..           Stage("cost_codes", ["python", "cost_codes.py"],
+    ..                 inputs=["rasters/blm_codes.tif"],
+    ..                 outputs=["rasters/cost_codes.tif"])]
+    >> Pipeline(stages, "pipeline.json").run()
+
+An input can be a (path, digest) pair, where digest(path) returns the bytes
+to hash, so a stage can depend on just part of a file, like a few columns
+of a table or the grid of a template raster.
+
+Created on Sat Oct 17 19:41:03 2026
+
+@author: twillia2
+"""
+
+import ast
+import datetime as dt
+import hashlib
+import inspect
+import json
+import os
+import subprocess as sp
+import sys
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob
+
+
+# Multi-file formats hashed together with their sidecars
+SIDECARS = (".shp",)
+
+# Directory of the weto package, whose modules are part of every stage
+LIBRARY = os.path.dirname(os.path.abspath(__file__))
+
+
+def _paths(path):
+    """The files that make up a path: itself, its sidecars, or the files
+    under a directory"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, f)
+                      for root, _, files in os.walk(path) for f in files)
+    if os.path.splitext(path)[1].lower() in SIDECARS:
+        return sorted(glob(os.path.splitext(path)[0] + ".*"))
+    return [path]
+
+
+def _imports(path):
+    """Top level names of the modules a script imports, with any sibling
+    module names of relative imports"""
+    try:
+        with open(path) as file:
+            tree = ast.parse(file.read(), path)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+        return []
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name.split(".")[0] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                names += [a.name for a in node.names]
+            if node.module:
+                names.append(node.module.split(".")[0])
+    return names
+
+
+def source_files(paths):
+    """Scripts plus the source files of everything they import locally
+    Imports are followed from each script to the modules next to it, and
+    any import of weto, or a script inside it, adds every module of the
+    package.
+    Arguments:
+        paths {iterable} -- paths of the scripts
+    Returns:
+        list(string) -- sorted absolute paths of the scripts and the
+            modules they depend on
+    """
+    library = sorted(glob(os.path.join(LIBRARY, "*.py")))
+    found = set()
+    todo = [os.path.abspath(str(path)) for path in paths]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        if path.startswith(LIBRARY + os.sep):
+            todo += [p for p in library if p not in found]
+            continue
+        for name in _imports(path):
+            if name == "weto":
+                todo += library
+                continue
+            module = os.path.join(os.path.dirname(path), name + ".py")
+            if os.path.isfile(module):
+                todo.append(module)
+
+    return sorted(found)
+
+
+def file_hash(path, chunk_size=2**24):
+    """Return the sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def raster_grid(path):
+    """Digest of a raster's grid only: crs, transform and shape. For stages
+    that use a raster as a template"""
+    import rasterio
+    with rasterio.open(path) as src:
+        grid = [str(src.crs), list(src.transform)[:6], src.width,
+                src.height]
+    return json.dumps(grid).encode()
+
+
+def table_columns(*columns):
+    """Make a digest of just some columns of a CSV table, for stages that
+    don't read the rest"""
+    def digest(path):
+        import pandas as pd
+        table = pd.read_csv(path)
+        return table.iloc[:, list(columns)].to_csv(index=False).encode()
+    return digest
+
+
+class HashCache:
+    """Content hashes keyed by (path, size, mtime), so unchanged files are
+    only read once across runs"""
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        """Hash a file, directory or multi-file dataset"""
+        digest = hashlib.sha256()
+        for part in _paths(path):
+            stat = os.stat(part)
+            key = [stat.st_size, stat.st_mtime_ns]
+            with self._lock:
+                entry = self.entries.get(part)
+            if entry is None or entry[:2] != key:
+                entry = key + [file_hash(part)]
+                with self._lock:
+                    self.entries[part] = entry
+            digest.update(os.path.basename(part).encode())
+            digest.update(entry[2].encode())
+        return digest.hexdigest()
+
+
+class Stage:
+    """One step of a pipeline: a command with declared inputs and outputs"""
+
+    def __init__(self, name, command, inputs=(), outputs=(), code=None,
+                 cwd=None):
+        """
+        Arguments:
+            name {string} -- unique stage name
+            command {list, callable} -- subprocess argument list, or a
+                function to call in this process
+        Keyword Arguments:
+            inputs {iterable} -- paths read by the stage, or (path, digest)
+                pairs where digest(path) returns the bytes to hash
+                (default: {()})
+            outputs {iterable} -- paths written by the stage
+                (default: {()})
+            code {iterable} -- source files that define the stage, defaults
+                to the .py files in the command, or the module of a
+                function. The modules they import locally and the weto
+                package are added, see source_files (default: {None})
+            cwd {string} -- working directory for the command
+                (default: {None})
+        """
+        self.name = name
+        self.command = command
+        self.inputs = [i if isinstance(i, tuple) else (i, None)
+                       for i in inputs]
+        self.outputs = list(outputs)
+        self.cwd = cwd
+        if code is None:
+            if callable(command):
+                try:
+                    code = [inspect.getsourcefile(command)]
+                except TypeError:
+                    code = []
+                code = [c for c in code if c and os.path.isfile(c)]
+            else:
+                code = [c for c in command if str(c).endswith(".py")]
+        self.code = source_files(c if os.path.isabs(c) or cwd is None else
+                                 os.path.join(cwd, c) for c in code)
+
+    def __repr__(self):
+        return "Stage<{}>".format(self.name)
+
+    def key(self, hasher):
+        """Hash of the stage's command, code and input contents"""
+        digest = hashlib.sha256()
+        if callable(self.command):
+            digest.update(self.command.__qualname__.encode())
+        else:
+            digest.update(json.dumps([str(c) for c in self.command]).encode())
+        for path in self.code:
+            digest.update(hasher(path).encode())
+        for path, function in sorted(self.inputs, key=lambda i: i[0]):
+            digest.update(path.encode())
+            if not os.path.exists(path):
+                raise FileNotFoundError("{} input {} does not exist".format(
+                    self, path))
+            if function is None:
+                digest.update(hasher(path).encode())
+            else:
+                digest.update(hashlib.sha256(function(path)).digest())
+        return digest.hexdigest()
+
+    def run(self, log_path=None):
+        """Run the command, raising on failure"""
+        if callable(self.command):
+            self.command()
+            return
+        command = [sys.executable if c == "python" else str(c)
+                   for c in self.command]
+        if log_path is None:
+            sp.run(command, cwd=self.cwd, check=True)
+            return
+        with open(log_path, "w") as log:
+            sp.run(command, cwd=self.cwd, check=True, stdout=log,
+                   stderr=sp.STDOUT)
+
+
+class Pipeline:
+    """Stages ordered by their inputs and outputs, run with skipping"""
+
+    def __init__(self, stages, state_path, log_dir=None):
+        """
+        Arguments:
+            stages {list(Stage)} -- every stage of the pipeline
+            state_path {string} -- JSON file recording stage keys and file
+                hashes between runs
+        Keyword Arguments:
+            log_dir {string} -- directory for per-stage command logs, or
+                None to print to the console (default: {None})
+        """
+        self.stages = {s.name: s for s in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("stage names must be unique")
+        self.state_path = state_path
+        self.log_dir = log_dir
+        self._lock = threading.Lock()
+
+        # A stage depends on the stages that write its inputs
+        producers = {}
+        for stage in stages:
+            for path in stage.outputs:
+                if path in producers:
+                    raise ValueError("{} is written by both {} and {}".format(
+                        path, producers[path], stage.name))
+                producers[path] = stage.name
+        self.upstream = {s.name: sorted({producers[p] for p, _ in s.inputs
+                                         if p in producers} - {s.name})
+                         for s in stages}
+        self.order()
+
+    def order(self):
+        """Return stage names in a dependency-respecting order"""
+        done = []
+        pending = dict(self.upstream)
+        while pending:
+            ready = sorted(n for n, up in pending.items()
+                           if all(u in done for u in up))
+            if not ready:
+                raise ValueError("stages form a cycle: {}".format(
+                    sorted(pending)))
+            done += ready
+            for name in ready:
+                del pending[name]
+        return done
+
+    def _downstream(self, names):
+        """Names plus every stage that depends on them"""
+        names = set(names)
+        for name in self.order():
+            if set(self.upstream[name]) & names:
+                names.add(name)
+        return names
+
+    def _upstream(self, names):
+        """Names plus every stage they depend on"""
+        names = set(names)
+        for name in reversed(self.order()):
+            if name in names:
+                names.update(self.upstream[name])
+        return names
+
+    def _load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as file:
+                return json.load(file)
+        return {"hashes": {}, "stages": {}}
+
+    def _save(self, state, hasher):
+        with self._lock:
+            state["hashes"] = dict(hasher.entries)
+            tmp = self.state_path + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump(state, file, indent=2, sort_keys=True)
+            os.replace(tmp, self.state_path)
+
+    def _current(self, stage, key, state):
+        """True when a stage's last successful run matches its key"""
+        record = state["stages"].get(stage.name, {})
+        return (record.get("key") == key and
+                all(os.path.exists(p) for p in stage.outputs))
+
+    def mark_current(self, names):
+        """Record stages as up to date without running them, as when their
+        outputs were brought up to date some other way
+        Arguments:
+            names {iterable} -- names of the stages to record
+        """
+        state = self._load()
+        hasher = HashCache(state.get("hashes"))
+        for name in names:
+            stage = self.stages[name]
+            state["stages"][name] = {
+                "key": stage.key(hasher),
+                "outputs": {p: hasher(p) for p in stage.outputs
+                            if os.path.exists(p)},
+                "finished": dt.datetime.now().isoformat(timespec="seconds"),
+                "seconds": 0}
+        self._save(state, hasher)
+
+    def run(self, targets=None, force=(), max_workers=4, dry_run=False):
+        """Run stages whose code or inputs changed, concurrently where they
+        don't depend on each other
+        Keyword Arguments:
+            targets {iterable} -- names of the stages to bring up to date,
+                with everything they depend on, or None for all
+                (default: {None})
+            force {iterable} -- names of stages to rerun regardless, along
+                with everything downstream of them (default: {()})
+            max_workers {int} -- most stages to run at once (default: {4})
+            dry_run {bool} -- only report what would run. Stages downstream
+                of one that would run are reported as "stale"
+                (default: {False})
+        Returns:
+            dict -- stage name: "ran", "skipped", "stale", "failed" or
+                "blocked"
+        """
+        state = self._load()
+        hasher = HashCache(state.get("hashes"))
+        names = self.order()
+        if targets is not None:
+            unknown = set(targets) - set(names)
+            if unknown:
+                raise KeyError("unknown stages: {}".format(sorted(unknown)))
+            wanted = self._upstream(targets)
+            names = [n for n in names if n in wanted]
+        forced = self._downstream(force)
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        results = {}
+        pending = list(names)
+        running = {}
+
+        def execute(stage):
+            key = stage.key(hasher) if not dry_run or all(
+                os.path.exists(p) for p, _ in stage.inputs) else None
+            if stage.name not in forced and key is not None and \
+                    self._current(stage, key, state):
+                return "skipped"
+            if dry_run:
+                return "stale"
+            print("Running {}...".format(stage.name))
+            start = dt.datetime.now()
+            log_path = None
+            if self.log_dir:
+                log_path = os.path.join(self.log_dir, stage.name + ".log")
+            stage.run(log_path)
+            with self._lock:
+                state["stages"][stage.name] = {
+                    "key": stage.key(hasher),
+                    "outputs": {p: hasher(p) for p in stage.outputs
+                                if os.path.exists(p)},
+                    "finished": dt.datetime.now().isoformat(
+                        timespec="seconds"),
+                    "seconds": (dt.datetime.now() - start).total_seconds()}
+            self._save(state, hasher)
+            print("Finished {}".format(stage.name))
+            return "ran"
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    ups = [u for u in self.upstream[name] if u in names]
+                    if any(results.get(u) in ("failed", "blocked")
+                           for u in ups):
+                        results[name] = "blocked"
+                        pending.remove(name)
+                    elif all(u in results for u in ups):
+                        if dry_run and any(results[u] == "stale"
+                                           for u in ups):
+                            results[name] = "stale"
+                        else:
+                            running[pool.submit(execute,
+                                                self.stages[name])] = name
+                        pending.remove(name)
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as error:
+                        print("{} failed: {}".format(name, error))
+                        results[name] = "failed"
+
+        if not dry_run:
+            self._save(state, hasher)
+
+        return {n: results[n] for n in names}
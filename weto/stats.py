@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Blockwise counting of integer rasters.
+
+Instead of one masked or fancy-indexed array and one full pass per count,
+every cell is binned once by the values of all its inputs. Each chunk is
+counted with `numpy.bincount` and the small per-chunk histograms are
+summed in a tree, so any count that is a sum over those bins comes from a
+single read of the inputs.
+
+    >> hist = joint_histogram([codes, conus != 0, costs > 0]).compute()
+    >> hist.shape
+    (65536, 2, 2)
+    >> nblm = hist[blm_codes, 1, :].sum()
+
+For quick estimates, histograms of a stratified random sample of blocks
+give ratios with confidence intervals from a fraction of the reads.
+
+    >> blocks, strata, totals = sample_blocks(codes.numblocks, 0.05)
+    >> hists = block_histograms([codes, conus != 0], blocks)
+    >> y, x = hists[:, 1:, 1].sum(axis=1), hists[:, :, 1].sum(axis=1)
+    >> share, margin = ratio_estimate(y, x, strata, totals)
+
+Created on Sun Oct 18 09:12:40 2026
+
+@author: twillia2
+"""
+
+import dask
+import dask.array as da
+import numpy as np
+
+
+def bin_count(dtype):
+    """Number of histogram bins that cover every value of a dtype
+    Arguments:
+        dtype {string, numpy.dtype} -- bool or an unsigned integer type of
+            at most 16 bits
+    Returns:
+        int -- number of bins
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "b":
+        return 2
+    if dtype.kind == "u" and dtype.itemsize <= 2:
+        return int(np.iinfo(dtype).max) + 1
+    raise ValueError("bins of {} values must be given explicitly".format(
+        dtype))
+
+
+def _joint_index(blocks, sizes):
+    """Flat joint bin index of each cell in a set of blocks, without cells
+    outside any array's [0, size)"""
+    index = np.zeros(blocks[0].shape, dtype=np.int64)
+    keep = None
+    for block, size in zip(blocks, sizes):
+        # Only check the range when the dtype can fall outside it
+        if block.dtype.kind == "b":
+            bounded = size >= 2
+        else:
+            bounded = (block.dtype.kind == "u" and
+                       np.iinfo(block.dtype).max < size)
+        if not bounded:
+            inside = (block >= 0) & (block < size)
+            keep = inside if keep is None else keep & inside
+        index *= size
+        index += block
+    if keep is not None:
+        return index[keep]
+    return index.ravel()
+
+
+def _histogram_kernel(*blocks, sizes):
+    """Joint histogram of one chunk, with a leading 1 per chunk axis"""
+    index = _joint_index(blocks, sizes)
+    counts = np.bincount(index, minlength=int(np.prod(sizes)))
+    return counts.reshape((1,) * blocks[0].ndim + (counts.size,))
+
+
+def _unique_kernel(*blocks, sizes):
+    """Joint bins with any cells in one chunk and their counts"""
+    return np.unique(_joint_index(blocks, sizes), return_counts=True)
+
+
+def _merge_counts(*parts):
+    """Add up (bins, counts) pairs"""
+    bins = np.concatenate([part[0] for part in parts])
+    counts = np.concatenate([part[1] for part in parts])
+    bins, inverse = np.unique(bins, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=counts,
+                         minlength=bins.size)
+    return bins, totals.astype(np.int64)
+
+
+def _histogram_inputs(arrays, sizes):
+    """Check histogram inputs and give them all the first one's chunks"""
+    arrays = [da.asarray(array) for array in arrays]
+    for array in arrays:
+        if array.dtype.kind not in "biu":
+            raise TypeError("histogram inputs must be integer or boolean, "
+                            "not {}. Cast codes with weto.codes.to_codes"
+                            .format(array.dtype))
+    if sizes is None:
+        sizes = [bin_count(array.dtype) for array in arrays]
+    sizes = [int(size) for size in sizes]
+    if len(sizes) != len(arrays):
+        raise ValueError("need one size per array")
+    if any(array.shape != arrays[0].shape for array in arrays):
+        raise ValueError("arrays must all have the same shape")
+    chunks = arrays[0].chunks
+    return [array.rechunk(chunks) for array in arrays], sizes
+
+
+def joint_histogram(arrays, sizes=None, split_every=None):
+    """Count the cells of each combination of values across arrays
+    Arguments:
+        arrays {list(dask.array.Array)} -- integer or boolean arrays of the
+            same shape, each holding values in [0, size)
+    Keyword Arguments:
+        sizes {list(int)} -- number of bins of each array, values outside
+            [0, size) are not counted. Defaults to every value of each
+            array's dtype, see bin_count (default: {None})
+        split_every {int} -- chunk histograms summed at a time in the tree
+            reduction (default: {None})
+    Returns:
+        dask.array.Array -- int64 counts shaped like sizes, where
+            hist[i, j, ...] is the number of cells where the first array is
+            i, the second is j, and so on
+    """
+    arrays, sizes = _histogram_inputs(arrays, sizes)
+    chunks = arrays[0].chunks
+    nbins = int(np.prod(sizes))
+    ndim = arrays[0].ndim
+    hists = da.map_blocks(_histogram_kernel, *arrays, sizes=sizes,
+                          new_axis=ndim,
+                          chunks=tuple((1,) * len(c) for c in chunks) +
+                          ((nbins,),),
+                          dtype=np.int64, token="joint-histogram")
+    hist = hists.sum(axis=tuple(range(ndim)), split_every=split_every)
+
+    return hist.reshape(tuple(sizes))
+
+
+def sample_blocks(numblocks, fraction=0.05, bands=None, seed=None):
+    """Draw a stratified random sample of the blocks of a 2d chunk grid
+    Block rows are grouped into bands of about equal height, the strata,
+    and the same fraction of blocks is drawn from each, at least two where
+    there are two, so the sample spreads over the whole grid.
+    Arguments:
+        numblocks {tuple(int)} -- (rows, columns) of blocks, as from
+            dask.array.Array.numblocks
+    Keyword Arguments:
+        fraction {float} -- share of blocks to draw (default: {0.05})
+        bands {int} -- number of strata, defaults to one per block row up
+            to 10 (default: {None})
+        seed {int} -- random seed, for a repeatable sample (default: {None})
+    Returns:
+        tuple -- list of (row, col) sampled blocks, numpy array of the
+            stratum of each, and numpy array of the number of blocks in
+            each stratum
+    """
+    rows, cols = numblocks
+    bands = min(bands or 10, rows)
+    edges = np.linspace(0, rows, bands + 1).round().astype(int)
+    rng = np.random.default_rng(seed)
+
+    blocks, strata, totals = [], [], []
+    for stratum, (start, stop) in enumerate(zip(edges[:-1], edges[1:])):
+        pool = [(r, c) for r in range(start, stop) for c in range(cols)]
+        n = min(len(pool), max(2, int(round(fraction * len(pool)))))
+        picks = np.sort(rng.choice(len(pool), n, replace=False))
+        blocks += [pool[i] for i in picks]
+        strata += [stratum] * n
+        totals.append(len(pool))
+
+    return blocks, np.array(strata), np.array(totals)
+
+
+def block_histograms(arrays, blocks, sizes=None):
+    """Joint histograms of some blocks only, one per block
+    Only the chosen blocks of each input are read.
+    Arguments:
+        arrays {list(dask.array.Array)} -- integer or boolean arrays, as
+            in joint_histogram
+        blocks {list(tuple)} -- block indices, as from sample_blocks
+    Keyword Arguments:
+        sizes {list(int)} -- number of bins of each array, see
+            joint_histogram (default: {None})
+    Returns:
+        numpy.ndarray -- int64 counts shaped (blocks,) + sizes
+    """
+    arrays, sizes = _histogram_inputs(arrays, sizes)
+    jobs = [dask.delayed(_histogram_kernel)(
+                *[array.blocks[tuple(block)] for array in arrays],
+                sizes=sizes)
+            for block in blocks]
+    hists = dask.compute(*jobs)
+
+    return np.stack([hist.reshape(sizes) for hist in hists])
+
+
+def ratio_estimate(y, x, strata, totals, confidence=0.95):
+    """Estimate sum(y) / sum(x) over all blocks from a stratified sample
+    Uses the combined ratio estimator with a linearized variance, so the
+    interval is approximate and assumes a reasonably sized sample.
+    Arguments:
+        y {numpy.ndarray} -- numerator count of each sampled block
+        x {numpy.ndarray} -- denominator count of each sampled block
+        strata {numpy.ndarray} -- stratum of each sampled block
+        totals {numpy.ndarray} -- number of blocks in each stratum
+    Keyword Arguments:
+        confidence {float} -- confidence level of the interval
+            (default: {0.95})
+    Returns:
+        tuple(float) -- the estimated ratio and the half width of its
+            confidence interval
+    """
+    from scipy.stats import norm
+
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    groups = [(strata == h, n) for h, n in enumerate(totals)]
+    ysum = sum(n * y[s].mean() for s, n in groups if s.any())
+    xsum = sum(n * x[s].mean() for s, n in groups if s.any())
+    if xsum == 0:
+        return np.nan, np.nan
+    ratio = ysum / xsum
+
+    variance = 0.
+    for selected, n in groups:
+        sampled = selected.sum()
+        if sampled > 1:
+            residuals = y[selected] - ratio * x[selected]
+            variance += (n ** 2 * (1 - sampled / n) *
+                         residuals.var(ddof=1) / sampled)
+    margin = norm.ppf(0.5 + confidence / 2) * np.sqrt(variance) / xsum
+
+    return ratio, margin
+
+
+def histogram_table(hist, names, count="count"):
+    """List the filled bins of a joint histogram as a tidy table
+    Arguments:
+        hist {numpy.ndarray} -- counts from joint_histogram
+        names {list(string)} -- column name for each histogram axis
+    Keyword Arguments:
+        count {string} -- name of the count column (default: {"count"})
+    Returns:
+        pandas.DataFrame -- one row per combination of values with any
+            cells, with a column per axis and the cell count
+    """
+    import pandas as pd
+
+    if len(names) != hist.ndim:
+        raise ValueError("need one name per histogram axis")
+    index = np.nonzero(hist)
+    table = pd.DataFrame(dict(zip(names, index)))
+    table[count] = hist[index]
+
+    return table
+
+
+def value_counts(arrays, names, sizes=None, split_every=8):
+    """Count the cells of each combination of values that occurs across
+    arrays, for value ranges too large for a dense joint_histogram
+    Each chunk lists only the combinations it holds, and the lists are
+    merged in a tree, so memory follows the number of combinations that
+    occur rather than the number possible, like codes by county.
+    Arguments:
+        arrays {list(dask.array.Array)} -- integer or boolean arrays, as
+            in joint_histogram
+        names {list(string)} -- column name for each array
+    Keyword Arguments:
+        sizes {list(int)} -- one more than the largest value counted in
+            each array, see joint_histogram (default: {None})
+        split_every {int} -- chunk lists merged at a time (default: {8})
+    Returns:
+        pandas.DataFrame -- a column per array and "count", with a row per
+            combination that has any cells
+    """
+    import pandas as pd
+
+    arrays, sizes = _histogram_inputs(arrays, sizes)
+    if len(names) != len(arrays):
+        raise ValueError("need one name per array")
+    if np.prod(sizes, dtype=np.float64) >= 2 ** 63:
+        raise ValueError("too many combinations to index: {}".format(sizes))
+
+    parts = [dask.delayed(_unique_kernel)(
+                 *[array.blocks[block] for array in arrays], sizes=sizes)
+             for block in np.ndindex(*arrays[0].numblocks)]
+    while len(parts) > 1:
+        parts = [dask.delayed(_merge_counts)(*parts[i:i + split_every])
+                 for i in range(0, len(parts), split_every)]
+    bins, counts = dask.compute(parts[0])[0]
+
+    values = np.unravel_index(bins, sizes)
+    table = pd.DataFrame(dict(zip(names, values)))
+    table["count"] = counts
+
+    return table
+
+
+def zonal_crosstab(zones, layers, sizes=None, zone_size=None,
+                   split_every=None, blocks=None):
+    """Count cells by zone and by the values of category or flag layers,
+    in one chunked pass
+    Every combination of values gets its own histogram bin, so keep the
+    product of the sizes small: map raw codes to a few categories first.
+    Example:
+        >> table = zonal_crosstab(divisions, {"category": categories,
+        ..                                    "conus": conus != 0,
+        ..                                    "cost": costs > 0})
+        >> table.groupby(["zone", "conus"])["count"].sum()
+    Arguments:
+        zones {dask.array.Array} -- integer zone ids, like a rasterized
+            census division, county or state field. Ids outside
+            [0, zone_size) are not counted
+        layers {dict} -- column name: integer or boolean array on the
+            zones' grid
+    Keyword Arguments:
+        sizes {list(int)} -- number of values of each layer, defaults to
+            every value of each layer's dtype (default: {None})
+        zone_size {int} -- one more than the largest zone id, defaults to
+            every value of the zones' dtype (default: {None})
+        split_every {int} -- see joint_histogram (default: {None})
+        blocks {list(tuple)} -- count only these blocks, each on its own,
+            as from sample_blocks (default: {None})
+    Returns:
+        pandas.DataFrame -- columns "zone", one per layer, and "count",
+            with a row per combination that has any cells. Boolean layers
+            keep boolean columns. With blocks, a leading "block" column
+            holds the position of each block in the list
+    """
+    names = list(layers)
+    arrays = [zones] + [layers[name] for name in names]
+    if sizes is None:
+        sizes = [bin_count(layers[name].dtype) for name in names]
+    if zone_size is None:
+        zone_size = bin_count(zones.dtype)
+    sizes = [zone_size] + list(sizes)
+    if blocks is None:
+        hist = joint_histogram(arrays, sizes, split_every).compute()
+        table = histogram_table(hist, ["zone"] + names)
+    else:
+        hists = block_histograms(arrays, blocks, sizes)
+        table = histogram_table(hists, ["block", "zone"] + names)
+    for name in names:
+        if layers[name].dtype == bool:
+            table[name] = table[name].astype(bool)
+
+    return table
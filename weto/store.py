@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked, compressed Zarr store for handing arrays between pipeline stages.
+
+Interim results go here instead of to GeoTIFFs. Every dask chunk becomes one
+Zarr chunk, written in parallel without locks, and reads come back with the
+same chunks, so nothing is rechunked between stages. GeoTIFFs are only
+written for final deliverables.
+
+Created on Sat Oct 17 11:05:12 2026
+
+@author: twillia2
+"""
+
+import os
+import shutil
+
+import dask.array as da
+import numpy as np
+import zarr
+
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+
+def _create_array(path, shape, chunks, dtype, cname, clevel, fill_value):
+    """Create an empty, compressed zarr array on either zarr 2 or 3"""
+    if hasattr(zarr, "create_array"):
+        from zarr.codecs import BloscCodec
+        codec = BloscCodec(cname=cname, clevel=clevel, shuffle="bitshuffle")
+        return zarr.create_array(path, shape=shape, chunks=chunks,
+                                 dtype=dtype, compressors=codec,
+                                 fill_value=fill_value, overwrite=True)
+    from numcodecs import Blosc
+    codec = Blosc(cname=cname, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+    return zarr.create(store=path, shape=shape, chunks=chunks, dtype=dtype,
+                       compressor=codec, fill_value=fill_value,
+                       overwrite=True)
+
+
+class IntermediateStore:
+    """A directory of named, chunk-aligned zarr arrays with raster metadata.
+
+    Example:
+        >> store = IntermediateStore("/scratch/interim.zarr")
+        >> masked = store.write("blm", blm * mask, transform=transform,
+        ..                      crs=crs)
+        >> composite = da.stack([store.read(n) for n in store.names()])
+        >> write_raster("cost_codes.tif", composite.max(axis=0),
+        ..              **store.profile("blm"))
+    """
+
+    def __init__(self, path, cname="zstd", clevel=1):
+        """
+        Arguments:
+            path {string} -- directory to keep the arrays in
+        Keyword Arguments:
+            cname {string} -- blosc codec, zstd and lz4 are both fast
+                (default: {"zstd"})
+            clevel {int} -- compression level (default: {1})
+        """
+        self.path = os.path.expanduser(path)
+        self.cname = cname
+        self.clevel = clevel
+        os.makedirs(self.path, exist_ok=True)
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def __repr__(self):
+        return "IntermediateStore<{}>".format(self.path)
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def names(self):
+        """List the names of the stored arrays"""
+        return sorted(d for d in os.listdir(self.path)
+                      if os.path.isdir(self._path(d)))
+
+    def write(self, name, array, transform=None, crs=None, nodata=None,
+              compute=True):
+        """Store a dask array under a name
+        Chunks are written concurrently, one zarr chunk per dask chunk.
+        Irregular chunks, like those of a windowed read, are first evened
+        out to the largest chunk shape since zarr needs a regular grid.
+        Arguments:
+            name {string} -- name to store the array under
+            array {dask.array.Array} -- array to store
+        Keyword Arguments:
+            transform {affine.Affine} -- geotransform, defaults to the
+                array's `transform` attribute if it has one
+                (default: {None})
+            crs {string, rasterio.crs.CRS} -- coordinate reference system
+                (default: {None})
+            nodata {int, float} -- nodata value, also used as the fill value
+                (default: {None})
+            compute {bool} -- write now, or return a delayed write that can
+                be computed with other work (default: {True})
+        Returns:
+            dask.array.Array -- the stored array, read lazily back from the
+                store, or a dask.delayed.Delayed when compute is False
+        """
+        if not isinstance(array, da.Array):
+            array = da.from_array(np.asarray(array))
+        if transform is None:
+            transform = getattr(array, "transform", None)
+
+        chunks = tuple(max(c) for c in array.chunks)
+        if any(len(set(c[:-1])) > 1 or c[-1] > c[0] for c in array.chunks):
+            array = array.rechunk(chunks)
+
+        fill_value = 0 if nodata is None else nodata
+        target = _create_array(self._path(name), array.shape, chunks,
+                               array.dtype.str, self.cname, self.clevel,
+                               fill_value)
+        attrs = {"nodata": nodata}
+        if transform is not None:
+            attrs["transform"] = list(transform)[:6]
+        if crs is not None:
+            attrs["crs"] = CRS.from_user_input(crs).to_wkt()
+        target.attrs.update(attrs)
+
+        stored = da.store(array, target, lock=False, compute=compute)
+        if not compute:
+            return stored
+
+        return self.read(name)
+
+    def read(self, name):
+        """Read a stored array lazily, with the chunks it was written with
+        Arguments:
+            name {string} -- name of the stored array
+        Returns:
+            dask.array.Array -- the array, carrying its geotransform as
+                `array.transform` when one was stored
+        """
+        if name not in self:
+            raise KeyError("{} has no array named {}".format(self, name))
+        source = zarr.open_array(self._path(name), mode="r")
+        array = da.from_zarr(source)
+        transform = source.attrs.get("transform")
+        if transform is not None:
+            array.transform = Affine(*transform)
+
+        return array
+
+    def profile(self, name):
+        """Return rasterio.open keyword arguments for writing a stored array
+        out as a GeoTIFF
+        Arguments:
+            name {string} -- name of the stored array
+        Returns:
+            dict -- driver, size, dtype and georeferencing of the array
+        """
+        source = zarr.open_array(self._path(name), mode="r")
+        attrs = dict(source.attrs)
+        shape = source.shape
+        profile = {"driver": "GTiff", "height": shape[-2],
+                   "width": shape[-1],
+                   "count": shape[0] if len(shape) == 3 else 1,
+                   "dtype": np.dtype(source.dtype).name,
+                   "nodata": attrs.get("nodata")}
+        if attrs.get("transform") is not None:
+            profile["transform"] = Affine(*attrs["transform"])
+        if attrs.get("crs") is not None:
+            profile["crs"] = CRS.from_wkt(attrs["crs"])
+
+        return profile
+
+    def remove(self, name):
+        """Delete a stored array"""
+        shutil.rmtree(self._path(name), ignore_errors=True)
+
+    def clear(self):
+        """Delete every stored array"""
+        for name in self.names():
+            self.remove(name)
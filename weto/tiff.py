@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read the storage layout of a GeoTIFF straight from its first IFD.
+
+Only what's needed to find each tile or strip on disk is parsed, so
+uncompressed rasters can be served as numpy.memmap views without GDAL.
+
+Created on Sat Oct 17 09:12:40 2026
+
+@author: twillia2
+"""
+
+import struct
+
+import numpy as np
+
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIG = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+# TIFF field types and their struct formats
+FIELD_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+
+class TiffLayout:
+    """Where the blocks of a TIFF's first image live on disk.
+    Attributes:
+        width, height {int} -- image size in pixels
+        block_height, block_width {int} -- tile shape, or (rows per strip,
+            width) for striped files
+        tiled {bool} -- True for tiled files, False for striped ones
+        samples {int} -- samples (bands) per pixel
+        planar {int} -- 1 for pixel-interleaved, 2 for band-separate blocks
+        bits {int} -- bits per sample
+        compression {int} -- TIFF compression code, 1 is uncompressed
+        byteorder {string} -- "<" or ">"
+        offsets, bytecounts {numpy.ndarray} -- file offset and size of each
+            block, in TIFF order (band major when planar is 2)
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    @property
+    def blocks_across(self):
+        """Number of blocks in a row of blocks"""
+        return -(-self.width // self.block_width)
+
+    @property
+    def blocks_down(self):
+        """Number of blocks in a column of blocks"""
+        return -(-self.height // self.block_height)
+
+    @property
+    def uncompressed(self):
+        """True when blocks are stored as raw pixels"""
+        return self.compression == 1
+
+    @property
+    def contiguous(self):
+        """True when each band's blocks follow one another on disk"""
+        if not hasattr(self, "_contiguous"):
+            per_band = self.blocks_across * self.blocks_down
+            ends = self.offsets + self.bytecounts
+            follows = self.offsets[1:] == ends[:-1]
+            if self.planar == 2:
+                follows[per_band - 1::per_band] = True
+            self._contiguous = bool(follows.all())
+        return self._contiguous
+
+    def block_index(self, band, row, col):
+        """Index into offsets for a band's block at (row, col) in blocks"""
+        index = row * self.blocks_across + col
+        if self.planar == 2:
+            index += (band - 1) * self.blocks_across * self.blocks_down
+        return index
+
+    def block_rows(self, row):
+        """Number of image rows stored in a row of blocks"""
+        if self.tiled:
+            return self.block_height
+        return min(self.block_height, self.height - row * self.block_height)
+
+    def block_nbytes(self, row):
+        """Expected raw size of a block in a row of blocks"""
+        samples = self.samples if self.planar == 1 else 1
+        return (self.block_rows(row) * self.block_width * samples *
+                self.bits // 8)
+
+
+def read_tiff_layout(path):
+    """Parse the block layout of a TIFF or BigTIFF file's first image
+    Arguments:
+        path {string} -- path to a local TIFF file
+    Returns:
+        TiffLayout -- block layout of the first IFD
+    """
+    with open(path, "rb") as file:
+        header = file.read(16)
+        if header[:2] == b"II":
+            order = "<"
+        elif header[:2] == b"MM":
+            order = ">"
+        else:
+            raise ValueError("{} is not a TIFF file".format(path))
+
+        version = struct.unpack(order + "H", header[2:4])[0]
+        if version == 42:
+            count_fmt, entry_fmt, inline = "H", "HHII", 4
+            ifd_offset = struct.unpack(order + "I", header[4:8])[0]
+        elif version == 43:
+            count_fmt, entry_fmt, inline = "Q", "HHQQ", 8
+            ifd_offset = struct.unpack(order + "Q", header[8:16])[0]
+        else:
+            raise ValueError("{} is not a TIFF file".format(path))
+
+        file.seek(ifd_offset)
+        count_size = struct.calcsize(count_fmt)
+        nentries = struct.unpack(order + count_fmt,
+                                 file.read(count_size))[0]
+        entry_size = struct.calcsize(order + entry_fmt)
+        entries = file.read(nentries * entry_size)
+
+        tags = {}
+        for n in range(nentries):
+            entry = entries[n * entry_size:(n + 1) * entry_size]
+            tag, ftype, count, value = struct.unpack(order + entry_fmt,
+                                                     entry)
+            if ftype not in FIELD_TYPES:
+                continue
+            fmt = FIELD_TYPES[ftype]
+            size = struct.calcsize(fmt) * count
+            if size <= inline:
+                raw = entry[-inline:][:size]
+            else:
+                file.seek(value)
+                raw = file.read(size)
+            tags[tag] = np.frombuffer(raw, dtype=order + fmt).astype(
+                np.int64)
+
+    def first(tag, default=None):
+        return int(tags[tag][0]) if tag in tags else default
+
+    width = first(IMAGE_WIDTH)
+    height = first(IMAGE_LENGTH)
+    tiled = TILE_OFFSETS in tags
+    if tiled:
+        block_shape = (first(TILE_LENGTH), first(TILE_WIDTH))
+        offsets, bytecounts = tags[TILE_OFFSETS], tags[TILE_BYTE_COUNTS]
+    else:
+        block_shape = (min(first(ROWS_PER_STRIP, height), height), width)
+        offsets, bytecounts = tags[STRIP_OFFSETS], tags[STRIP_BYTE_COUNTS]
+
+    return TiffLayout(width=width, height=height,
+                      block_height=block_shape[0],
+                      block_width=block_shape[1], tiled=tiled,
+                      samples=first(SAMPLES_PER_PIXEL, 1),
+                      planar=first(PLANAR_CONFIG, 1),
+                      bits=first(BITS_PER_SAMPLE, 1),
+                      compression=first(COMPRESSION, 1), byteorder=order,
+                      offsets=offsets, bytecounts=bytecounts)
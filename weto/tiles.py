@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tile-level change detection and in-place tile rewrites.
+
+Inputs are hashed tile by tile on a shared grid and the hashes are kept
+between runs, so a correction to a small region maps to the few output
+tiles it touches. Those tiles are then recomputed and written back into
+the existing output rasters, leaving every other tile alone.
+
+    >> state = TileState("tiles.npz")
+    >> hashes = {name: tile_hashes(array) for name, array in inputs.items()}
+    >> tiles = state.changed(hashes)
+    >> write_tiles("cost_codes.tif", composite, tiles)
+    >> state.save(hashes)
+
+A TileIndex keeps a value histogram and valid and nodata counts for each
+tile of a raster in a sidecar file. Extent queries add up the tiles they
+cover from the index and only read the parts of edge tiles they overlap.
+
+    >> index = TileIndex("cost_codes.tif")
+    >> index.build()
+    >> index.update(tiles)
+    >> values, counts = index.histogram(bounds=state_bounds)
+
+Created on Sat Oct 17 21:03:55 2026
+
+@author: twillia2
+"""
+
+import hashlib
+
+import dask
+import dask.array as da
+import numpy as np
+import rasterio
+
+from rasterio.windows import Window
+from weto.dask_raster import read_raster_band, release_file, resolve_window
+from weto.metrics import METRICS
+
+
+def _hash_kernel(block):
+    """Hash one 2d block to a (1, 1) uint64"""
+    block = np.ascontiguousarray(block)
+    digest = hashlib.blake2b(block.tobytes(), digest_size=8)
+    digest.update(str(block.dtype).encode())
+    value = np.frombuffer(digest.digest(), dtype=np.uint64)
+    return value.reshape((1, 1))
+
+
+def tile_hashes(array):
+    """Hash each chunk of a 2d array
+    Arguments:
+        array {dask.array.Array} -- 2d array, chunked into tiles
+    Returns:
+        numpy.ndarray -- uint64 hash per tile, shaped like the chunk grid
+    """
+    if array.ndim != 2:
+        raise ValueError("tile_hashes needs a 2d array")
+    chunks = tuple((1,) * len(c) for c in array.chunks)
+    hashes = da.map_blocks(_hash_kernel, array, chunks=chunks,
+                           dtype=np.uint64, token="tile-hashes")
+    return hashes.compute()
+
+
+class TileState:
+    """Tile hashes of named inputs, kept in an .npz file between runs"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return "TileState<{}>".format(self.path)
+
+    def load(self):
+        """Return the saved hashes by input name, empty before a first save"""
+        try:
+            with np.load(self.path) as saved:
+                return {name: saved[name] for name in saved.files}
+        except FileNotFoundError:
+            return {}
+
+    def save(self, hashes):
+        """Save tile hashes by input name"""
+        with open(self.path, "wb") as file:
+            np.savez(file, **hashes)
+
+    def changed(self, hashes):
+        """Find the tiles where any input differs from the saved state
+        Arguments:
+            hashes {dict} -- input name: tile hashes from tile_hashes
+        Returns:
+            list(tuple) -- (row, col) chunk indices of changed tiles, or
+                None when there is no comparable saved state and everything
+                has to be rebuilt
+        """
+        saved = self.load()
+        changed = None
+        for name, new in hashes.items():
+            old = saved.get(name)
+            if old is None or old.shape != new.shape:
+                return None
+            diff = old != new
+            changed = diff if changed is None else changed | diff
+        if changed is None:
+            return []
+        return [tuple(int(i) for i in ix) for ix in np.argwhere(changed)]
+
+
+def write_tiles(path, array, tiles, batch=None):
+    """Recompute some chunks of an array and write them into an existing
+    raster in place
+    Chunks are computed in parallel in batches, then written one by one.
+    Compressed GeoTIFFs append rewritten tiles to the end of the file, so a
+    file grows a little with each update until it is rebuilt.
+    Arguments:
+        path {string} -- existing raster, on the array's grid
+        array {dask.array.Array} -- 2d or (band, y, x) array whose chunks
+            are the tiles
+        tiles {iterable} -- (row, col) chunk indices to write
+    Keyword Arguments:
+        batch {int} -- tiles computed at once, defaults to all of them
+            (default: {None})
+    Returns:
+        int -- number of tiles written
+    """
+    tiles = list(tiles)
+    if not tiles:
+        return 0
+    if array.ndim == 2:
+        array = array[None, :, :]
+    batch = batch or len(tiles)
+    rows = np.cumsum((0,) + array.chunks[1])
+    cols = np.cumsum((0,) + array.chunks[2])
+
+    with rasterio.open(path, "r+") as dst:
+        if (dst.count, dst.height, dst.width) != array.shape:
+            raise ValueError("{} has shape {}, not {}".format(
+                path, (dst.count, dst.height, dst.width), array.shape))
+        for start in range(0, len(tiles), batch):
+            part = tiles[start:start + batch]
+            blocks = dask.compute(*[array.blocks[:, r, c] for r, c in part])
+            for (r, c), block in zip(part, blocks):
+                window = Window(int(cols[c]), int(rows[r]), block.shape[2],
+                                block.shape[1])
+                with METRICS.timed("write", path, window) as info:
+                    dst.write(block.astype(dst.dtypes[0], copy=False),
+                              window=window)
+                    info["nbytes"] = block.nbytes
+    release_file(path)
+
+    return len(tiles)
+
+
+def _tile_stats(block, nodata=None):
+    """Value histogram, valid count and nodata count of one tile"""
+    valid = np.ones(block.shape, dtype=bool)
+    if nodata is not None:
+        valid &= block != nodata
+    if block.dtype.kind == "f":
+        valid &= ~np.isnan(block)
+    values, counts = np.unique(block[valid], return_counts=True)
+    nvalid = int(counts.sum())
+    return values, counts.astype(np.int64), nvalid, block.size - nvalid
+
+
+def _add_histograms(histograms, dtype):
+    """Sum (values, counts) histograms into one"""
+    histograms = list(histograms)
+    if not histograms:
+        return np.array([], dtype=dtype), np.array([], dtype=np.int64)
+    values = np.concatenate([h[0] for h in histograms]).astype(dtype)
+    counts = np.concatenate([h[1] for h in histograms])
+    values, inverse = np.unique(values, return_inverse=True)
+    totals = np.zeros(values.size, dtype=np.int64)
+    np.add.at(totals, inverse.ravel(), counts)
+    return values, totals
+
+
+class TileIndex:
+    """Per-tile value histograms and valid and nodata counts of a raster,
+    kept in a sidecar file next to it
+    Meant for rasters with a limited set of values, like codes or costs
+    mapped from codes, where each tile's histogram stays small.
+    """
+
+    def __init__(self, path, tile=(2048, 2048), index_path=None):
+        """
+        Arguments:
+            path {string} -- raster to index, band 1
+        Keyword Arguments:
+            tile {tuple(int)} -- (rows, columns) of a tile, ideally a
+                multiple of the raster's blocks (default: {(2048, 2048)})
+            index_path {string} -- sidecar file, defaults to the raster path
+                plus ".tiles.npz" (default: {None})
+        """
+        self.path = path
+        self.tile = tuple(int(t) for t in tile)
+        self.index_path = index_path or str(path) + ".tiles.npz"
+        self.tiles = {}
+        self.valid = None
+        self.nodata = None
+        self.dtype = None
+        self.nodata_value = None
+
+    def __repr__(self):
+        return "TileIndex<{}>".format(self.path)
+
+    @property
+    def grid(self):
+        """(rows, columns) of tiles"""
+        with rasterio.open(self.path) as src:
+            shape = (src.height, src.width)
+        return tuple(-(-n // t) for n, t in zip(shape, self.tile))
+
+    def _array(self):
+        return read_raster_band(self.path, chunks=self.tile)
+
+    def _compute(self, array, tiles):
+        """Compute the statistics of some tiles"""
+        jobs = [dask.delayed(_tile_stats)(array.blocks[r, c],
+                                          self.nodata_value)
+                for r, c in tiles]
+        for (r, c), stats in zip(tiles, dask.compute(*jobs)):
+            values, counts, nvalid, nnodata = stats
+            self.tiles[(r, c)] = (values, counts)
+            self.valid[r, c] = nvalid
+            self.nodata[r, c] = nnodata
+
+    def build(self):
+        """Index every tile of the raster and save the index
+        Returns:
+            TileIndex -- self
+        """
+        with rasterio.open(self.path) as src:
+            self.dtype = np.dtype(src.dtypes[0])
+            self.nodata_value = src.nodata
+        array = self._array()
+        grid = array.numblocks
+        self.tiles = {}
+        self.valid = np.zeros(grid, dtype=np.int64)
+        self.nodata = np.zeros(grid, dtype=np.int64)
+        self._compute(array, [(r, c) for r in range(grid[0])
+                              for c in range(grid[1])])
+        self.save()
+        return self
+
+    def update(self, tiles):
+        """Re-index some tiles, after they were rewritten, and save
+        Arguments:
+            tiles {iterable} -- (row, col) tile indices, as from
+                TileState.changed on the same tile grid
+        Returns:
+            int -- number of tiles re-indexed
+        """
+        tiles = [tuple(t) for t in tiles]
+        if not tiles:
+            return 0
+        if not self.tiles:
+            self.load()
+        self._compute(self._array(), tiles)
+        self.save()
+        return len(tiles)
+
+    def save(self):
+        """Write the index to its sidecar file"""
+        keys = sorted(self.tiles)
+        values, counts = _add_histograms([], self.dtype)
+        values = np.concatenate([values] + [self.tiles[k][0] for k in keys])
+        counts = np.concatenate([counts] + [self.tiles[k][1] for k in keys])
+        offsets = np.cumsum([0] + [self.tiles[k][0].size for k in keys])
+        with open(self.index_path, "wb") as file:
+            np.savez(
+                file, tile=np.array(self.tile), keys=np.array(keys),
+                offsets=offsets, values=values, counts=counts,
+                valid=self.valid, nodata=self.nodata,
+                dtype=np.array(self.dtype.str),
+                nodata_value=np.array(np.nan if self.nodata_value is None
+                                      else self.nodata_value))
+
+    def load(self):
+        """Read the index from its sidecar file
+        Returns:
+            TileIndex -- self
+        """
+        with np.load(self.index_path) as saved:
+            if tuple(saved["tile"]) != self.tile:
+                raise ValueError("{} was built with {} tiles, not {}".format(
+                    self.index_path, tuple(saved["tile"]), self.tile))
+            offsets = saved["offsets"]
+            values = saved["values"]
+            counts = saved["counts"]
+            self.tiles = {
+                tuple(int(i) for i in key): (values[a:b], counts[a:b])
+                for key, a, b in zip(saved["keys"], offsets[:-1],
+                                     offsets[1:])}
+            self.valid = saved["valid"]
+            self.nodata = saved["nodata"]
+            self.dtype = np.dtype(str(saved["dtype"]))
+            nodata = float(saved["nodata_value"])
+            self.nodata_value = None if np.isnan(nodata) else nodata
+        if self.valid.shape != self.grid:
+            raise ValueError("{} does not match the grid of {}".format(
+                self.index_path, self.path))
+        return self
+
+    def _query(self, window, bounds):
+        """Histograms and counts of the full tiles and edge pieces of an
+        extent"""
+        if not self.tiles:
+            self.load()
+        with rasterio.open(self.path) as src:
+            window = resolve_window(src, window, bounds)
+            rows = (window.row_off, window.row_off + window.height)
+            cols = (window.col_off, window.col_off + window.width)
+            th, tw = self.tile
+            histograms = []
+            nvalid = nnodata = 0
+            for r in range(rows[0] // th, -(-rows[1] // th)):
+                for c in range(cols[0] // tw, -(-cols[1] // tw)):
+                    top, left = r * th, c * tw
+                    bottom = min(top + th, src.height)
+                    right = min(left + tw, src.width)
+                    piece = (max(top, rows[0]), min(bottom, rows[1]),
+                             max(left, cols[0]), min(right, cols[1]))
+                    if piece == (top, bottom, left, right):
+                        histograms.append(self.tiles[(r, c)])
+                        nvalid += int(self.valid[r, c])
+                        nnodata += int(self.nodata[r, c])
+                        continue
+
+                    # Only the part of an edge tile inside the extent
+                    edge = Window(piece[2], piece[0], piece[3] - piece[2],
+                                  piece[1] - piece[0])
+                    with METRICS.timed("read", self.path, edge) as info:
+                        block = src.read(1, window=edge)
+                        info["nbytes"] = block.nbytes
+                    values, counts, v, n = _tile_stats(block,
+                                                       self.nodata_value)
+                    histograms.append((values, counts))
+                    nvalid += v
+                    nnodata += n
+
+        return histograms, nvalid, nnodata
+
+    def histogram(self, window=None, bounds=None):
+        """Count each value in an extent, without nodata
+        Tiles inside the extent come from the index, only the overlapping
+        parts of edge tiles are read.
+        Keyword Arguments:
+            window {rasterio.windows.Window, tuple} -- pixel window, see
+                weto.dask_raster.resolve_window (default: {None})
+            bounds {tuple(float)} -- (left, bottom, right, top) projected
+                bounds (default: {None})
+        Returns:
+            tuple(numpy.ndarray) -- sorted values and their cell counts
+        """
+        histograms, _, _ = self._query(window, bounds)
+        return _add_histograms(histograms, self.dtype)
+
+    def summary(self, window=None, bounds=None):
+        """Summarize the values in an extent
+        Keyword Arguments:
+            window {rasterio.windows.Window, tuple} -- pixel window
+                (default: {None})
+            bounds {tuple(float)} -- (left, bottom, right, top) projected
+                bounds (default: {None})
+        Returns:
+            dict -- cells, valid and nodata counts and the sum, mean,
+                minimum and maximum of the valid values
+        """
+        histograms, nvalid, nnodata = self._query(window, bounds)
+        values, counts = _add_histograms(histograms, self.dtype)
+        total = float(np.dot(values.astype(np.float64), counts))
+        return {"cells": nvalid + nnodata, "valid": nvalid,
+                "nodata": nnodata, "sum": total,
+                "mean": total / nvalid if nvalid else np.nan,
+                "min": values[0].item() if values.size else np.nan,
+                "max": values[-1].item() if values.size else np.nan}